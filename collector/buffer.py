@@ -0,0 +1,311 @@
+import logging
+import threading
+import time
+
+from sqlalchemy import exc
+
+logger = logging.getLogger(__name__)
+
+
+def is_transient(error):
+    """
+    Checks if a database error is likely to go away when the same
+    statements are retried later on, like a lost connection.
+
+    :param error: The error the database gave.
+    :type error: sqlalchemy.exc.SQLAlchemyError
+    :return: True if the error is transient.
+    :rtype: bool
+    """
+    if isinstance(error, (exc.OperationalError, exc.DisconnectionError,
+                          exc.TimeoutError)):
+        return True
+    return getattr(error, 'connection_invalidated', False)
+
+
+class WriteBehindBuffer(object):
+    """
+    Buffers storage rows in memory and writes them to the database in bulk,
+    grouped per model (and thus per table), as soon as either the row count
+    or the time threshold is reached. The rollup counts of the written rows
+    are written in the same transaction.
+
+    When the database is unavailable, the rows stay buffered until a later
+    flush succeeds. Rows the database refuses are retried per table and
+    then one by one, so a single bad row can't hold back the others; the
+    rows that still fail are dropped.
+    """
+
+    def __init__(self, db, max_rows=500, max_delay=1.0, observer=None,
+                 rollup=None, max_buffered=100000):
+        """
+        Creates a new write-behind buffer.
+
+        :param db: The database session to flush the rows with.
+        :type db: sqlalchemy.orm.scoped_session
+        :param max_rows: The amount of buffered rows that triggers a flush.
+        :type max_rows: int
+        :param max_delay: The maximum time (in seconds) a row may stay
+            buffered before it's written.
+        :type max_delay: float
+        :param observer: Optional callable that gets the amount of rows and
+            the duration of every successful flush.
+        :type observer: callable
+        :param rollup: Optional callable that writes the rollup counts
+            (without committing), given the session and the counts.
+        :type rollup: callable
+        :param max_buffered: The maximum amount of buffered rows; rows that
+            don't fit anymore are dropped. 0 disables the limit.
+        :type max_buffered: int
+        """
+        self.db = db
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.observer = observer
+        self.rollup = rollup
+        self.max_buffered = max_buffered
+        self._lock = threading.Lock()
+        # The (row, rollup cell) pairs, per model
+        self._rows = {}
+        self._count = 0
+        self._oldest = None
+        # Statistics about the flushes that happened
+        self.flushes = 0
+        self.rows_written = 0
+        self.last_flush_rows = 0
+        self.last_flush_duration = 0.0
+        # Rows that were dropped because the database refused them, or
+        # because the buffer was full
+        self.rows_refused = 0
+        self.rows_overflowed = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, row, cell=None):
+        """
+        Queues a row for storage, and flushes the buffer if it's full.
+
+        :param row: The row to store.
+        :type row: database.Base
+        :param cell: The rollup cell the row counts in (see
+            collector.rollup.get_cell), if any.
+        :type cell: tuple
+        :return: None
+        :rtype: None
+        """
+        self.extend([row], [cell])
+
+    def extend(self, rows, cells=None):
+        """
+        Queues multiple rows for storage, and flushes the buffer if it's
+        full.
+
+        :param rows: The rows to store.
+        :type rows: list[database.Base]
+        :param cells: The rollup cell of each row (see
+            collector.rollup.get_cell), or None for rows that aren't
+            counted.
+        :type cells: list[tuple]
+        :return: None
+        :rtype: None
+        """
+        if len(rows) == 0:
+            return
+        if cells is None:
+            cells = [None] * len(rows)
+        with self._lock:
+            accepted = len(rows)
+            if self.max_buffered > 0:
+                accepted = max(0, min(accepted,
+                                      self.max_buffered - self._count))
+            for row, cell in zip(rows[:accepted], cells):
+                self._rows.setdefault(type(row), []).append((row, cell))
+            self._count += accepted
+            self.rows_overflowed += len(rows) - accepted
+            if self._oldest is None and accepted > 0:
+                self._oldest = time.time()
+            full = self._count >= self.max_rows
+        if accepted < len(rows):
+            logger.warning('Buffer is full; dropping %s rows',
+                           len(rows) - accepted)
+        if full:
+            self.flush()
+
+    def is_due(self):
+        """
+        Checks if the oldest buffered row exceeded the maximum delay.
+
+        :return: True if the buffer should be flushed.
+        :rtype: bool
+        """
+        oldest = self._oldest
+        return oldest is not None and time.time() - oldest >= self.max_delay
+
+    def tick(self):
+        """
+        Flushes the buffer if the time threshold passed. Meant to be called
+        periodically (e.g. through a LoopingCall).
+
+        :return: None
+        :rtype: None
+        """
+        if self.is_due():
+            self.flush()
+
+    def flush(self):
+        """
+        Writes all buffered rows to the database, using a single bulk insert
+        per model and one commit for the whole batch. If the database is
+        unavailable, the rows are put back in the buffer so they can be
+        retried on the next flush. If it refuses the batch for any other
+        reason, the rows are retried per model and then one by one.
+
+        :return: The amount of rows that were written.
+        :rtype: int
+        """
+        with self._lock:
+            if self._count == 0:
+                return 0
+            pending, count = self._rows, self._count
+            self._rows, self._count, self._oldest = {}, 0, None
+        start = time.time()
+        groups = list(pending.items())
+        try:
+            self._write(groups)
+            written = count
+        except exc.SQLAlchemyError as e:
+            if is_transient(e):
+                self._requeue(groups)
+                logger.error('Flush of %s rows failed, keeping them '
+                             'buffered: %s', count, e)
+                return 0
+            logger.warning('Flush of %s rows failed, retrying them per '
+                           'table: %s', count, e)
+            written = self._salvage(groups)
+            if written == 0:
+                return 0
+        duration = time.time() - start
+        self.flushes += 1
+        self.rows_written += written
+        self.last_flush_rows = written
+        self.last_flush_duration = duration
+        if self.observer is not None:
+            self.observer(written, duration)
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Flushed %s rows (%s) in %.3f seconds', written,
+                        ', '.join('%s: %s' % (model.__tablename__,
+                                              len(entries))
+                                  for model, entries in groups),
+                        duration, extra={'category': 'flush'})
+        return written
+
+    def _write(self, groups):
+        """
+        Writes rows and their rollup counts in a single transaction. The
+        transaction is rolled back if that fails.
+
+        :param groups: The (model, [(row, cell)]) pairs to write.
+        :type groups: list[tuple]
+        :return: None
+        :rtype: None
+        """
+        counts = {}
+        try:
+            for model, entries in groups:
+                self.db.bulk_save_objects([row for row, cell in entries])
+                for row, cell in entries:
+                    if cell is not None:
+                        counts[cell] = counts.get(cell, 0) + 1
+            if self.rollup is not None and len(counts) > 0:
+                self.rollup(self.db, counts)
+            self.db.commit()
+        except exc.SQLAlchemyError:
+            self.db.rollback()
+            raise
+
+    def _salvage(self, groups):
+        """
+        Writes the rows of a refused flush per model, and the rows of a
+        model that's still refused one by one. The rows that the database
+        keeps refusing are dropped. If the database becomes unavailable
+        meanwhile, the remaining rows are put back in the buffer.
+
+        :param groups: The (model, [(row, cell)]) pairs to write.
+        :type groups: list[tuple]
+        :return: The amount of rows that were written.
+        :rtype: int
+        """
+        written = 0
+        for index, (model, entries) in enumerate(groups):
+            try:
+                self._write([(model, entries)])
+                written += len(entries)
+                continue
+            except exc.SQLAlchemyError as e:
+                if is_transient(e):
+                    self._requeue(groups[index:])
+                    return written
+            for position, entry in enumerate(entries):
+                try:
+                    self._write([(model, [entry])])
+                    written += 1
+                except exc.SQLAlchemyError as e:
+                    if is_transient(e):
+                        self._requeue([(model, entries[position:])] +
+                                      groups[index + 1:])
+                        return written
+                    self.rows_refused += 1
+                    logger.error('Dropping %s row that the database '
+                                 'refuses: %s', model.__tablename__, e)
+        return written
+
+    def _requeue(self, groups):
+        """
+        Puts rows of a failed flush back in front of the buffer. If they
+        don't fit anymore, the newest rows are dropped: first the ones that
+        were added during the flush, then the ones that are put back.
+
+        :param groups: The (model, [(row, cell)]) pairs to put back.
+        :type groups: list[tuple]
+        :return: None
+        :rtype: None
+        """
+        requeued = dict(groups)
+        with self._lock:
+            overflow = 0
+            if self.max_buffered > 0:
+                overflow = max(0, self._count - self.max_buffered + sum(
+                    len(entries) for entries in requeued.values()))
+            dropped = self._trim(self._rows, overflow)
+            dropped += self._trim(requeued, overflow - dropped)
+            self._count -= dropped
+            self.rows_overflowed += dropped
+            for model, entries in requeued.items():
+                self._rows[model] = entries + self._rows.get(model, [])
+                self._count += len(entries)
+            self._oldest = time.time()
+        if dropped > 0:
+            logger.warning('Buffer is full; dropping %s rows', dropped)
+
+    @staticmethod
+    def _trim(rows, amount):
+        """
+        Removes rows from the end of the lists of their model.
+
+        :param rows: The (row, cell) pairs, per model.
+        :type rows: dict[type,list]
+        :param amount: The amount of rows to remove.
+        :type amount: int
+        :return: The amount of rows that were removed.
+        :rtype: int
+        """
+        removed = 0
+        for model in list(rows):
+            if removed >= amount:
+                break
+            entries = rows[model]
+            keep = max(0, len(entries) - (amount - removed))
+            removed += len(entries) - keep
+            rows[model] = entries[:keep]
+        return removed
@@ -0,0 +1,226 @@
+import collections
+import logging
+import threading
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from mod_config.models import CacheVersion
+from mod_honeypot.models import Deployment
+
+logger = logging.getLogger(__name__)
+
+
+class DeploymentRecord(object):
+    """
+    Resolved, session independent view on a deployment and the services of
+    its profile, as needed by the collector to process a message.
+    """
+
+    def __init__(self, deployment_id, instance_key, mac_key, encryption_key,
+                 services):
+        """
+        Creates a new record.
+
+        :param deployment_id: The id of the deployment.
+        :type deployment_id: int
+        :param instance_key: The instance key of the deployment.
+        :type instance_key: str
+        :param mac_key: The key used for message authentication.
+        :type mac_key: str
+        :param encryption_key: The key used for encryption.
+        :type encryption_key: str
+        :param services: The services of the profile, mapping the service
+            name on a (service_id, parsed service config) tuple.
+        :type services: dict[str,tuple]
+        """
+        self.id = deployment_id
+        self.instance_key = instance_key
+        self.mac_key = mac_key
+        self.encryption_key = encryption_key
+        self.services = services
+
+    def __repr__(self):
+        return '<DeploymentRecord %r: %r>' % (self.id, self.instance_key)
+
+    @staticmethod
+    def from_deployment(deployment):
+        """
+        Resolves a deployment (and its profile services) into a record.
+
+        :param deployment: The deployment.
+        :type deployment: mod_honeypot.models.Deployment
+        :return: The resolved record.
+        :rtype: DeploymentRecord
+        """
+        return DeploymentRecord(
+            deployment.id, deployment.instance_key, deployment.mac_key,
+            deployment.encryption_key,
+            dict((ps.service.name, (ps.service_id, ps.get_service_config()))
+                 for ps in deployment.profile.services)
+        )
+
+
+class DeploymentCache(object):
+    """
+    Maps instance keys on resolved deployment records, so that known
+    honeypots can be processed without querying the database. Keys without
+    a deployment are remembered for a while as well, so they don't cost a
+    query every time.
+    """
+
+    def __init__(self, db, missing_ttl=10.0, max_missing=10000,
+                 clock=time.time):
+        """
+        Creates a new, empty cache.
+
+        :param db: The database session used to resolve unknown keys.
+        :type db: sqlalchemy.orm.scoped_session
+        :param missing_ttl: How long (in seconds) a key without deployment
+            is remembered; 0 disables this.
+        :type missing_ttl: float
+        :param max_missing: The maximum amount of keys without deployment
+            to remember; the oldest ones are forgotten first.
+        :type max_missing: int
+        :param clock: Function that returns the current time in seconds.
+        :type clock: callable
+        """
+        self.db = db
+        self.missing_ttl = missing_ttl
+        self.max_missing = max_missing
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._records = {}
+        # Keys without deployment, with the time they expire
+        self._missing = collections.OrderedDict()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, instance_key):
+        """
+        Gets the record for the given instance key, loading it from the
+        database if it's not cached yet.
+
+        :param instance_key: The instance key.
+        :type instance_key: str
+        :return: The record, or None if there's no such deployment.
+        :rtype: DeploymentRecord
+        """
+        record = self._records.get(instance_key, None)
+        if record is not None:
+            self.hits += 1
+            return record
+        if self._is_missing(instance_key):
+            self.hits += 1
+            return None
+        self.misses += 1
+        generation = self._generation
+        try:
+            deployment = self.db.query(Deployment).filter(
+                Deployment.instance_key == instance_key).first()
+            record = None
+            if deployment is not None:
+                record = DeploymentRecord.from_deployment(deployment)
+        finally:
+            # Also after an error (e.g. a lost connection), so the session
+            # of this thread remains usable
+            self.db.rollback()
+        with self._lock:
+            # Don't cache what was loaded before an invalidation
+            if generation == self._generation:
+                if record is not None:
+                    self._records[instance_key] = record
+                elif self.missing_ttl > 0:
+                    self._missing.pop(instance_key, None)
+                    if len(self._missing) >= self.max_missing:
+                        self._missing.popitem(last=False)
+                    self._missing[instance_key] = \
+                        self._clock() + self.missing_ttl
+        return record
+
+    def _is_missing(self, instance_key):
+        """
+        Checks if a key recently turned out to have no deployment.
+
+        :param instance_key: The instance key.
+        :type instance_key: str
+        :return: True if the key is known to have no deployment.
+        :rtype: bool
+        """
+        with self._lock:
+            expires = self._missing.get(instance_key, None)
+            if expires is None:
+                return False
+            if expires > self._clock():
+                return True
+            del self._missing[instance_key]
+            return False
+
+    def invalidate(self):
+        """
+        Drops all cached records, and forgets which keys had no deployment.
+
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            self._records = {}
+            self._missing = collections.OrderedDict()
+            self._generation += 1
+
+
+class CacheVersionWatcher(object):
+    """
+    Polls the cache versions that the web application bumps, and calls the
+    registered callbacks for every version that changed.
+    """
+
+    def __init__(self, db):
+        """
+        Creates a new watcher.
+
+        :param db: The database session to poll with.
+        :type db: sqlalchemy.orm.scoped_session
+        """
+        self.db = db
+        self._callbacks = {}
+        self._versions = None
+
+    def register(self, name, callback):
+        """
+        Registers a callback for when the given cache version changes.
+
+        :param name: The name of the cache.
+        :type name: str
+        :param callback: A callable without arguments.
+        :type callback: callable
+        :return: None
+        :rtype: None
+        """
+        self._callbacks.setdefault(name, []).append(callback)
+
+    def poll(self):
+        """
+        Fetches the current versions and notifies the callbacks of every
+        changed one. The first poll only records the versions.
+
+        :return: None
+        :rtype: None
+        """
+        try:
+            versions = dict(self.db.query(
+                CacheVersion.name, CacheVersion.version).all())
+            # End the transaction, so the next poll sees new versions
+            self.db.rollback()
+        except SQLAlchemyError as e:
+            self.db.rollback()
+            logger.error('Could not poll cache versions: %s', e)
+            return
+        previous, self._versions = self._versions, versions
+        if previous is None:
+            return
+        for name, callbacks in self._callbacks.items():
+            if versions.get(name, 0) != previous.get(name, 0):
+                for callback in callbacks:
+                    callback()
@@ -0,0 +1,67 @@
+import collections
+import threading
+
+
+class DuplicateFilter(object):
+    """
+    Remembers the most recent batch nonces of every deployment, so that
+    batches a client retransmits are only processed once.
+    """
+
+    def __init__(self, window=1024, max_deployments=10000):
+        """
+        Creates an empty filter.
+
+        :param window: The amount of nonces to remember per deployment; the
+            oldest ones are forgotten first.
+        :type window: int
+        :param max_deployments: The maximum amount of deployments to keep
+            nonces for; the least recently seen ones are forgotten first.
+        :type max_deployments: int
+        """
+        self.window = window
+        self.max_deployments = max_deployments
+        self._lock = threading.Lock()
+        self._nonces = collections.OrderedDict()
+
+    def seen(self, instance_key, nonce):
+        """
+        Checks if a nonce was recorded before, without recording it.
+
+        :param instance_key: The instance key of the deployment.
+        :type instance_key: str
+        :param nonce: The nonce of the batch.
+        :type nonce: bytes
+        :return: True if the batch is a duplicate.
+        :rtype: bool
+        """
+        with self._lock:
+            nonces = self._nonces.get(instance_key, None)
+            return nonces is not None and nonce in nonces
+
+    def add(self, instance_key, nonce):
+        """
+        Records a nonce. Should only be called once the batch is known to
+        be authentic, so forged batches can't block real ones.
+
+        :param instance_key: The instance key of the deployment.
+        :type instance_key: str
+        :param nonce: The nonce of the batch.
+        :type nonce: bytes
+        :return: False if the nonce was recorded already (the batch is a
+            duplicate), True otherwise.
+        :rtype: bool
+        """
+        with self._lock:
+            nonces = self._nonces.pop(instance_key, None)
+            if nonces is None:
+                nonces = collections.OrderedDict()
+                if len(self._nonces) >= self.max_deployments:
+                    self._nonces.popitem(last=False)
+            self._nonces[instance_key] = nonces
+            if nonce in nonces:
+                return False
+            nonces[nonce] = True
+            if len(nonces) > self.window:
+                nonces.popitem(last=False)
+            return True
@@ -0,0 +1,337 @@
+import json
+import logging
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a notifier that keeps failing, and lets a single trial
+    call through once the reset timeout passed.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        """
+        Creates a new (closed) circuit breaker.
+
+        :param threshold: Consecutive failures after which the circuit opens.
+        :type threshold: int
+        :param reset_timeout: Seconds after which an open circuit allows a
+            trial call.
+        :type reset_timeout: float
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened = None
+
+    @property
+    def is_open(self):
+        """
+        Checks, without changing the state, if calls are currently refused.
+
+        :return: True if the circuit is open and not ready for a trial.
+        :rtype: bool
+        """
+        opened = self._opened
+        return opened is not None and \
+            time.time() - opened < self.reset_timeout
+
+    def allow(self):
+        """
+        Checks if a call may be made.
+
+        :return: True if the circuit is closed, or if it's time for a trial.
+        :rtype: bool
+        """
+        with self._lock:
+            if self._opened is None:
+                return True
+            if time.time() - self._opened >= self.reset_timeout:
+                # Half open: let this call through, and only this one
+                self._opened = time.time()
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened = None
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.threshold:
+                self._opened = time.time()
+
+
+class _Lane(object):
+    """
+    Queue and workers for a single notifier.
+    """
+
+    def __init__(self, name, config, queue_size, breaker):
+        self.name = name
+        self.config = config
+        self.queue = queue.Queue(queue_size)
+        self.breaker = breaker
+        self.workers = []
+        # Guards the retirement, so no message is queued after it
+        self.lock = threading.Lock()
+        # The notifier the workers share, obtained on first use
+        self.notifier_lock = threading.Lock()
+        self.notifier = None
+        # Workers that are still running
+        self.active = 0
+        # Set once the lane is no longer used for new messages
+        self.retired = False
+
+    def retire(self):
+        """
+        Stops the lane from taking new messages, and wakes up the idle
+        workers. Workers that can't be woken up (because the queue is full)
+        stop once they find the queue empty.
+
+        :return: None
+        :rtype: None
+        """
+        with self.lock:
+            self.retired = True
+        for worker in self.workers:
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                break
+
+
+class NotificationDispatcher(object):
+    """
+    Sends notifications from worker threads, so that the ingest path only
+    has to enqueue them. Every notifier gets its own bounded queue, a fixed
+    amount of workers (its concurrency limit) and a circuit breaker, so one
+    slow or broken notifier can't hold up the others.
+    """
+
+    def __init__(self, get_notifier, queue_size=1000, concurrency=1,
+                 timeout=10.0, failure_threshold=5, reset_timeout=30.0,
+                 release_notifier=None, observer=None):
+        """
+        Creates a new dispatcher.
+
+        :param get_notifier: Callable that returns a notifier for a given
+            name and config (e.g. NotificationLoader.pool.get).
+        :type get_notifier: callable
+        :param queue_size: The maximum amount of pending messages per
+            notifier. Messages beyond this are dropped.
+        :type queue_size: int
+        :param concurrency: The amount of workers per notifier. A notifier
+            is only used by more than one thread at a time if this is
+            larger than 1.
+        :type concurrency: int
+        :param timeout: The maximum time (in seconds) a message may wait in
+            the queue, and a call may take before it counts as failed.
+            Python threads can't be interrupted, so a call that overruns
+            keeps its worker busy until it returns.
+        :type timeout: float
+        :param failure_threshold: Consecutive failures that open the
+            circuit of a notifier.
+        :type failure_threshold: int
+        :param reset_timeout: Seconds before an open circuit is retried.
+        :type reset_timeout: float
+        :param release_notifier: Optional callable that gets a notifier
+            back once the workers of its lane stopped (e.g.
+            NotificationLoader.pool.release).
+        :type release_notifier: callable
+        :param observer: Optional callable that gets the name of the
+            notifier and the duration of every call.
+        :type observer: callable
+        """
+        self._get_notifier = get_notifier
+        self._release_notifier = release_notifier
+        self.observer = observer
+        self.queue_size = queue_size
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._lanes = {}
+        self._stopped = False
+        # How often (in seconds) idle workers check if their lane retired
+        self.idle_interval = 1.0
+        # Statistics
+        self.dispatched = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.dropped = {'queue_full': 0, 'circuit_open': 0, 'expired': 0}
+
+    def queue_depth(self):
+        """
+        Gets the amount of messages that are waiting to be sent.
+
+        :return: The amount of queued messages over all notifiers.
+        :rtype: int
+        """
+        return sum(lane.queue.qsize() for lane in list(self._lanes.values()))
+
+    def dispatch(self, name, config, message):
+        """
+        Queues a message for the given notifier. Never blocks.
+
+        :param name: The name of the notification service.
+        :type name: str
+        :param config: The configuration of the notification service.
+        :type config: dict
+        :param message: The message to send out.
+        :type message: str
+        :return: True if the message was queued, False if it was dropped.
+        :rtype: bool
+        """
+        while True:
+            lane = self._get_lane(name, config)
+            if lane is None:
+                return False
+            if lane.breaker.is_open:
+                self._drop('circuit_open')
+                return False
+            with lane.lock:
+                # A lane that retired meanwhile is replaced by a new one
+                if lane.retired:
+                    continue
+                try:
+                    lane.queue.put_nowait((message, time.time()))
+                    return True
+                except queue.Full:
+                    pass
+            self._drop('queue_full')
+            return False
+
+    def retain(self, keys):
+        """
+        Retires the lanes of the notifiers that aren't in use anymore. Their
+        workers send the messages that are already queued, and then stop
+        and release their notifier.
+
+        :param keys: The (name, config) pairs in use, with the config
+            serialized as JSON with sorted keys.
+        :type keys: set[tuple]
+        :return: The amount of retired lanes.
+        :rtype: int
+        """
+        with self._lock:
+            retired = [self._lanes.pop(key) for key in list(self._lanes)
+                       if key not in keys]
+        for lane in retired:
+            lane.retire()
+        return len(retired)
+
+    def stop(self, timeout=5.0):
+        """
+        Stops the workers after they handled the messages that are already
+        queued.
+
+        :param timeout: Seconds to wait for each worker.
+        :type timeout: float
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            self._stopped = True
+            lanes = list(self._lanes.values())
+        for lane in lanes:
+            lane.retire()
+        for lane in lanes:
+            for worker in lane.workers:
+                worker.join(timeout)
+
+    def _get_lane(self, name, config):
+        key = (name, json.dumps(config, sort_keys=True))
+        lane = self._lanes.get(key, None)
+        if lane is not None:
+            return lane
+        with self._lock:
+            if self._stopped:
+                return None
+            lane = self._lanes.get(key, None)
+            if lane is None:
+                lane = _Lane(name, config, self.queue_size, CircuitBreaker(
+                    self.failure_threshold, self.reset_timeout))
+                lane.active = self.concurrency
+                for i in range(self.concurrency):
+                    worker = threading.Thread(
+                        name='notify_%s_%s' % (name, i),
+                        target=self._work, args=(lane,))
+                    worker.daemon = True
+                    worker.start()
+                    lane.workers.append(worker)
+                self._lanes[key] = lane
+        return lane
+
+    def _work(self, lane):
+        try:
+            while True:
+                try:
+                    task = lane.queue.get(True, self.idle_interval)
+                except queue.Empty:
+                    # Nothing can be queued anymore once the lane retired
+                    if lane.retired:
+                        return
+                    continue
+                if task is None:
+                    return
+                self._send(lane, *task)
+        finally:
+            with lane.notifier_lock:
+                lane.active -= 1
+                notifier = None
+                if lane.active == 0:
+                    notifier, lane.notifier = lane.notifier, None
+            if notifier is not None and self._release_notifier is not None:
+                self._release_notifier(notifier)
+
+    def _send(self, lane, message, queued):
+        if time.time() - queued > self.timeout:
+            self._drop('expired')
+            return
+        if not lane.breaker.allow():
+            self._drop('circuit_open')
+            return
+        start = time.time()
+        try:
+            with lane.notifier_lock:
+                if lane.notifier is None:
+                    lane.notifier = self._get_notifier(lane.name, lane.config)
+                notifier = lane.notifier
+            notifier.process(message)
+            succeeded = True
+        except Exception:
+            logger.exception('Notification through %s failed', lane.name)
+            succeeded = False
+        self._record(lane, succeeded, time.time() - start)
+
+    def _record(self, lane, succeeded, duration):
+        timed_out = succeeded and duration > self.timeout
+        if succeeded and not timed_out:
+            lane.breaker.success()
+        else:
+            lane.breaker.failure()
+        with self._lock:
+            self.dispatched += 1
+            if not succeeded:
+                self.failed += 1
+            if timed_out:
+                self.timed_out += 1
+        if self.observer is not None:
+            self.observer(lane.name, duration)
+
+    def _drop(self, reason):
+        with self._lock:
+            self.dropped[reason] += 1
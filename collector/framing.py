@@ -0,0 +1,101 @@
+import struct
+
+
+class FrameError(Exception):
+    """
+    Class for framing errors; the stream can't be recovered after one.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+class FrameDecoder(object):
+    """
+    Reassembles the messages of a stream connection. The framing is detected
+    per message:
+
+    - a JSON message (starting with '{') ends at a newline;
+    - anything else starts with a 4 byte, big endian, length prefix.
+    """
+
+    _length = struct.Struct('!I')
+
+    def __init__(self, max_frame_size=65536):
+        """
+        Creates a decoder with an empty reassembly buffer.
+
+        :param max_frame_size: The maximum size of a single message.
+        :type max_frame_size: int
+        """
+        self.max_frame_size = max_frame_size
+        self._buffer = b''
+        # Position up to where the buffer was searched for a newline
+        self._scanned = 0
+
+    def __len__(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        """
+        Adds received data to the buffer, and returns the messages that are
+        complete now.
+
+        :param data: The received data.
+        :type data: bytes
+        :return: The complete messages, in order.
+        :rtype: list[bytes]
+        :raise FrameError: If a message exceeds the maximum size.
+        """
+        self._buffer += data
+        frames = []
+        while len(self._buffer) > 0:
+            first = self._buffer[:1]
+            if first in (b'\r', b'\n'):
+                # Line ending of the previous message
+                self._buffer = self._buffer.lstrip(b'\r\n')
+            elif first == b'{':
+                end = self._buffer.find(b'\n', self._scanned)
+                if end < 0:
+                    if len(self._buffer) > self.max_frame_size:
+                        raise FrameError('Message exceeds %s bytes' %
+                                         self.max_frame_size)
+                    self._scanned = len(self._buffer)
+                    break
+                frame = self._buffer[:end].rstrip(b'\r')
+                if len(frame) > self.max_frame_size:
+                    # Complete, but still too large
+                    raise FrameError('Message of %s bytes exceeds %s bytes' %
+                                     (len(frame), self.max_frame_size))
+                frames.append(frame)
+                self._buffer = self._buffer[end + 1:]
+                self._scanned = 0
+            else:
+                if len(self._buffer) < self._length.size:
+                    break
+                length, = self._length.unpack(
+                    self._buffer[:self._length.size])
+                if length > self.max_frame_size:
+                    raise FrameError('Message of %s bytes exceeds %s bytes' %
+                                     (length, self.max_frame_size))
+                end = self._length.size + length
+                if len(self._buffer) < end:
+                    break
+                frames.append(self._buffer[self._length.size:end])
+                self._buffer = self._buffer[end:]
+        return frames
+
+    def flush(self):
+        """
+        Returns what's left in the buffer if it's an unterminated JSON
+        message, as sent by clients that use one connection per message.
+
+        :return: The last message, or None.
+        :rtype: bytes
+        """
+        remainder, self._buffer, self._scanned = self._buffer, b'', 0
+        if remainder[:1] == b'{':
+            return remainder
+        return None
@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = logging.getLogger(__name__)
+
+
+class IngestPipeline(object):
+    """
+    Bounded queue between the reactor and a pool of worker threads, which
+    do the actual processing (decryption, verification, storage) of the
+    received messages. Each worker uses its own database session. Messages
+    can be handed over in batches, which take a single queue slot; the
+    queue is bounded by the amount of messages, whatever the batch size.
+    """
+
+    def __init__(self, process, workers=4, queue_size=10000, db=None):
+        """
+        Creates a new (stopped) pipeline.
+
+        :param process: Callable that processes a single message.
+        :type process: callable
+        :param workers: The amount of worker threads. With 0 workers,
+            messages are processed right away in the calling thread.
+        :type workers: int
+        :param queue_size: The maximum amount of messages waiting for a
+            worker. Messages beyond this are dropped.
+        :type queue_size: int
+        :param db: The (thread-local) database session the workers use, so
+            it can be cleaned up when a worker stops.
+        :type db: sqlalchemy.orm.scoped_session
+        """
+        self._process = process
+        self.workers = workers
+        self.db = db
+        self.queue_size = queue_size
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        # Messages that were queued, but not handled yet
+        self._pending = 0
+        # Statistics
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def queue_depth(self):
+        """
+        Gets the amount of messages waiting for a worker.
+
+        :return: The amount of queued messages.
+        :rtype: int
+        """
+        return self._pending
+
+    def start(self):
+        """
+        Starts the worker threads.
+
+        :return: None
+        :rtype: None
+        """
+        for i in range(self.workers):
+            worker = threading.Thread(
+                name='ingest_%s' % i, target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+
+    def stop(self, timeout=10.0):
+        """
+        Stops the workers once they processed the queued messages. Messages
+        that are still queued after that (because the workers got stuck)
+        are processed in the calling thread, for at most the same timeout;
+        the rest is dropped.
+
+        :param timeout: Seconds to wait for each worker.
+        :type timeout: float
+        :return: None
+        :rtype: None
+        """
+        threads, self._threads = self._threads, []
+        for worker in threads:
+            self._queue.put(None)
+        for worker in threads:
+            worker.join(timeout)
+        leftover = []
+        while True:
+            try:
+                batch = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if batch is not None:
+                leftover.extend(batch)
+        # Workers that are still busy stop once they're done
+        for worker in threads:
+            if worker.is_alive():
+                self._queue.put(None)
+        if len(leftover) == 0:
+            return
+        logger.warning('Processing %s messages the workers left queued',
+                       len(leftover))
+        deadline = time.time() + timeout
+        for index, data in enumerate(leftover):
+            if time.time() > deadline:
+                discarded = len(leftover) - index
+                with self._lock:
+                    self._pending -= discarded
+                    self.dropped += discarded
+                logger.error('Discarding %s queued messages on shutdown',
+                             discarded)
+                return
+            self._handle(data)
+            with self._lock:
+                self._pending -= 1
+
+    def submit(self, data):
+        """
+        Hands a received message to the workers. Never blocks.
+
+        :param data: The received message.
+        :type data: any
+        :return: True if the message was accepted, False if it was dropped.
+        :rtype: bool
+        """
+        return self.submit_batch([data])
+
+    def submit_batch(self, batch):
+        """
+        Hands a batch of received messages to the workers, as a single
+        unit. Never blocks. If the queue can't hold all of them, the
+        messages that don't fit are dropped.
+
+        :param batch: The received messages.
+        :type batch: list
+        :return: True if the whole batch was accepted, False if (some of)
+            its messages were dropped.
+        :rtype: bool
+        """
+        self.received += len(batch)
+        if len(self._threads) == 0:
+            for data in batch:
+                self._handle(data)
+            return True
+        with self._lock:
+            accepted = max(0, min(len(batch),
+                                  self.queue_size - self._pending))
+            self._pending += accepted
+            self.dropped += len(batch) - accepted
+        if accepted > 0:
+            self._queue.put(batch[:accepted])
+        return accepted == len(batch)
+
+    def _work(self):
+        try:
+            while True:
+                batch = self._queue.get()
+                if batch is None:
+                    return
+                for data in batch:
+                    self._handle(data)
+                    with self._lock:
+                        self._pending -= 1
+        finally:
+            if self.db is not None:
+                self.db.remove()
+
+    def _handle(self, data):
+        try:
+            self._process(data)
+            succeeded = True
+        except Exception:
+            logger.exception('Could not process message')
+            succeeded = False
+            if self.db is not None:
+                # A failed transaction (e.g. after a lost connection) would
+                # make every later query of this thread fail as well
+                self.db.rollback()
+        with self._lock:
+            if succeeded:
+                self.processed += 1
+            else:
+                self.errors += 1
@@ -0,0 +1,300 @@
+import threading
+import time
+
+from twisted.web import resource
+
+# Default histogram buckets (in seconds), from 0.1 ms up to 10 seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+                   5.0, 10.0)
+
+
+def _format_value(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, int):
+        return '%d' % value
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+
+
+class _Metric(object):
+    """
+    Base for a metric that may have labels. Every combination of label
+    values gets its own child, which holds the actual value(s).
+    """
+
+    metric_type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def labels(self, *values):
+        """
+        Gets the child of the metric for the given label values.
+
+        :param values: The label values, in the order of the label names.
+        :type values: str
+        :return: The child of the metric.
+        :rtype: _Metric
+        """
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self.label_names):
+            raise ValueError('%s expects %s labels' %
+                             (self.name, len(self.label_names)))
+        child = self._children.get(values, None)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values, None)
+                if child is None:
+                    child = self._create_child()
+                    self._children[values] = child
+        return child
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.metric_type)]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _create_child(self):
+        raise NotImplementedError()
+
+    def _render_child(self, values, child):
+        raise NotImplementedError()
+
+
+class _CounterChild(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """
+    A value that only goes up.
+    """
+
+    metric_type = 'counter'
+
+    def inc(self, amount=1):
+        """
+        Increments an unlabeled counter.
+
+        :param amount: The amount to add.
+        :type amount: int
+        :return: None
+        :rtype: None
+        """
+        self.labels().inc(amount)
+
+    def _create_child(self):
+        return _CounterChild()
+
+    def _render_child(self, values, child):
+        return ['%s%s %s' % (self.name, _format_labels(
+            self.label_names, values), _format_value(child.value))]
+
+
+class _HistogramChild(object):
+
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    def time(self, start):
+        """
+        Observes the time that passed since the given start.
+
+        :param start: The start time, as returned by time.time().
+        :type start: float
+        :return: The current time, so it can be used as the next start.
+        :rtype: float
+        """
+        now = time.time()
+        self.observe(now - start)
+        return now
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values (typically durations) over buckets.
+    """
+
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, documentation, label_names)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+
+    def observe(self, value):
+        """
+        Records a value in an unlabeled histogram.
+
+        :param value: The value to record.
+        :type value: float
+        :return: None
+        :rtype: None
+        """
+        self.labels().observe(value)
+
+    def _create_child(self):
+        return _HistogramChild(self.buckets + (float('inf'),))
+
+    def _render_child(self, values, child):
+        with child._lock:
+            counts, total, count = list(child.counts), child.sum, child.count
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(child.buckets, counts):
+            cumulative += bucket_count
+            lines.append('%s_bucket%s %s' % (self.name, _format_labels(
+                self.label_names, values, ('le', _format_value(bound))),
+                cumulative))
+        labels = _format_labels(self.label_names, values)
+        lines.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+        lines.append('%s_count%s %s' % (self.name, labels, count))
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """
+    Metric whose values are read from a callback at render time, to expose
+    statistics that are already kept elsewhere.
+    """
+
+    def __init__(self, name, documentation, metric_type, callback,
+                 label_names=()):
+        """
+        Creates the metric.
+
+        :param metric_type: 'counter' or 'gauge'.
+        :type metric_type: str
+        :param callback: Function that returns the value, or for labeled
+            metrics a dictionary with a value for each tuple of label values.
+        :type callback: callable
+        """
+        _Metric.__init__(self, name, documentation, label_names)
+        self.metric_type = metric_type
+        self._callback = callback
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.metric_type)]
+        values = self._callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            if not isinstance(labels, tuple):
+                labels = (labels,)
+            lines.append('%s%s %s' % (self.name, _format_labels(
+                self.label_names, labels), _format_value(value)))
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    Holds the metrics of a process, and renders them in the Prometheus text
+    exposition format.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = []
+
+    def register(self, metric):
+        """
+        Adds a metric to the registry.
+
+        :param metric: The metric to add.
+        :type metric: _Metric
+        :return: The added metric.
+        :rtype: _Metric
+        """
+        with self._lock:
+            if metric.name in [m.name for m in self._metrics]:
+                raise ValueError('Duplicate metric: %s' % metric.name)
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+        return self.register(Counter(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self.register(
+            Histogram(name, documentation, label_names, buckets))
+
+    def callback(self, name, documentation, metric_type, callback,
+                 label_names=()):
+        return self.register(CallbackMetric(
+            name, documentation, metric_type, callback, label_names))
+
+    def render(self):
+        """
+        Renders all metrics.
+
+        :return: The metrics in the Prometheus text format.
+        :rtype: str
+        """
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsResource(resource.Resource):
+    """
+    Twisted web resource that serves the metrics of a registry.
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader(b'Content-Type',
+                          b'text/plain; version=0.0.4; charset=utf-8')
+        return self.registry.render().encode('utf-8')
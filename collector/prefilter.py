@@ -0,0 +1,161 @@
+import collections
+import logging
+import re
+import threading
+import time
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from collector import wire
+from collector.ratelimit import TokenBucket
+from mod_honeypot.models import Deployment
+
+logger = logging.getLogger(__name__)
+
+# Finds the instance key of a JSON message without parsing it
+_json_instance = re.compile(br'"instance"\s*:\s*"([^"\\]{1,255})"')
+
+
+class KnownInstances(object):
+    """
+    In-memory set of the instance keys of all deployments, so messages can
+    be checked against it without touching the database.
+    """
+
+    def __init__(self, db):
+        """
+        Creates an empty set; it's filled by the first reload.
+
+        :param db: The database session to load the keys with.
+        :type db: sqlalchemy.orm.scoped_session
+        """
+        self.db = db
+        self._keys = None
+
+    @property
+    def loaded(self):
+        return self._keys is not None
+
+    def __contains__(self, instance_key):
+        keys = self._keys
+        return keys is not None and instance_key in keys
+
+    def reload(self):
+        """
+        Loads the instance keys of all deployments.
+
+        :return: None
+        :rtype: None
+        """
+        try:
+            keys = frozenset(
+                key for key, in self.db.query(Deployment.instance_key))
+            self.db.rollback()
+        except SQLAlchemyError as e:
+            self.db.rollback()
+            logger.error('Could not load the instance keys: %s', e)
+            return
+        self._keys = keys
+
+
+class PreFilter(object):
+    """
+    Cheap checks on received messages, done before they're queued for
+    decryption: whether they name an instance key, and whether it's known
+    (the sizes are limited by the listeners already). Messages with an
+    unknown key are let through to the regular processing (which looks them
+    up in the database, in case a deployment was just added) at a limited
+    rate per source address, and at a limited rate overall, as source
+    addresses are easily spoofed.
+    """
+
+    def __init__(self, known, unknown_rate=1.0, unknown_burst=5,
+                 total_rate=10.0, total_burst=20, max_sources=10000,
+                 clock=time.time):
+        """
+        Creates the filter.
+
+        :param known: The known instance keys.
+        :type known: KnownInstances
+        :param unknown_rate: The amount of messages per second with an
+            unknown instance key that a single address may send.
+        :type unknown_rate: float
+        :param unknown_burst: The burst allowed over that rate.
+        :type unknown_burst: int
+        :param total_rate: The amount of messages per second with an
+            unknown instance key that all addresses together may send.
+        :type total_rate: float
+        :param total_burst: The burst allowed over that rate.
+        :type total_burst: int
+        :param max_sources: The maximum amount of addresses to keep a rate
+            limit for; the least recently seen ones are forgotten first.
+        :type max_sources: int
+        :param clock: Function that returns the current time in seconds.
+        :type clock: callable
+        """
+        self.known = known
+        self.unknown_rate = unknown_rate
+        self.unknown_burst = unknown_burst
+        self.max_sources = max_sources
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._sources = collections.OrderedDict()
+        self._total = TokenBucket(total_rate, total_burst, clock)
+
+    @staticmethod
+    def get_instance(data):
+        """
+        Extracts the instance key of a message, without decrypting or fully
+        parsing it.
+
+        :param data: The received message.
+        :type data: bytes
+        :return: The instance key, or None if it can't be found.
+        :rtype: str
+        """
+        if wire.is_envelope(data):
+            try:
+                return wire.decode_envelope(data).instance
+            except wire.WireError:
+                return None
+        match = _json_instance.search(data)
+        if match is None:
+            return None
+        return match.group(1).decode('utf-8', 'replace')
+
+    def check(self, data, source=None):
+        """
+        Checks a received message.
+
+        :param data: The received message.
+        :type data: bytes
+        :param source: The address the message came from.
+        :type source: str
+        :return: The reason to drop the message, or None to process it.
+        :rtype: str
+        """
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        instance = self.get_instance(data)
+        if instance is None:
+            return 'malformed'
+        if instance in self.known or not self.known.loaded:
+            return None
+        if self._allow_unknown(source):
+            return None
+        return 'unknown_instance'
+
+    def _allow_unknown(self, source):
+        with self._lock:
+            bucket = self._sources.pop(source, None)
+            if bucket is None:
+                bucket = TokenBucket(
+                    self.unknown_rate, self.unknown_burst, self._clock)
+                if len(self._sources) >= self.max_sources:
+                    self._sources.popitem(last=False)
+            self._sources[source] = bucket
+            if bucket.pressure() > 0 or self._total.pressure() > 0:
+                return False
+            bucket.take()
+            self._total.take()
+            return True
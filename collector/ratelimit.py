@@ -0,0 +1,145 @@
+import math
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Token bucket that may go into debt (up to its burst size), so that it
+    also tells how far over its rate the traffic is.
+    """
+
+    def __init__(self, rate, burst, clock=time.time):
+        """
+        Creates a full bucket.
+
+        :param rate: The amount of tokens added per second.
+        :type rate: float
+        :param burst: The capacity of the bucket, which is also the maximum
+            debt.
+        :type burst: float
+        :param clock: Function that returns the current time in seconds.
+        :type clock: callable
+        """
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+
+    def pressure(self):
+        """
+        Gets how overloaded the bucket is.
+
+        :return: 0 as long as there are tokens left, rising to 1 when the
+            debt reaches the burst size.
+        :rtype: float
+        """
+        self._refill()
+        if self._tokens >= 0:
+            return 0.0
+        return -self._tokens / self.burst
+
+    def take(self, amount=1.0):
+        """
+        Takes tokens from the bucket, going into debt if necessary.
+
+        :param amount: The amount of tokens to take.
+        :type amount: float
+        :return: The amount of tokens left (negative when in debt).
+        :rtype: float
+        """
+        self._refill()
+        self._tokens = max(-self.burst, self._tokens - amount)
+        return self._tokens
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+
+class LoadShedder(object):
+    """
+    Limits the amount of entries each deployment (instance key) can have
+    processed per second. Entries over the limit aren't refused outright:
+    the longer the overload lasts, the more of the lowest notification
+    levels of a service get shed. The highest level is never shed.
+    """
+
+    def __init__(self, rate, burst, clock=time.time):
+        """
+        Creates a new load shedder.
+
+        :param rate: The sustained amount of entries per second that a
+            single deployment may send.
+        :type rate: float
+        :param burst: The amount of entries a deployment may send over the
+            rate before entries get shed.
+        :type burst: float
+        :param clock: Function that returns the current time in seconds.
+        :type clock: callable
+        """
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._shed = {}
+
+    def admit(self, instance_key, level, levels):
+        """
+        Checks if an entry of a deployment should be processed, and counts
+        it against the deployment's limit.
+
+        :param instance_key: The instance key of the deployment.
+        :type instance_key: str
+        :param level: The notification level of the entry, or None for
+            entries that must always be kept.
+        :type level: int
+        :param levels: The notification levels of the service.
+        :type levels: list[int]
+        :return: True if the entry should be processed, False if it's shed.
+        :rtype: bool
+        """
+        with self._lock:
+            bucket = self._buckets.get(instance_key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst, self._clock)
+                self._buckets[instance_key] = bucket
+            pressure = bucket.pressure()
+            bucket.take()
+            if level is None or pressure == 0 or len(levels) < 2:
+                return True
+            if level >= self.get_floor(pressure, levels):
+                return True
+            self._shed[instance_key] = self._shed.get(instance_key, 0) + 1
+            return False
+
+    @staticmethod
+    def get_floor(pressure, levels):
+        """
+        Determines the lowest level that is kept at a given pressure.
+
+        :param pressure: The overload pressure, between 0 and 1.
+        :type pressure: float
+        :param levels: The notification levels of the service.
+        :type levels: list[int]
+        :return: The lowest notification level that is kept.
+        :rtype: int
+        """
+        levels = sorted(levels)
+        shed = int(math.ceil(pressure * (len(levels) - 1)))
+        return levels[min(shed, len(levels) - 1)]
+
+    def get_shed_counts(self):
+        """
+        Gets the amount of shed entries per deployment.
+
+        :return: A dictionary with the amount of shed entries for each
+            instance key.
+        :rtype: dict[str,int]
+        """
+        with self._lock:
+            return dict(self._shed)
@@ -0,0 +1,221 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import threading
+
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+
+from mod_config.models import Service
+from mod_honeypot.models import PiPotReport
+from pipot.services import ServiceLoader
+
+logger = logging.getLogger(__name__)
+
+
+def get_report_models(db):
+    """
+    Gets the report models, with the name of the service they belong to,
+    as declared by the get_used_table_names of each service. Services that
+    can't be loaded are skipped.
+
+    :param db: The database session to look up the services with.
+    :type db: sqlalchemy.orm.scoped_session
+    :return: The (service name, model) pairs, starting with the reports of
+        the honeypots themselves ('PiPot').
+    :rtype: list[tuple]
+    """
+    models = [('PiPot', PiPotReport)]
+    names = [name for name, in db.query(Service.name)]
+    db.rollback()
+    for name in names:
+        try:
+            service = ServiceLoader.registry.get_instance(name, None, None)
+        except ServiceLoader.ServiceLoaderException as e:
+            logger.warning('Could not load the models of service %s: %s',
+                           name, e.value)
+            continue
+        tables = service.get_used_table_names()
+        models.extend((name, tables[table]) for table in sorted(tables))
+    return models
+
+
+class ReportPruner(object):
+    """
+    Removes report rows that are older than the retention period of their
+    service, in small chunks (each its own short transaction), so the
+    tables are never locked for long. Removed rows can be archived to
+    gzipped JSON files first.
+    """
+
+    def __init__(self, db, retention_days, service_retention=None,
+                 chunk_size=1000, archive_dir=None):
+        """
+        Creates a new pruner.
+
+        :param db: The database session to prune with.
+        :type db: sqlalchemy.orm.scoped_session
+        :param retention_days: The amount of days to keep reports for; 0
+            keeps them forever.
+        :type retention_days: int
+        :param service_retention: The amount of days per service (by name;
+            'PiPot' for the reports of the honeypots themselves), overriding
+            the default.
+        :type service_retention: dict[str,int]
+        :param chunk_size: The amount of rows to remove per transaction.
+        :type chunk_size: int
+        :param archive_dir: Directory to archive the removed rows in; None
+            doesn't archive them.
+        :type archive_dir: str
+        """
+        self.db = db
+        self.retention_days = retention_days
+        self.service_retention = service_retention or {}
+        self.chunk_size = chunk_size
+        self.archive_dir = archive_dir
+        self._stopped = threading.Event()
+        # Statistics
+        self.pruned = 0
+
+    @staticmethod
+    def from_config(db, config):
+        """
+        Creates a pruner from the REPORT_RETENTION* settings.
+
+        :param db: The database session to prune with.
+        :type db: sqlalchemy.orm.scoped_session
+        :param config: The configuration.
+        :type config: dict
+        :return: The pruner, or None if no retention is configured.
+        :rtype: ReportPruner
+        """
+        days = config.get('REPORT_RETENTION_DAYS', 0)
+        per_service = config.get('REPORT_RETENTION', {})
+        if days <= 0 and len(per_service) == 0:
+            return None
+        return ReportPruner(
+            db, days, per_service,
+            config.get('REPORT_PRUNE_CHUNK_SIZE', 1000),
+            config.get('REPORT_ARCHIVE_DIR', None)
+        )
+
+    def stop(self):
+        """
+        Makes a running prune stop after its current chunk.
+
+        :return: None
+        :rtype: None
+        """
+        self._stopped.set()
+
+    def get_retention(self, service):
+        """
+        Gets the retention period of a service.
+
+        :param service: The name of the service.
+        :type service: str
+        :return: The amount of days to keep its reports; 0 keeps them
+            forever.
+        :rtype: int
+        """
+        return self.service_retention.get(service, self.retention_days)
+
+    def run(self):
+        """
+        Prunes the reports of all services. Meant to be called periodically,
+        outside the reactor thread.
+
+        :return: The amount of removed rows.
+        :rtype: int
+        """
+        self._stopped.clear()
+        total = 0
+        try:
+            models = get_report_models(self.db)
+        except SQLAlchemyError as e:
+            self.db.rollback()
+            logger.error('Could not determine the report tables: %s', e)
+            return 0
+        now = datetime.datetime.utcnow()
+        for service, model in models:
+            days = self.get_retention(service)
+            if days <= 0 or self._stopped.is_set():
+                continue
+            try:
+                total += self.prune(model.__table__,
+                                    now - datetime.timedelta(days=days))
+            except SQLAlchemyError as e:
+                self.db.rollback()
+                logger.error('Pruning %s failed: %s',
+                             model.__tablename__, e)
+        return total
+
+    def prune(self, table, cutoff):
+        """
+        Removes the rows of a table from before the cutoff, a chunk at a
+        time.
+
+        :param table: The report table.
+        :type table: sqlalchemy.Table
+        :param cutoff: The time before which rows are removed.
+        :type cutoff: datetime.datetime
+        :return: The amount of removed rows.
+        :rtype: int
+        """
+        removed = 0
+        while not self._stopped.is_set():
+            # Only the ids are needed, unless the rows are archived
+            columns = [table] if self.archive_dir is not None \
+                else [table.c.id]
+            rows = self.db.execute(
+                select(columns).where(table.c.timestamp < cutoff).order_by(
+                    table.c.id).limit(self.chunk_size)).fetchall()
+            if len(rows) == 0:
+                self.db.rollback()
+                break
+            if self.archive_dir is not None:
+                self._archive(table, rows)
+            self.db.execute(table.delete().where(
+                table.c.id.in_([row['id'] for row in rows])))
+            self.db.commit()
+            removed += len(rows)
+            self.pruned += len(rows)
+            if len(rows) < self.chunk_size:
+                break
+        if removed > 0:
+            logger.info('Pruned %s rows from %s', removed, table.name)
+        return removed
+
+    def _archive(self, table, rows):
+        """
+        Appends rows to the archive of their table, one file per day.
+
+        :param table: The report table.
+        :type table: sqlalchemy.Table
+        :param rows: The rows to archive.
+        :type rows: list
+        :return: None
+        :rtype: None
+        """
+        if not os.path.isdir(self.archive_dir):
+            os.makedirs(self.archive_dir)
+        files = {}
+        try:
+            for row in rows:
+                day = row['timestamp'].strftime('%Y-%m-%d') \
+                    if row['timestamp'] is not None else 'unknown'
+                archive = files.get(day, None)
+                if archive is None:
+                    # Appending adds a gzip member, which readers handle
+                    archive = gzip.open(os.path.join(
+                        self.archive_dir, '%s-%s.jsonl.gz' % (
+                            table.name, day)), 'ab')
+                    files[day] = archive
+                archive.write((json.dumps(
+                    dict(row.items()), sort_keys=True, default=str) +
+                    '\n').encode('utf-8'))
+        finally:
+            for archive in files.values():
+                archive.close()
@@ -0,0 +1,224 @@
+import collections
+import logging
+
+from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
+
+from mod_report.models import ReportRollup
+from pipot.services import ServiceLoader
+
+logger = logging.getLogger(__name__)
+
+# The notification level that the reports of the honeypot itself count as
+PIPOT_LEVEL = 0
+
+
+def get_hour(timestamp):
+    """
+    Gets the hour a timestamp falls in.
+
+    :param timestamp: The timestamp.
+    :type timestamp: datetime.datetime
+    :return: The start of the hour.
+    :rtype: datetime.datetime
+    """
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+def get_cell(deployment_id, service, timestamp, level):
+    """
+    Gets the rollup cell that a stored report counts in.
+
+    :param deployment_id: The id of the deployment.
+    :type deployment_id: int
+    :param service: The name of the service ('PiPot' for the honeypot).
+    :type service: str
+    :param timestamp: The timestamp of the report.
+    :type timestamp: datetime.datetime
+    :param level: The notification level of the report.
+    :type level: int
+    :return: The (deployment id, service, hour, level) of the cell.
+    :rtype: tuple
+    """
+    return deployment_id, service, get_hour(timestamp), level
+
+
+def count(counts, deployment_id, service, timestamp, level, amount=1):
+    """
+    Adds stored reports to a set of rollup counts.
+
+    :param counts: The counts, per (deployment id, service, hour, level).
+    :type counts: dict[tuple,int]
+    :param deployment_id: The id of the deployment.
+    :type deployment_id: int
+    :param service: The name of the service ('PiPot' for the honeypot).
+    :type service: str
+    :param timestamp: The timestamp of the reports.
+    :type timestamp: datetime.datetime
+    :param level: The notification level of the reports.
+    :type level: int
+    :param amount: The amount of reports.
+    :type amount: int
+    :return: None
+    :rtype: None
+    """
+    key = get_cell(deployment_id, service, timestamp, level)
+    counts[key] = counts.get(key, 0) + amount
+
+
+def merge(counts, other):
+    """
+    Adds a set of rollup counts to another one.
+
+    :param counts: The counts to add to.
+    :type counts: dict[tuple,int]
+    :param other: The counts to add.
+    :type other: dict[tuple,int]
+    :return: None
+    :rtype: None
+    """
+    for key, amount in other.items():
+        counts[key] = counts.get(key, 0) + amount
+
+
+def write_counts(db, counts):
+    """
+    Adds counts to the rollup table, without committing. MySQL gets a
+    single upsert for all cells; other databases get an update per cell,
+    and an insert for the cells that don't exist yet. If another flush
+    inserted such a cell meanwhile, the insert is retried as an update.
+
+    :param db: The database session.
+    :type db: sqlalchemy.orm.scoped_session
+    :param counts: The counts, per (deployment id, service, hour, level).
+    :type counts: dict[tuple,int]
+    :return: None
+    :rtype: None
+    """
+    if len(counts) == 0:
+        return
+    table = ReportRollup.__table__
+    # A fixed order keeps concurrent writers from deadlocking
+    cells = [{'deployment_id': key[0], 'service': key[1], 'hour': key[2],
+              'level': key[3], 'count': amount}
+             for key, amount in sorted(counts.items())]
+    if db.get_bind().dialect.name == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        statement = insert(table).values(cells)
+        db.execute(statement.on_duplicate_key_update(
+            count=table.c.count + statement.inserted.count))
+        return
+    for cell in cells:
+        if _update_cell(db, table, cell):
+            continue
+        try:
+            # A savepoint keeps the transaction usable if the insert fails
+            with db.begin_nested():
+                db.execute(table.insert().values(**cell))
+        except IntegrityError:
+            if not _update_cell(db, table, cell):
+                raise
+
+
+def _update_cell(db, table, cell):
+    """
+    Adds a count to an existing cell of the rollup table.
+
+    :param db: The database session.
+    :type db: sqlalchemy.orm.scoped_session
+    :param table: The rollup table.
+    :type table: sqlalchemy.Table
+    :param cell: The key columns of the cell, and the count to add.
+    :type cell: dict
+    :return: True if the cell exists.
+    :rtype: bool
+    """
+    result = db.execute(table.update().where(and_(
+        table.c.deployment_id == cell['deployment_id'],
+        table.c.service == cell['service'],
+        table.c.hour == cell['hour'],
+        table.c.level == cell['level']
+    )).values(count=table.c.count + cell['count']))
+    return result.rowcount > 0
+
+
+def backfill(db, models, chunk_size=1000):
+    """
+    Recomputes the rollup counts of the given report tables from the
+    stored reports, replacing the existing counts of their services. The
+    collector should be stopped meanwhile, or the reports it stores during
+    the backfill may be counted twice.
+
+    :param db: The database session.
+    :type db: sqlalchemy.orm.scoped_session
+    :param models: The (service name, model) pairs to count; all models of
+        a service should be given, as its counts are replaced as a whole.
+    :type models: list[tuple]
+    :param chunk_size: The amount of reports to read at once.
+    :type chunk_size: int
+    :return: The amount of counted reports, per service.
+    :rtype: dict[str,int]
+    """
+    services = collections.OrderedDict()
+    for name, model in models:
+        services.setdefault(name, []).append(model)
+    totals = {}
+    for name, service_models in services.items():
+        service = None
+        if name != 'PiPot':
+            # Only the service knows the notification level of a report
+            service = ServiceLoader.registry.get_instance(name, None, None)
+        counts = {}
+        total = 0
+        for model in service_models:
+            total += _count_reports(db, name, model, service, counts,
+                                    chunk_size)
+        db.query(ReportRollup).filter(ReportRollup.service == name).delete(
+            synchronize_session=False)
+        write_counts(db, counts)
+        db.commit()
+        totals[name] = total
+        logger.info('Counted %s reports of %s in %s cells', total, name,
+                    len(counts))
+    return totals
+
+
+def _count_reports(db, name, model, service, counts, chunk_size):
+    """
+    Counts the stored reports of a single report table.
+
+    :param db: The database session.
+    :type db: sqlalchemy.orm.scoped_session
+    :param name: The name of the service.
+    :type name: str
+    :param model: The model of the report table.
+    :type model: class
+    :param service: An instance of the service, or None for the reports of
+        the honeypot itself.
+    :type service: pipot.services.IService.IService
+    :param counts: The counts to add the reports to.
+    :type counts: dict[tuple,int]
+    :param chunk_size: The amount of reports to read at once.
+    :type chunk_size: int
+    :return: The amount of counted reports.
+    :rtype: int
+    """
+    total = 0
+    last = 0
+    while True:
+        rows = db.query(model).filter(model.id > last).order_by(
+            model.id).limit(chunk_size).all()
+        if len(rows) == 0:
+            break
+        if service is None:
+            levels = [PIPOT_LEVEL] * len(rows)
+        else:
+            levels = service.get_notification_levels_for(rows)
+        for row, level in zip(rows, levels):
+            if row.timestamp is not None:
+                count(counts, row.deployment_id, name, row.timestamp, level)
+                total += 1
+        last = rows[-1].id
+        # Keep the session from holding on to all the reports
+        db.expunge_all()
+    return total
@@ -0,0 +1,160 @@
+import collections
+import json
+import threading
+
+from sqlalchemy.orm import joinedload
+
+from mod_config.models import Rule, Actions
+
+# Outcome of the rules for a notification level: a tuple of (notification
+# name, notification config) pairs to notify, and whether to drop the entry.
+Decision = collections.namedtuple('Decision', ['notifications', 'drop'])
+
+
+class CompiledRules(object):
+    """
+    Decision table for the rules of a single service, precomputed for every
+    notification level the service declares.
+    """
+
+    def __init__(self, rules, levels):
+        """
+        Compiles the given rules.
+
+        :param rules: The rules of the service, ordered by level, as
+            (condition, level, notification name, notification config, drop)
+            tuples.
+        :type rules: list[tuple]
+        :param levels: The notification levels of the service.
+        :type levels: list[int]
+        """
+        self._rules = rules
+        self._table = dict((level, self._decide(level)) for level in levels)
+
+    def evaluate(self, level):
+        """
+        Looks up the decision for the given level. Levels that the service
+        didn't declare are decided (and remembered) on first use.
+
+        :param level: The notification level of an entry.
+        :type level: int
+        :return: The decision for this level.
+        :rtype: Decision
+        """
+        decision = self._table.get(level, None)
+        if decision is None:
+            decision = self._decide(level)
+            self._table[level] = decision
+        return decision
+
+    def _decide(self, level):
+        notifications = []
+        for condition, rule_level, name, config, drop in self._rules:
+            if not condition.compare(level, rule_level):
+                continue
+            if name is not None:
+                notifications.append((name, config))
+            if drop:
+                return Decision(tuple(notifications), True)
+        return Decision(tuple(notifications), False)
+
+
+class RuleEngine(object):
+    """
+    Keeps the compiled rules of all services, so that evaluating the rules
+    for an entry doesn't require any database access.
+    """
+
+    def __init__(self, db):
+        """
+        Creates a new rule engine. Rules are loaded on first use.
+
+        :param db: The database session to load the rules with.
+        :type db: sqlalchemy.orm.scoped_session
+        """
+        self.db = db
+        self._lock = threading.Lock()
+        self._rules = None
+        self._compiled = {}
+
+    def evaluate(self, service_id, service, level):
+        """
+        Evaluates the rules of a service for a given notification level.
+
+        :param service_id: The id of the service.
+        :type service_id: int
+        :param service: An instance of the service, used to determine the
+            notification levels when the rules need to be compiled.
+        :type service: pipot.services.IService.IService
+        :param level: The notification level of the entry.
+        :type level: int
+        :return: The decision for this level.
+        :rtype: Decision
+        """
+        compiled = self._compiled.get(service_id, None)
+        if compiled is None:
+            compiled = self._compile(service_id, service)
+        return compiled.evaluate(level)
+
+    def invalidate(self):
+        """
+        Drops all compiled rules, so they are rebuilt on next use.
+
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            self._rules = None
+            self._compiled = {}
+
+    def get_notifiers(self):
+        """
+        Gets the notifiers that the rules use, loading the rules if needed.
+
+        :return: The (name, config) pairs, with the config serialized as
+            JSON with sorted keys.
+        :rtype: set[tuple]
+        """
+        with self._lock:
+            if self._rules is None:
+                self._rules = self._load()
+            return set(
+                (name, json.dumps(config, sort_keys=True))
+                for rules in self._rules.values()
+                for condition, level, name, config, drop in rules
+                if name is not None)
+
+    def _compile(self, service_id, service):
+        with self._lock:
+            if self._rules is None:
+                self._rules = self._load()
+            compiled = CompiledRules(self._rules.get(service_id, []),
+                                     service.get_notification_levels())
+            self._compiled[service_id] = compiled
+        return compiled
+
+    def _load(self):
+        """
+        Loads all rules with a single query, grouped per service.
+
+        :return: A dictionary with the rule tuples for each service id.
+        :rtype: dict[int,list[tuple]]
+        """
+        rules = {}
+        query = self.db.query(Rule).options(
+            joinedload(Rule.notification)).order_by(
+            Rule.service_id, Rule.level.asc(), Rule.id)
+        try:
+            for rule in query:
+                name = None
+                if rule.notification is not None:
+                    name = rule.notification.name
+                rules.setdefault(rule.service_id, []).append((
+                    rule.condition, rule.level, name,
+                    rule.get_notification_config(),
+                    rule.action == Actions.drop
+                ))
+        finally:
+            # Also after an error, so the session remains usable
+            self.db.rollback()
+        return rules
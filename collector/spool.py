@@ -0,0 +1,368 @@
+import logging
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from sqlalchemy.exc import SQLAlchemyError
+
+logger = logging.getLogger(__name__)
+
+
+class Spool(object):
+    """
+    Append-only message log on disk, split over numbered segment files.
+    Every record is stored as a 4 byte length and a 4 byte CRC32, followed
+    by the payload. A checkpoint file holds the position up to where the
+    records were consumed; fully consumed segments are removed.
+    """
+
+    _header = struct.Struct('!II')
+    _segment_name = re.compile(r'^spool-(\d{10})\.log$')
+    _checkpoint_name = 'checkpoint'
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 sync_records=1000, sync_interval=0.1):
+        """
+        Opens (or creates) the spool in the given directory, and cuts off
+        any incomplete record a crash left at the end of it.
+
+        :param directory: The directory to keep the segments in.
+        :type directory: str
+        :param segment_size: The size (in bytes) after which a new segment
+            is started.
+        :type segment_size: int
+        :param sync_records: The amount of appended records after which
+            the segment is fsynced.
+        :type sync_records: int
+        :param sync_interval: The maximum time (in seconds) an appended
+            record may stay unsynced.
+        :type sync_interval: float
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync_records = sync_records
+        self.sync_interval = sync_interval
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        self._last_sync = time.time()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.checkpoint = self._read_checkpoint()
+        segments = self._list_segments()
+        if len(segments) == 0:
+            segments = [self.checkpoint[0]]
+        self._segment = segments[-1]
+        self._size = self._recover(self._segment)
+        self._file = open(self._get_path(self._segment), 'ab')
+
+    def _get_path(self, segment):
+        return os.path.join(self.directory, 'spool-%010d.log' % segment)
+
+    def _list_segments(self):
+        segments = []
+        for name in os.listdir(self.directory):
+            match = self._segment_name.match(name)
+            if match is not None:
+                segments.append(int(match.group(1)))
+        return sorted(segments)
+
+    def _read_checkpoint(self):
+        try:
+            with open(os.path.join(
+                    self.directory, self._checkpoint_name)) as f:
+                segment, offset = f.read().split()
+            return int(segment), int(offset)
+        except (IOError, OSError, ValueError):
+            return 0, 0
+
+    def _recover(self, segment):
+        """
+        Truncates the given segment after its last complete record.
+
+        :param segment: The number of the segment.
+        :type segment: int
+        :return: The size of the segment.
+        :rtype: int
+        """
+        path = self._get_path(segment)
+        if not os.path.exists(path):
+            return 0
+        offset = 0
+        with open(path, 'rb') as f:
+            while True:
+                record = self._read_record(f)
+                if record is None:
+                    break
+                offset = f.tell()
+        if offset != os.path.getsize(path):
+            logger.warning('Truncating spool segment %s at %s bytes',
+                           path, offset)
+            with open(path, 'r+b') as f:
+                f.truncate(offset)
+        return offset
+
+    def _read_record(self, f):
+        header = f.read(self._header.size)
+        if len(header) < self._header.size:
+            return None
+        length, checksum = self._header.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or \
+                zlib.crc32(payload) & 0xffffffff != checksum:
+            return None
+        return payload
+
+    def append(self, payload):
+        """
+        Appends a record. It's visible to readers right away, and on disk
+        once the next (batched) fsync happened.
+
+        :param payload: The record to append.
+        :type payload: bytes
+        :return: None
+        :rtype: None
+        """
+        record = self._header.pack(
+            len(payload), zlib.crc32(payload) & 0xffffffff) + payload
+        with self._lock:
+            self._file.write(record)
+            self._file.flush()
+            self._size += len(record)
+            self._unsynced += 1
+            if self._unsynced >= self.sync_records or \
+                    time.time() - self._last_sync >= self.sync_interval:
+                self._sync()
+            if self._size >= self.segment_size:
+                self._rotate()
+
+    def sync(self, force=False):
+        """
+        Fsyncs the current segment if the sync interval passed.
+
+        :param force: Sync regardless of the interval.
+        :type force: bool
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            if self._unsynced > 0 and (force or time.time() -
+                                       self._last_sync >= self.sync_interval):
+                self._sync()
+
+    def _sync(self):
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def _rotate(self):
+        self._sync()
+        self._file.close()
+        self._segment += 1
+        self._size = 0
+        self._file = open(self._get_path(self._segment), 'ab')
+
+    def read(self, position, limit=500):
+        """
+        Reads the records after a given position.
+
+        :param position: The (segment, offset) to start at.
+        :type position: tuple
+        :param limit: The maximum amount of records to read.
+        :type limit: int
+        :return: The records, each with the position after it.
+        :rtype: list[tuple]
+        """
+        records = []
+        segment, offset = position
+        while len(records) < limit:
+            with self._lock:
+                current = self._segment
+            path = self._get_path(segment)
+            if os.path.exists(path):
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    while len(records) < limit:
+                        payload = self._read_record(f)
+                        if payload is None:
+                            break
+                        offset = f.tell()
+                        records.append((payload, (segment, offset)))
+                    at_end = offset == os.path.getsize(path)
+            else:
+                at_end = True
+            if len(records) >= limit or segment >= current:
+                break
+            if not at_end:
+                # A finished segment can't have an incomplete record
+                logger.error('Corrupt record in %s at %s; skipping the rest '
+                             'of the segment', path, offset)
+            # Continue in the next segment
+            segment, offset = segment + 1, 0
+        return records
+
+    def commit(self, position):
+        """
+        Stores the position up to where the records are consumed, and
+        removes the segments before it.
+
+        :param position: The (segment, offset) of the first unconsumed
+            record.
+        :type position: tuple
+        :return: None
+        :rtype: None
+        """
+        path = os.path.join(self.directory, self._checkpoint_name)
+        with open(path + '.tmp', 'w') as f:
+            f.write('%s %s' % position)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+        self.checkpoint = position
+        for segment in self._list_segments():
+            if segment < position[0]:
+                os.remove(self._get_path(segment))
+
+    def backlog(self):
+        """
+        Gets the amount of bytes that weren't consumed yet.
+
+        :return: The size of the unconsumed records, in bytes.
+        :rtype: int
+        """
+        segment, offset = self.checkpoint
+        total = 0
+        for number in self._list_segments():
+            if number >= segment:
+                try:
+                    total += os.path.getsize(self._get_path(number))
+                except OSError:
+                    pass
+        return max(0, total - offset)
+
+    def close(self):
+        """
+        Fsyncs and closes the current segment.
+
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            self._sync()
+            self._file.close()
+
+
+class SpoolDrainer(object):
+    """
+    Background thread that replays the spooled records into the database,
+    and moves the checkpoint once their rows are written. Records may be
+    replayed twice after a crash, but none are lost.
+    """
+
+    def __init__(self, spool, handle, flush, batch_size=500, interval=0.2,
+                 max_backoff=30.0):
+        """
+        Creates a (stopped) drainer.
+
+        :param spool: The spool to drain.
+        :type spool: Spool
+        :param handle: Callable that processes a single record. Database
+            errors (SQLAlchemyError) make the drainer retry the record
+            later; other errors skip it.
+        :type handle: callable
+        :param flush: Callable that writes the rows of the handled records,
+            and returns True if it succeeded.
+        :type flush: callable
+        :param batch_size: The maximum amount of records per checkpoint.
+        :type batch_size: int
+        :param interval: Seconds to wait when there are no new records.
+        :type interval: float
+        :param max_backoff: The maximum amount of seconds to wait before
+            retrying after a database error.
+        :type max_backoff: float
+        """
+        self.spool = spool
+        self._handle = handle
+        self._flush = flush
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self._stopped = threading.Event()
+        self._thread = None
+        # Position after the records that were replayed, but not flushed
+        self._pending = None
+        # Statistics
+        self.replayed = 0
+        self.skipped = 0
+        self.retries = 0
+
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(name='spool_drainer',
+                                        target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=10.0):
+        """
+        Stops the drainer after its current batch. Records that weren't
+        replayed yet stay in the spool.
+
+        :param timeout: Seconds to wait for the thread.
+        :type timeout: float
+        :return: None
+        :rtype: None
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _work(self):
+        backoff = self.interval
+        while not self._stopped.is_set():
+            self.spool.sync()
+            if self.drain():
+                backoff = self.interval
+                continue
+            if self.spool.backlog() > 0:
+                # Database trouble; back off before trying again
+                self.retries += 1
+                backoff = min(self.max_backoff, backoff * 2)
+                self._stopped.wait(backoff)
+            else:
+                self._stopped.wait(self.interval)
+
+    def drain(self):
+        """
+        Replays one batch of records, and moves the checkpoint past them
+        once their rows are written. If writing the rows fails, the next
+        call retries that instead of replaying the records again.
+
+        :return: True if records were replayed and committed.
+        :rtype: bool
+        """
+        if self._pending is None:
+            records = self.spool.read(self.spool.checkpoint, self.batch_size)
+            for payload, after in records:
+                try:
+                    self._handle(payload)
+                    self.replayed += 1
+                except SQLAlchemyError as e:
+                    logger.warning('Database error while replaying spool: '
+                                   '%s', e)
+                    break
+                except Exception:
+                    logger.exception('Could not replay spooled record; '
+                                     'skipping it')
+                    self.skipped += 1
+                self._pending = after
+            if self._pending is None:
+                return False
+        if not self._flush():
+            return False
+        self.spool.commit(self._pending)
+        self._pending = None
+        return True
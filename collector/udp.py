@@ -0,0 +1,63 @@
+import logging
+import os
+import socket
+
+logger = logging.getLogger(__name__)
+
+# The kernel's tables of UDP sockets, with a drop count per socket (Linux)
+PROC_TABLES = ('/proc/net/udp', '/proc/net/udp6')
+
+
+def set_receive_buffer(sock, size):
+    """
+    Sets the size of the kernel receive buffer of a socket, so bursts can
+    wait there until the reactor reads them. The kernel caps it at
+    net.core.rmem_max.
+
+    :param sock: The socket.
+    :type sock: socket.socket
+    :param size: The requested size, in bytes.
+    :type size: int
+    :return: The size the kernel actually uses.
+    :rtype: int
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+    actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    # Linux reports double the granted size (it includes its bookkeeping),
+    # so a smaller value means the request was capped
+    if actual < size:
+        logger.warning('Receive buffer of %s bytes requested, but the '
+                       'kernel only allows %s; raise net.core.rmem_max',
+                       size, actual)
+    return actual
+
+
+def get_socket_drops(fileno, tables=PROC_TABLES):
+    """
+    Reads the amount of datagrams the kernel dropped for a socket, because
+    its receive buffer was full.
+
+    :param fileno: The file descriptor of the socket.
+    :type fileno: int
+    :param tables: The files to look for the socket in.
+    :type tables: tuple
+    :return: The amount of dropped datagrams, or None if it's unknown (the
+        platform has no such tables).
+    :rtype: int
+    """
+    try:
+        inode = str(os.fstat(fileno).st_ino)
+    except OSError:
+        return None
+    for path in tables:
+        try:
+            with open(path) as f:
+                lines = f.readlines()[1:]
+        except IOError:
+            continue
+        for line in lines:
+            fields = line.split()
+            # The inode is the 10th column, the drops are the last one
+            if len(fields) >= 13 and fields[9] == inode:
+                return int(fields[-1])
+    return None
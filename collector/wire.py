@@ -0,0 +1,148 @@
+import collections
+import struct
+
+# Every binary message starts with these bytes; JSON messages start with '{'
+MAGIC = b'PP'
+# Flags of the envelope
+FLAG_COMPRESSED = 0x01
+FLAG_NONCE = 0x02
+# Versions of the envelope the collector accepts
+VERSIONS = (1, 2, 3)
+# Size of the MAC (HMAC-SHA256) in front of the payload of version 2
+MAC_SIZE = 32
+# Size of the batch nonce that follows the instance key if FLAG_NONCE is set
+NONCE_SIZE = 8
+
+# A decoded envelope. The body holds the encrypted payload, as raw bytes;
+# the nonce is None if the envelope has none.
+Envelope = collections.namedtuple(
+    'Envelope', ['version', 'flags', 'instance', 'nonce', 'body'])
+
+_header = struct.Struct('!2sBBB')
+
+
+class WireError(Exception):
+    """
+    Class for messages that aren't valid binary envelopes.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+def is_envelope(data):
+    """
+    Checks if a message uses the binary format.
+
+    :param data: The received message.
+    :type data: bytes
+    :return: True if the message starts with the envelope magic.
+    :rtype: bool
+    """
+    return data[:len(MAGIC)] == MAGIC
+
+
+def encode_envelope(instance, body, version=1, flags=0, nonce=None):
+    """
+    Builds a binary envelope. The layout is:
+
+    - magic (2 bytes, 'PP');
+    - version (1 byte);
+    - flags (1 byte);
+    - length of the instance key (1 byte), followed by the key;
+    - if FLAG_NONCE is set, the nonce of the batch (8 bytes), which the
+      client picks at random (or counts up) per batch and reuses when it
+      retransmits the batch;
+    - the body: the IV (or nonce) followed by the encrypted payload.
+
+    For version 1, the payload is the same JSON object (content and hmac)
+    that the JSON format carries in base64; the nonce of the envelope isn't
+    authenticated, so it's ignored (the payload can carry one instead). For
+    version 2, the payload is the raw HMAC-SHA256 of the batch nonce (if
+    any) and the content bytes, followed by those content bytes (the JSON
+    list of entries), so the MAC can be checked before any parsing.
+    For version 3, the body is the 12 byte nonce followed by the AES-GCM
+    encrypted content bytes and the tag; the header (everything before the
+    body, including the batch nonce) is authenticated as associated data.
+    If FLAG_COMPRESSED is set, the JSON (for versions 2 and 3: the content
+    bytes, which the MAC or tag covers) is zlib compressed.
+
+    :param instance: The instance key of the deployment.
+    :type instance: str
+    :param body: The encrypted payload.
+    :type body: bytes
+    :param version: The version of the envelope.
+    :type version: int
+    :param flags: The flags of the envelope.
+    :type flags: int
+    :param nonce: The nonce of the batch; sets FLAG_NONCE if given.
+    :type nonce: bytes
+    :return: The envelope.
+    :rtype: bytes
+    """
+    key = instance.encode('utf-8')
+    if len(key) > 255:
+        raise WireError('Instance key too long')
+    if nonce is not None:
+        if len(nonce) != NONCE_SIZE:
+            raise WireError('Nonce must be %s bytes' % NONCE_SIZE)
+        flags |= FLAG_NONCE
+    elif flags & FLAG_NONCE:
+        raise WireError('Nonce flag set without a nonce')
+    else:
+        nonce = b''
+    return _header.pack(MAGIC, version, flags, len(key)) + key + nonce + \
+        body
+
+
+def decode_envelope(data, versions=VERSIONS):
+    """
+    Parses the header of a binary envelope.
+
+    :param data: The received message.
+    :type data: bytes
+    :param versions: The versions that are accepted.
+    :type versions: tuple
+    :return: The decoded envelope.
+    :rtype: Envelope
+    :raise WireError: If the message isn't a valid envelope.
+    """
+    if len(data) < _header.size:
+        raise WireError('Envelope too short')
+    magic, version, flags, key_length = _header.unpack_from(data)
+    if magic != MAGIC:
+        raise WireError('Not an envelope')
+    if version not in versions:
+        raise WireError('Unsupported envelope version %s' % version)
+    end = _header.size + key_length
+    if len(data) < end:
+        raise WireError('Envelope too short')
+    try:
+        instance = data[_header.size:end].decode('utf-8')
+    except UnicodeDecodeError:
+        raise WireError('Invalid instance key')
+    nonce = None
+    if flags & FLAG_NONCE:
+        nonce = data[end:end + NONCE_SIZE]
+        end += NONCE_SIZE
+        if len(data) < end:
+            raise WireError('Envelope too short')
+    return Envelope(version, flags, instance, nonce, data[end:])
+
+
+def get_header(data, envelope):
+    """
+    Gets the header bytes of an envelope (everything before the body,
+    including the nonce), which version 3 authenticates as associated
+    data.
+
+    :param data: The received message.
+    :type data: bytes
+    :param envelope: The decoded envelope of the message.
+    :type envelope: Envelope
+    :return: The header.
+    :rtype: bytes
+    """
+    return data[:len(data) - len(envelope.body)]
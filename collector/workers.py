@@ -0,0 +1,182 @@
+import os
+import socket
+import sys
+
+from twisted.application import service
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.runner.procmon import ProcessMonitor
+
+# Environment variable that holds the index of a collector worker process
+WORKER_ENV = 'PIPOT_COLLECTOR_WORKER'
+
+# Runs twistd from the interpreter that runs the supervisor
+_TWISTD = 'from twisted.scripts.twistd import run; run()'
+
+
+def get_worker_index():
+    """
+    Gets the index of the collector worker this process runs as.
+
+    :return: The index of the worker, or None if this process isn't a
+        worker process.
+    :rtype: int
+    """
+    index = os.environ.get(WORKER_ENV, None)
+    if index is None:
+        return None
+    return int(index)
+
+
+def get_worker_config(config, index, workers):
+    """
+    Adapts the configuration for a single collector worker. The rate limits
+    are kept per process, so every worker gets an equal share of them; the
+    spool gets a directory per worker.
+
+    :param config: The configuration of the collector.
+    :type config: dict
+    :param index: The index of the worker.
+    :type index: int
+    :param workers: The amount of worker processes.
+    :type workers: int
+    :return: The configuration of the worker.
+    :rtype: dict
+    """
+    config = dict(config)
+    for name in ['COLLECTOR_RATE_LIMIT', 'COLLECTOR_RATE_BURST',
+                 'COLLECTOR_UNKNOWN_TOTAL_RATE',
+                 'COLLECTOR_UNKNOWN_TOTAL_BURST']:
+        if config.get(name, None) is not None:
+            config[name] = float(config[name]) / workers
+    if config.get('COLLECTOR_SPOOL_DIR', None) is not None:
+        config['COLLECTOR_SPOOL_DIR'] = os.path.join(
+            config['COLLECTOR_SPOOL_DIR'], 'worker-%s' % index)
+    return config
+
+
+def create_supervisor(workers, tac_file, cwd=None, max_restart_delay=30):
+    """
+    Creates a service that runs the given amount of collector workers as
+    twistd child processes, and restarts them when they exit.
+
+    :param workers: The amount of worker processes.
+    :type workers: int
+    :param tac_file: The application file the workers run.
+    :type tac_file: str
+    :param cwd: The working directory of the workers.
+    :type cwd: str
+    :param max_restart_delay: The maximum amount of seconds before a worker
+        that keeps crashing is restarted.
+    :type max_restart_delay: int
+    :return: The supervisor service.
+    :rtype: twisted.runner.procmon.ProcessMonitor
+    """
+    monitor = ProcessMonitor()
+    monitor.maxRestartDelay = max_restart_delay
+    for index in range(workers):
+        env = dict(os.environ)
+        env[WORKER_ENV] = str(index)
+        monitor.addProcess(
+            'collector-%s' % index,
+            [sys.executable, '-c', _TWISTD, '--nodaemon', '--pidfile=',
+             '--python', tac_file],
+            env=env, cwd=cwd
+        )
+    return monitor
+
+
+def reuse_port_socket(socket_type, interface, port):
+    """
+    Creates a socket bound with SO_REUSEPORT, so that the kernel spreads
+    the traffic for this port over all worker processes that bind it.
+
+    :param socket_type: socket.SOCK_DGRAM or socket.SOCK_STREAM.
+    :type socket_type: int
+    :param interface: The interface to bind to.
+    :type interface: str
+    :param port: The port to bind to.
+    :type port: int
+    :return: The bound (and for streams, listening) socket.
+    :rtype: socket.socket
+    :raise ValueError: If the platform doesn't support SO_REUSEPORT.
+    """
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise ValueError('SO_REUSEPORT is not supported on this platform')
+    sock = socket.socket(socket.AF_INET, socket_type)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.setblocking(False)
+        sock.bind((interface, port))
+        if socket_type == socket.SOCK_STREAM:
+            sock.listen(50)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
+
+class _ReusePortServer(service.Service):
+    """
+    Listens on a port that is shared with the other worker processes.
+    """
+
+    socket_type = None
+
+    def __init__(self, port, interface=''):
+        self.port = port
+        self.interface = interface
+        self._port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        sock = reuse_port_socket(self.socket_type, self.interface, self.port)
+        try:
+            # The reactor works on a copy of the file descriptor
+            self._port = self._adopt(sock.fileno())
+        finally:
+            sock.close()
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._port is not None:
+            port, self._port = self._port, None
+            return port.stopListening()
+
+    def _adopt(self, fileno):
+        raise NotImplementedError()
+
+
+class ReusePortUDPServer(_ReusePortServer):
+    """
+    UDP counterpart of twisted.application.internet.UDPServer.
+    """
+
+    socket_type = socket.SOCK_DGRAM
+
+    def __init__(self, port, protocol, interface=''):
+        _ReusePortServer.__init__(self, port, interface)
+        self.protocol = protocol
+
+    def _adopt(self, fileno):
+        from twisted.internet import reactor
+        return reactor.adoptDatagramPort(fileno, socket.AF_INET,
+                                         self.protocol)
+
+
+class ReusePortSSLServer(_ReusePortServer):
+    """
+    TLS counterpart of twisted.application.internet.SSLServer.
+    """
+
+    socket_type = socket.SOCK_STREAM
+
+    def __init__(self, port, factory, context_factory, interface=''):
+        _ReusePortServer.__init__(self, port, interface)
+        self.factory = factory
+        self.context_factory = context_factory
+
+    def _adopt(self, fileno):
+        from twisted.internet import reactor
+        return reactor.adoptStreamPort(
+            fileno, socket.AF_INET,
+            TLSMemoryBIOFactory(self.context_factory, False, self.factory))
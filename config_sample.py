@@ -6,5 +6,112 @@ INSTANCE_NAME = 'myTestInstance'
 APPLICATION_ROOT = None
 CSRF_ENABLED = True
 DATABASE_URI = 'mysql+pymysql://root:@localhost:3306/test'
+# Connection pool of each process: the amount of kept connections, the
+# extra ones allowed under load, the age (in seconds) after which a
+# connection is replaced, and whether connections are tested before use.
+DATABASE_POOL_SIZE = 10
+DATABASE_MAX_OVERFLOW = 20
+DATABASE_POOL_RECYCLE = 3600
+DATABASE_POOL_PRE_PING = True
+# Optional read replica of the database. The queries of the dashboard go
+# there, so they don't slow down the collector; None uses the database
+# above for everything.
+DATABASE_READ_URI = None
 COLLECTOR_UDP_PORT = 1234
 COLLECTOR_SSL_PORT = 1235
+# Optional collector tuning. Rows are written in bulk once either threshold
+# is reached. While the database is unavailable, up to
+# COLLECTOR_BUFFER_MAX_ROWS rows are kept in memory (0 removes the limit);
+# rows beyond that are dropped.
+COLLECTOR_FLUSH_ROWS = 500
+COLLECTOR_FLUSH_INTERVAL = 1.0
+COLLECTOR_BUFFER_MAX_ROWS = 100000
+# How often (in seconds) the collector checks for configuration changes.
+COLLECTOR_CACHE_POLL_INTERVAL = 5.0
+# Notifications are sent from worker threads; per notifier there's a queue,
+# a number of workers and a circuit breaker that opens after a number of
+# consecutive failures and retries after the given amount of seconds.
+COLLECTOR_NOTIFY_QUEUE_SIZE = 1000
+COLLECTOR_NOTIFY_CONCURRENCY = 1
+COLLECTOR_NOTIFY_TIMEOUT = 10.0
+COLLECTOR_NOTIFY_FAILURES = 5
+COLLECTOR_NOTIFY_RETRY = 30.0
+# Maximum size (in bytes) of a single message on a TLS connection. Messages
+# are either newline terminated JSON or prefixed with a 4 byte length.
+COLLECTOR_MAX_FRAME_SIZE = 65536
+# Maximum size (in bytes) of a single UDP datagram.
+COLLECTOR_MAX_DATAGRAM_SIZE = 65536
+# Received datagrams are handed to the ingest workers in batches of up to
+# COLLECTOR_UDP_BATCH_SIZE datagrams, or after COLLECTOR_UDP_BATCH_DELAY
+# seconds (1 disables batching). The kernel receive buffer of the UDP
+# socket is set to COLLECTOR_UDP_RECEIVE_BUFFER bytes (0 keeps the system
+# default; the kernel caps it at net.core.rmem_max).
+COLLECTOR_UDP_BATCH_SIZE = 64
+COLLECTOR_UDP_BATCH_DELAY = 0.005
+COLLECTOR_UDP_RECEIVE_BUFFER = 4 * 1024 * 1024
+# Messages naming an instance key that isn't known are dropped before any
+# processing, except for this many per second (with this burst) per source
+# address, and this many per second (with this burst) over all addresses,
+# so deployments that were just added still get through. Keys that turn
+# out not to exist are remembered for COLLECTOR_UNKNOWN_CACHE_TIME seconds
+# (or until a deployment changes), so they aren't looked up again.
+COLLECTOR_UNKNOWN_RATE = 1
+COLLECTOR_UNKNOWN_BURST = 5
+COLLECTOR_UNKNOWN_TOTAL_RATE = 10
+COLLECTOR_UNKNOWN_TOTAL_BURST = 20
+COLLECTOR_UNKNOWN_CACHE_TIME = 10.0
+# Clients may give every batch a nonce, which they reuse when they
+# retransmit it. Only authenticated nonces count: those in the header of
+# version 2 and 3 envelopes, and a "nonce" next to the content in the
+# encrypted payload (which the hmac then covers as well). The last
+# COLLECTOR_DEDUP_WINDOW nonces of each deployment are remembered, and
+# batches with one of those are dropped as duplicates. 0 disables the check.
+COLLECTOR_DEDUP_WINDOW = 1024
+# Received messages are processed by this many worker threads (0 processes
+# them in the reactor thread); at most COLLECTOR_INGEST_QUEUE_SIZE messages
+# wait for a worker.
+COLLECTOR_INGEST_WORKERS = 4
+COLLECTOR_INGEST_QUEUE_SIZE = 10000
+# Amount of collector processes. With more than one, a supervisor process
+# runs the workers, which share the collector ports through SO_REUSEPORT.
+# Every worker keeps its own rate limits and duplicate window: the rate
+# limits (also the overall one for unknown instance keys) are split evenly
+# over the workers, but a retransmitted batch that the kernel hands to
+# another worker than the original isn't recognized as a duplicate.
+COLLECTOR_WORKERS = 1
+# Per deployment limit on the entries per second (0 disables it), and the
+# burst allowed over it. Under sustained overload the lowest notification
+# levels are shed first; the highest level is always kept.
+COLLECTOR_RATE_LIMIT = 0
+COLLECTOR_RATE_BURST = 1000
+# Port (on 127.0.0.1) of the Prometheus metrics endpoint of the collector;
+# 0 disables it. With multiple workers, worker N uses this port + N.
+COLLECTOR_METRICS_PORT = 9105
+# Logging of the collector and the web application: the level, and for
+# chatty categories (received, stored, dropped, shed, rejected, flush) the
+# N in "log 1 in N". Records are written by a background thread; at most
+# LOG_QUEUE_SIZE records wait to be written.
+LOG_LEVEL = 'INFO'
+LOG_SAMPLING = {'stored': 1000, 'dropped': 1000, 'shed': 100, 'rejected': 100}
+LOG_QUEUE_SIZE = 10000
+# Directory of the on-disk spool. When set, authenticated messages are
+# appended to it and replayed into the database in the background, so the
+# collector keeps accepting data while the database is slow or down.
+# Segments are rotated at COLLECTOR_SPOOL_SEGMENT_SIZE bytes and fsynced
+# every COLLECTOR_SPOOL_SYNC_RECORDS records or
+# COLLECTOR_SPOOL_SYNC_INTERVAL seconds.
+COLLECTOR_SPOOL_DIR = None
+COLLECTOR_SPOOL_SEGMENT_SIZE = 64 * 1024 * 1024
+COLLECTOR_SPOOL_SYNC_RECORDS = 1000
+COLLECTOR_SPOOL_SYNC_INTERVAL = 0.1
+# Retention of the reports: rows older than REPORT_RETENTION_DAYS (0 keeps
+# them forever) are removed by the collector every REPORT_PRUNE_INTERVAL
+# seconds, REPORT_PRUNE_CHUNK_SIZE rows per transaction. REPORT_RETENTION
+# overrides the period per service ('PiPot' for the reports of the
+# honeypots themselves). When REPORT_ARCHIVE_DIR is set, removed rows are
+# appended to gzipped JSON files there first, one per table and day.
+REPORT_RETENTION_DAYS = 0
+REPORT_RETENTION = {}
+REPORT_PRUNE_INTERVAL = 3600
+REPORT_PRUNE_CHUNK_SIZE = 1000
+REPORT_ARCHIVE_DIR = None
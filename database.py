@@ -1,9 +1,16 @@
-import re
+import logging
+import os
+import threading
 from abc import ABCMeta
+from functools import wraps
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.engine.url import make_url
 from sqlalchemy.ext.declarative import declarative_base, DeclarativeMeta
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.schema import CreateIndex
+
+logger = logging.getLogger(__name__)
 
 
 class DeclarativeABCMeta(DeclarativeMeta, ABCMeta):
@@ -12,32 +19,291 @@ class DeclarativeABCMeta(DeclarativeMeta, ABCMeta):
     """
     pass
 
+
+class RoutingQueryProperty(object):
+    """
+    Model.query property that queries the read replica inside read_replica,
+    and the primary database everywhere else.
+    """
+
+    def __get__(self, instance, owner):
+        session = db_session
+        if read_session is not None and getattr(_routing, 'depth', 0) > 0:
+            session = read_session
+        if session is None:
+            return None
+        return session.query_property().__get__(instance, owner)
+
+
 Base = declarative_base(metaclass=DeclarativeMeta)
-Base.query = None
+Base.query = RoutingQueryProperty()
+# The engine (and connection pool) of this process, and its sessions
 db_engine = None
+db_session = None
+# The optional read replica, for the heavy queries of the dashboard
+read_engine = None
+read_session = None
+_engine_lock = threading.RLock()
+_engine_uri = None
+_engine_config = None
+_engine_pid = None
+# Per thread, how many read_replica blocks are active
+_routing = threading.local()
 
 
-def create_session(db_string, drop_tables=False):
+def _create_engine(db_string, config):
     """
-    Creates a new DB session using the scoped_session that SQLAlchemy
-    provices.
+    Creates an engine with the pool settings of the configuration.
 
     :param db_string: The connection string.
     :type db_string: str
-    :param drop_tables: Drop existing tables?
-    :type drop_tables: bool
-    :return: A SQLAlchemy session object
-    :rtype: sqlalchemy.orm.scoped_session
+    :param config: The configuration.
+    :type config: dict
+    :return: The engine.
+    :rtype: sqlalchemy.engine.Engine
+    """
+    options = {
+        'convert_unicode': True,
+        'pool_recycle': config.get('DATABASE_POOL_RECYCLE', 3600),
+        'pool_pre_ping': config.get('DATABASE_POOL_PRE_PING', True)
+    }
+    if not make_url(db_string).drivername.startswith('sqlite'):
+        # SQLite doesn't use a queue pool
+        options['pool_size'] = config.get('DATABASE_POOL_SIZE', 10)
+        options['max_overflow'] = config.get('DATABASE_MAX_OVERFLOW', 20)
+    return create_engine(db_string, **options)
+
+
+def init_engine(db_string, config=None):
+    """
+    Creates the engine of this process, which holds the connection pool
+    that all sessions share. Replaces an existing engine.
+
+    :param db_string: The connection string.
+    :type db_string: str
+    :param config: Settings for the pool: DATABASE_POOL_SIZE,
+        DATABASE_MAX_OVERFLOW, DATABASE_POOL_RECYCLE (seconds after which a
+        connection is replaced) and DATABASE_POOL_PRE_PING (test
+        connections before using them). DATABASE_READ_URI optionally
+        points to a read replica, which gets a pool with the same
+        settings.
+    :type config: dict
+    :return: The engine.
+    :rtype: sqlalchemy.engine.Engine
+    """
+    global db_engine, db_session, read_engine, read_session, _engine_uri, \
+        _engine_config, _engine_pid
+    if config is None:
+        config = {}
+    read_uri = config.get('DATABASE_READ_URI', None)
+    with _engine_lock:
+        if _engine_pid == os.getpid():
+            for engine in [db_engine, read_engine]:
+                if engine is not None:
+                    engine.dispose()
+        db_engine = _create_engine(db_string, config)
+        db_session = scoped_session(sessionmaker(bind=db_engine))
+        read_engine, read_session = None, None
+        if read_uri:
+            read_engine = _create_engine(read_uri, config)
+            # Nothing is written through it, so nothing needs flushing
+            read_session = scoped_session(sessionmaker(
+                bind=read_engine, autoflush=False))
+        _engine_uri = db_string
+        _engine_config = config
+        _engine_pid = os.getpid()
+    return db_engine
+
+
+def get_engine(db_string):
+    """
+    Gets the engine of this process, creating it (with the default pool
+    settings) if there's none for the given connection string yet.
+
+    :param db_string: The connection string.
+    :type db_string: str
+    :return: The engine.
+    :rtype: sqlalchemy.engine.Engine
+    """
+    with _engine_lock:
+        if db_engine is None or _engine_uri != db_string or \
+                _engine_pid != os.getpid():
+            # A forked process can't share the connections of its parent,
+            # but keeps the settings (and replica) it was configured with
+            init_engine(db_string,
+                        _engine_config if _engine_uri == db_string else None)
+        return db_engine
+
+
+class read_replica(object):
+    """
+    Routes the queries made through Model.query to the read replica, when
+    DATABASE_READ_URI is configured, for the duration of a with block or a
+    decorated function. Only for reading: the replica may lag behind the
+    primary database, and changes made to the objects it returns aren't
+    written. Writes go through the primary session as usual. The replica
+    session is closed when the outermost block ends.
+    """
+
+    def __enter__(self):
+        _routing.depth = getattr(_routing, 'depth', 0) + 1
+        return read_session if read_session is not None else db_session
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _routing.depth -= 1
+        if _routing.depth == 0 and read_session is not None:
+            read_session.remove()
+        return False
+
+    def __call__(self, f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with self:
+                return f(*args, **kwargs)
+        return decorated_function
+
+
+def import_service_models():
+    """
+    Imports the models of the installed services (as listed by the
+    ServiceModelsManager), so their report tables are known to the
+    metadata. Services that can't be imported are skipped.
+
+    :return: None
+    :rtype: None
     """
-    global db_engine, Base
+    from pipot.services import ServiceModelsManager
+    try:
+        models = ServiceModelsManager.get_models()
+    except IOError:
+        # No services were installed yet
+        return
+    for service in sorted(set(model.split('.')[0] for model in models)):
+        try:
+            ServiceModelsManager.import_models([service])
+        except Exception:
+            logger.exception('Could not import the models of service %s',
+                             service)
 
-    db_engine = create_engine(db_string, convert_unicode=True)
-    db_session = scoped_session(sessionmaker(bind=db_engine))
-    Base.query = db_session.query_property()
 
+def bootstrap(db_string, drop_tables=False, create_indexes=False):
+    """
+    Creates the tables that don't exist yet, and reports the indexes that
+    tables created by an older version lack, including those of the
+    installed services. Meant to be called once, when installing or
+    starting the application, not per session.
+
+    :param db_string: The connection string.
+    :type db_string: str
+    :param drop_tables: Drop existing tables first?
+    :type drop_tables: bool
+    :param create_indexes: Create the missing indexes, instead of only
+        reporting them. This can take a while on large tables.
+    :type create_indexes: bool
+    :return: None
+    :rtype: None
+    """
+    engine = get_engine(db_string)
+    import_service_models()
     if drop_tables:
-        Base.metadata.drop_all(bind=db_engine)
+        Base.metadata.drop_all(bind=engine)
+    Base.metadata.create_all(bind=engine)
+    check_indexes(engine, create=create_indexes)
+    # Processes forked after this shouldn't inherit pooled connections
+    engine.dispose()
+
+
+def find_missing_indexes(engine, tables=None):
+    """
+    Finds the declared indexes that an existing table doesn't have. An
+    index counts as present if the table has any index (or key) that
+    starts with the same columns.
+
+    :param engine: The engine to inspect the database with.
+    :type engine: sqlalchemy.engine.Engine
+    :param tables: The tables to check; all known tables by default.
+    :type tables: list[sqlalchemy.Table]
+    :return: The missing indexes.
+    :rtype: list[sqlalchemy.Index]
+    """
+    if tables is None:
+        tables = Base.metadata.sorted_tables
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in tables:
+        if table.name not in existing_tables:
+            continue
+        keys = [tuple(inspector.get_pk_constraint(table.name)[
+            'constrained_columns'])]
+        keys.extend(tuple(index['column_names'])
+                    for index in inspector.get_indexes(table.name))
+        keys.extend(tuple(constraint['column_names']) for constraint in
+                    inspector.get_unique_constraints(table.name))
+        for index in table.indexes:
+            columns = tuple(column.name for column in index.columns)
+            if not any(key[:len(columns)] == columns for key in keys):
+                missing.append(index)
+    return missing
+
+
+def check_indexes(engine, tables=None, create=False):
+    """
+    Reports (or creates) the declared indexes that existing tables lack.
+
+    :param engine: The engine to use.
+    :type engine: sqlalchemy.engine.Engine
+    :param tables: The tables to check; all known tables by default.
+    :type tables: list[sqlalchemy.Table]
+    :param create: Create the missing indexes.
+    :type create: bool
+    :return: The missing indexes (before any were created).
+    :rtype: list[sqlalchemy.Index]
+    """
+    missing = find_missing_indexes(engine, tables)
+    for index in missing:
+        if create:
+            index.create(bind=engine)
+            logger.info('Created index %s on %s', index.name,
+                        index.table.name)
+        else:
+            logger.warning('Table %s lacks index %s; create it by running '
+                           'install/init_db.py, or with: %s',
+                           index.table.name, index.name,
+                           CreateIndex(index).compile(bind=engine))
+    return missing
 
-    Base.metadata.create_all(bind=db_engine)
 
+def create_tables(models):
+    """
+    Creates the tables of the given models if they don't exist yet, for
+    models that are loaded after the bootstrap (those of services), and
+    reports the indexes that existing tables lack.
+
+    :param models: The model classes.
+    :type models: list[class]
+    :return: None
+    :rtype: None
+    """
+    tables = [model.__table__ for model in models]
+    Base.metadata.create_all(bind=db_engine, tables=tables)
+    check_indexes(db_engine, tables)
+
+
+def create_session(db_string, drop_tables=False):
+    """
+    Gets a DB session using the scoped_session that SQLAlchemy provides.
+    All sessions share the engine (and connection pool) of this process;
+    the schema is created by bootstrap.
+
+    :param db_string: The connection string.
+    :type db_string: str
+    :param drop_tables: Drop and recreate the tables?
+    :type drop_tables: bool
+    :return: A SQLAlchemy session object
+    :rtype: sqlalchemy.orm.scoped_session
+    """
+    get_engine(db_string)
+    if drop_tables:
+        bootstrap(db_string, drop_tables=True)
     return db_session
@@ -0,0 +1,34 @@
+#!/usr/bin/python
+"""
+Fills the rollup table that the dashboard counts reports with from the
+reports that are already stored. Stop the collector while this runs.
+
+Usage: backfill_rollup.py <database uri> [chunk size]
+"""
+
+import sys
+from os import path
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+
+
+def run():
+    from database import bootstrap, create_session
+    from collector.retention import get_report_models
+    from collector.rollup import backfill
+
+    chunk_size = int(sys.argv[2]) if len(sys.argv) == 3 else 1000
+    bootstrap(sys.argv[1])
+    db = create_session(sys.argv[1])
+    totals = backfill(db, get_report_models(db), chunk_size)
+    for name, total in sorted(totals.items()):
+        print('Counted %s reports of %s' % (total, name))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in [2, 3]:
+        print('Invalid number of arguments. Expected 2 or 3 arguments, got '
+              '%s' % len(sys.argv))
+        exit()
+    run()
@@ -13,10 +13,12 @@ if len(sys.argv) != 5:
 
 
 def run():
-    from database import create_session
+    from database import bootstrap, create_session
     from mod_auth.models import User, Role
     from mod_auth.models import Page
 
+    # Existing installations get the indexes they lack as well
+    bootstrap(sys.argv[1], create_indexes=True)
     db = create_session(sys.argv[1])
     # Create pages if not existing
     pages = Page.query.all()
@@ -0,0 +1,159 @@
+import itertools
+import logging
+import os
+import sys
+import threading
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+# Format of the lines the writer produces
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Lets only 1 in N records of a category through. The category of a
+    record is given through the `extra` argument of the logging call, e.g.
+    logger.info('Stored', extra={'category': 'stored'}). Errors are never
+    sampled.
+    """
+
+    def __init__(self, rates):
+        """
+        Creates the filter.
+
+        :param rates: The N for every sampled category.
+        :type rates: dict[str,int]
+        """
+        logging.Filter.__init__(self)
+        self.rates = dict(rates)
+        self._counters = dict(
+            (category, itertools.count()) for category in self.rates)
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        category = getattr(record, 'category', None)
+        counter = self._counters.get(category, None)
+        if counter is None:
+            return True
+        return next(counter) % self.rates[category] == 0
+
+
+class _StandardOutputHandler(logging.Handler):
+    """
+    Writes to whatever sys.stdout is at the time of writing, so that the
+    output ends up in the log of twistd or gunicorn, which replace it after
+    the application is loaded.
+    """
+
+    def emit(self, record):
+        try:
+            sys.stdout.write(self.format(record) + '\n')
+            sys.stdout.flush()
+        except Exception:
+            self.handleError(record)
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Hands records to a background thread that writes them through the
+    target handler, so logging never blocks on the output. Records that
+    don't fit in the queue are dropped (and counted).
+    """
+
+    def __init__(self, target, queue_size=10000):
+        """
+        Creates the handler. The writer thread is started on first use (and
+        again after a fork).
+
+        :param target: The handler that writes the records.
+        :type target: logging.Handler
+        :param queue_size: The maximum amount of records waiting to be
+            written.
+        :type queue_size: int
+        """
+        logging.Handler.__init__(self)
+        self.target = target
+        self._queue = queue.Queue(queue_size)
+        self._thread_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.dropped = 0
+
+    def emit(self, record):
+        self._ensure_writer()
+        # Format the message now; the arguments may change after this call
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(
+                record.exc_info)
+            record.exc_info = None
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Writes the queued records and stops the writer thread.
+
+        :return: None
+        :rtype: None
+        """
+        with self._thread_lock:
+            thread, self._thread = self._thread, None
+        if thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            thread.join(5.0)
+        self.target.close()
+        logging.Handler.close(self)
+
+    def _ensure_writer(self):
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._thread_lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    name='log_writer', target=self._write)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _write(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                return
+            self.target.handle(record)
+
+
+def configure(config, name='pipot'):
+    """
+    Sets up the logging of a process according to the configuration: the
+    level (LOG_LEVEL), the sampled categories (LOG_SAMPLING) and the size
+    of the queue of the writer thread (LOG_QUEUE_SIZE). Records are written
+    to standard output.
+
+    :param config: The parsed configuration.
+    :type config: dict
+    :param name: The name of the process, which is added to every line.
+    :type name: str
+    :return: The asynchronous handler that was installed.
+    :rtype: AsyncHandler
+    """
+    target = _StandardOutputHandler()
+    target.setFormatter(logging.Formatter('%s %s' % (name, LOG_FORMAT)))
+    handler = AsyncHandler(target, config.get('LOG_QUEUE_SIZE', 10000))
+    handler.addFilter(SamplingFilter(config.get('LOG_SAMPLING', {})))
+    root = logging.getLogger()
+    for existing in [h for h in root.handlers if isinstance(h, AsyncHandler)]:
+        root.removeHandler(existing)
+        existing.close()
+    root.addHandler(handler)
+    root.setLevel(config.get('LOG_LEVEL', 'INFO'))
+    return handler
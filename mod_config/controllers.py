@@ -1,3 +1,4 @@
+import logging
 import os
 import sys
 
@@ -12,18 +13,20 @@ from flask import Blueprint, g, request, send_file, jsonify, abort, \
 from werkzeug.utils import secure_filename
 from sqlalchemy import create_engine
 
-from database import create_session
+from database import create_session, create_tables
 from decorators import get_menu_entries, template_renderer
 from mod_auth.controllers import login_required, check_access_rights
 from mod_config.forms import NewServiceForm, BaseServiceForm, \
     UpdateServiceForm, EditServiceForm, UpdateNotificationForm, \
     NewNotificationForm, EditNotificationForm, BaseNotificationForm, \
     RuleForm, DeleteRuleForm
-from mod_config.models import Service, Notification, Rule, Actions, Conditions
+from mod_config.models import Service, Notification, Rule, Actions, \
+    Conditions, CacheVersion
 from pipot.notifications import NotificationLoader
 from pipot.services import ServiceLoader, ServiceModelsManager
 
 mod_config = Blueprint('config', __name__)
+logger = logging.getLogger(__name__)
 
 
 @mod_config.before_app_request
@@ -59,7 +62,7 @@ def _install_notification_service_thread(cls, update, description):
     if len(apt_deps) > 0:
         apt = ['apt-get', '-q', '-y', 'install']
         apt.extend(apt_deps)
-        print('Calling %s' % " ".join(apt))
+        logger.info('Calling %s', " ".join(apt))
         # Call apt-get install
         _ph = subprocess.Popen(apt)
         _ph.wait()
@@ -68,7 +71,7 @@ def _install_notification_service_thread(cls, update, description):
     if len(pip_deps) > 0:
         pip = ['pip', 'install']
         pip.extend(pip_deps)
-        print('Calling %s' % " ".join(pip))
+        logger.info('Calling %s', " ".join(pip))
         _ph = subprocess.Popen(pip)
         _ph.wait()
 
@@ -173,8 +176,10 @@ def notifications_ajax(action):
         if form.validate_on_submit():
             notification = Notification.query.filter(
                 Notification.id == form.id.data).first()
-            # Delete service
+            # Delete service (and the rules using it)
             g.db.delete(notification)
+            CacheVersion.bump(g.db, 'rule')
+            CacheVersion.bump(g.db, 'notification')
             # Delete file
             try:
                 os.remove(notification.get_file())
@@ -215,6 +220,8 @@ def notifications_ajax(action):
                     cls = NotificationLoader.load_from_file(temp_path)
                     # Overwrite existing
                     shutil.move(temp_path, notification.get_file())
+                    CacheVersion.bump(g.db, 'notification')
+                    g.db.commit()
                     # Update requirements
                     _install_notification_service(cls)
                     result['status'] = 'success'
@@ -253,6 +260,7 @@ def data_processing():
             Actions[form.action.data]
         )
         g.db.add(rule)
+        CacheVersion.bump(g.db, 'rule')
         g.db.commit()
         return redirect(url_for('.data_processing'))
     return {
@@ -276,6 +284,7 @@ def data_processing_ajax(action):
             if rule is not None:
                 # Delete rule
                 g.db.delete(rule)
+                CacheVersion.bump(g.db, 'rule')
                 g.db.commit()
                 result['status'] = 'success'
         else:
@@ -288,8 +297,8 @@ def verify_and_import_module(final_path, form, is_container=False, re_load=True)
         instance = ServiceLoader.load_from_container(final_path, temp_folder=False, re_load=re_load)
     else:
         instance = ServiceLoader.load_from_file(final_path, temp_folder=False, re_load=re_load)
-    # Auto-generate tables
-    instance.get_used_table_names()
+    # Create the tables of the service
+    create_tables(instance.get_used_table_names().values())
     # Update database
     service = Service(instance.__class__.__name__, form.description.data)
     g.db.add(service)
@@ -297,6 +306,21 @@ def verify_and_import_module(final_path, form, is_container=False, re_load=True)
     return instance
 
 
+def _service_changed(name):
+    """
+    Drops the cached instances of a service after its code changed, in this
+    process and (through the cache version) in the collector.
+
+    :param name: The name of the service.
+    :type name: str
+    :return: None
+    :rtype: None
+    """
+    ServiceLoader.registry.invalidate(name)
+    CacheVersion.bump(g.db, 'service')
+    g.db.commit()
+
+
 @mod_config.route('/services', methods=['GET', 'POST'])
 @login_required
 @check_access_rights()
@@ -320,6 +344,7 @@ def services():
                         zip_file.extractall('./pipot/services')
                         try:
                             verify_and_import_module(final_dir, form, is_container=True, re_load=False)
+                            _service_changed(basename)
                             # Reset form, all ok
                             form = NewServiceForm(None)
                         except ServiceLoader.ServiceLoaderException as e:
@@ -334,6 +359,7 @@ def services():
                     # Import and verify module
                     try:
                         verify_and_import_module(final_dir, form, is_container=False, re_load=False)
+                        _service_changed(basename)
                         # Reset form, all ok
                         form = NewServiceForm(None)
                     except ServiceLoader.ServiceLoaderException as e:
@@ -370,7 +396,7 @@ def services_ajax(action):
         if form.validate_on_submit():
             service = Service.query.filter(
                 Service.id == form.id.data).first()
-            # Delete service in db
+            # Delete service in db (cascades to profiles and rules)
             g.db.delete(service)
             # Delete service model
             removed_models = ServiceModelsManager.rm_models(service.name)
@@ -384,6 +410,9 @@ def services_ajax(action):
             try:
                 shutil.rmtree(service.get_file())
                 # Finalize service delete
+                ServiceLoader.registry.invalidate(service.name)
+                for name in ['service', 'deployment', 'rule']:
+                    CacheVersion.bump(g.db, name)
                 g.db.commit()
                 result['status'] = 'success'
             except EnvironmentError as e:
@@ -430,6 +459,8 @@ def services_ajax(action):
                 # Import and verify module
                 try:
                     new_instance = ServiceLoader.load_from_file(final_dir, temp_folder=False, re_load=True)
+                    create_tables(new_instance.get_used_table_names().values())
+                    _service_changed(service.name)
                     # Reset form, all ok
                     form = NewServiceForm(None)
                     # remove the old service file
@@ -441,6 +472,7 @@ def services_ajax(action):
                     shutil.move(os.path.join(temp_dir, basename),
                                 os.path.join('./pipot/services'))
                     old_instance = ServiceLoader.load_from_file(final_dir, temp_folder=False, re_load=True)
+                    create_tables(old_instance.get_used_table_names().values())
                     # Pass error to user
                     form.errors['file'] = [e.value]
                     result['errors'] = form.errors
@@ -1,4 +1,5 @@
 import json
+import operator
 import os
 import enum
 
@@ -53,6 +54,44 @@ class Notification(Base):
         )
 
 
+class CacheVersion(Base):
+    """
+    Version counter for configuration that is cached by other processes
+    (e.g. the collector). Bumping a version tells them to reload it.
+    """
+    __tablename__ = 'cache_version'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+    name = Column(String(50), primary_key=True)
+    version = Column(Integer, nullable=False)
+
+    def __init__(self, name, version=0):
+        self.name = name
+        self.version = version
+
+    def __repr__(self):
+        return '<CacheVersion %r: %r>' % (self.name, self.version)
+
+    @staticmethod
+    def bump(db, name):
+        """
+        Increments the version of the given cache. The caller is responsible
+        for committing the session.
+
+        :param db: The database session.
+        :type db: sqlalchemy.orm.scoped_session
+        :param name: The name of the cache.
+        :type name: str
+        :return: None
+        :rtype: None
+        """
+        entry = db.query(CacheVersion).filter(
+            CacheVersion.name == name).first()
+        if entry is None:
+            entry = CacheVersion(name)
+            db.add(entry)
+        entry.version += 1
+
+
 class Actions(enum.Enum):
     drop = "drop"
     store = "store"
@@ -66,6 +105,29 @@ class Conditions(enum.Enum):
     ge = '>='
     ne = '!='
 
+    def compare(self, left, right):
+        """
+        Applies this condition to two values.
+
+        :param left: The left hand side of the comparison.
+        :type left: int
+        :param right: The right hand side of the comparison.
+        :type right: int
+        :return: The result of the comparison.
+        :rtype: bool
+        """
+        return _condition_operators[self.name](left, right)
+
+
+_condition_operators = {
+    'st': operator.lt,
+    'gt': operator.gt,
+    'eq': operator.eq,
+    'se': operator.le,
+    'ge': operator.ge,
+    'ne': operator.ne
+}
+
 
 class Rule(Base):
     __tablename__ = 'rule'
@@ -74,7 +136,7 @@ class Rule(Base):
     }
     id = Column(Integer, primary_key=True)
     service_id = Column(Integer, ForeignKey('service.id', onupdate="CASCADE",
-                                            ondelete="CASCADE"))
+                                            ondelete="CASCADE"), index=True)
     notification_id = Column(Integer,
                              ForeignKey('notification.id',
                                         onupdate="CASCADE",
@@ -98,8 +160,7 @@ class Rule(Base):
         self.action = action
 
     def matches(self, compare_level):
-        return eval('%s %s %s' % (compare_level, self.condition.value,
-                                  self.level))
+        return self.condition.compare(compare_level, self.level)
 
     @staticmethod
     def is_valid_condition(condition):
@@ -1,3 +1,4 @@
+import logging
 import os
 import string
 import sys
@@ -15,13 +16,14 @@ from sqlalchemy import and_
 
 from decorators import get_menu_entries, template_renderer
 from mod_auth.controllers import check_access_rights, login_required
-from mod_config.models import Service
+from mod_config.models import Service, CacheVersion
 from mod_honeypot.forms import NewDeploymentForm, ModifyProfileForm, \
     NewProfileForm, ServiceProfileForm
 from mod_honeypot.models import Profile, ProfileService, Deployment, PiPotReport, \
     PiModels, CollectorTypes
 
 mod_honeypot = Blueprint('honeypot', __name__)
+logger = logging.getLogger(__name__)
 
 
 @mod_honeypot.before_app_request
@@ -65,6 +67,7 @@ def profiles_id(id):
     if form.validate_on_submit():
         if form.type.data == 'delete':
             g.db.delete(profile)
+            CacheVersion.bump(g.db, 'deployment')
             g.db.commit()
             return redirect(url_for('.profiles'))
         else:
@@ -92,6 +95,7 @@ def profiles_id(id):
                         service_form.service_configuration.data
                     )
                     g.db.add(ps)
+                    CacheVersion.bump(g.db, 'deployment')
                     g.db.commit()
                     result['status'] = 'success'
                 else:
@@ -104,6 +108,7 @@ def profiles_id(id):
                 ).first()
                 ps.service_configuration = \
                     service_form.service_configuration.data
+                CacheVersion.bump(g.db, 'deployment')
                 g.db.commit()
                 result['status'] = 'success'
             elif service_form.service_type.data == 'delete':
@@ -112,6 +117,7 @@ def profiles_id(id):
                     ProfileService.service_id == service_form.service_id.data)
                 ).first()
                 g.db.delete(ps)
+                CacheVersion.bump(g.db, 'deployment')
                 g.db.commit()
                 result['status'] = 'success'
         else:
@@ -164,6 +170,7 @@ def manage():
                 CollectorTypes[new_deploy.collector_type.data]
             )
             g.db.add(deployment)
+            CacheVersion.bump(g.db, 'deployment')
             g.db.commit()
             result['status'] = 'success'
             result['id'] = deployment.id
@@ -177,11 +184,10 @@ def manage():
     if sys.platform.startswith("linux"):
         addrs = ni.ifaddresses(app.config.get('NETWORK_INTERFACE'))
         new_deploy.server_ip.data = addrs[ni.AF_INET][0]['addr']
-        print('Setting default ip: %s' % addrs[ni.AF_INET][0]['addr'])
+        logger.debug('Setting default ip: %s', addrs[ni.AF_INET][0]['addr'])
     else:
-        print('Windows platform is currently unsupported; interfaces below '
-              'for debug purposes')
-        print(ni.interfaces())
+        logger.warning('Windows platform is currently unsupported; '
+                       'interfaces: %s', ni.interfaces())
     return {
         'deployments': Deployment.query.order_by(Deployment.name.asc()),
         'form': new_deploy
@@ -233,8 +239,7 @@ def manage_id(id, action):
                 subprocess.Popen(args, stdout=devnull,
                                  stderr=subprocess.STDOUT)
             else:
-                print('Windows unsupported; arguments for debug')
-                print(args)
+                logger.warning('Windows unsupported; arguments: %s', args)
             result['status'] = 'success'
             result['progress'] = 0
             return jsonify(result)
@@ -248,6 +253,7 @@ def manage_id(id, action):
                 os.remove(deployment.get_image_path())
             # Delete from DB
             g.db.delete(deployment)
+            CacheVersion.bump(g.db, 'deployment')
             g.db.commit()
             result['status'] = 'success'
             return jsonify(result)
@@ -83,7 +83,7 @@ class Deployment(Base):
         ForeignKey('profile.id', onupdate="CASCADE", ondelete="RESTRICT")
     )
     profile = orm.relationship("Profile")
-    instance_key = Column(String(20))
+    instance_key = Column(String(20), index=True)
     mac_key = Column(String(32))
     encryption_key = Column(String(32))
     rpi_model = Column(Enum(PiModels))
@@ -1,13 +1,16 @@
 import datetime
 from flask import Blueprint, g, jsonify, request, render_template_string
+from sqlalchemy import func
 
+from database import read_replica
 from decorators import template_renderer, get_menu_entries
 from mod_auth.controllers import login_required, check_access_rights
 
 # Register blueprint
 from mod_honeypot.models import Deployment, PiPotReport
-from mod_report.forms import DashboardForm
-from pipot.services.ServiceLoader import get_class_instance
+from mod_report.forms import DashboardForm, CountsForm
+from mod_report.models import ReportRollup
+from pipot.services import ServiceLoader
 
 mod_report = Blueprint('report', __name__)
 
@@ -18,13 +21,50 @@ def before_request():
         g.user, 'Dashboard', 'dashboard', 'report.dashboard')
 
 
+def get_since(hours):
+    """
+    Gets the start of the oldest hour in a span that ends with the current
+    hour.
+
+    :param hours: The amount of hours in the span.
+    :type hours: int
+    :return: The start of the oldest hour.
+    :rtype: datetime.datetime
+    """
+    return datetime.datetime.utcnow().replace(
+        minute=0, second=0, microsecond=0) - datetime.timedelta(
+        hours=hours - 1)
+
+
+def get_recent_totals(hours=24):
+    """
+    Gets the amount of reports of the last hours per deployment and
+    service, from the rollup instead of the report tables.
+
+    :param hours: The amount of hours to count.
+    :type hours: int
+    :return: The amounts, per (deployment id, service name); the reports of
+        the honeypot itself count as service 'PiPot'.
+    :rtype: dict[tuple,int]
+    """
+    rows = ReportRollup.query.with_entities(
+        ReportRollup.deployment_id, ReportRollup.service,
+        func.sum(ReportRollup.count)).filter(
+        ReportRollup.hour >= get_since(hours)).group_by(
+        ReportRollup.deployment_id, ReportRollup.service).all()
+    return dict(((deployment_id, service), int(total))
+                for deployment_id, service, total in rows)
+
+
 @mod_report.route('/')
 @login_required
 @check_access_rights()
+@read_replica()
 @template_renderer()
 def dashboard():
     # Get active deployments
     deployments = Deployment.query.all()
+    totals = get_recent_totals()
     data = [
         {
             'id': d.id,
@@ -35,10 +75,13 @@ def dashboard():
                 {
                     'id': ps.service.id,
                     'name': ps.service.name,
-                    'report_types': get_class_instance(
-                        ps.service.name, None, None).get_report_types()
+                    'report_types': ServiceLoader.registry.get_instance(
+                        ps.service.name, None, None).get_report_types(),
+                    'count': totals.get((d.id, ps.service.name), 0)
                 } for ps in d.profile.services
-            ]
+            ],
+            'count': sum(total for key, total in totals.items()
+                         if key[0] == d.id)
         } for d in deployments
     ]
     for d in data:
@@ -46,7 +89,8 @@ def dashboard():
             {
                 'id': 0,
                 'name': 'General information',
-                'report_types': ['General data']
+                'report_types': ['General data'],
+                'count': totals.get((d['id'], 'PiPot'), 0)
             }
         )
     return {
@@ -58,6 +102,7 @@ def dashboard():
 @mod_report.route('/dashboard/<action>', methods=['POST'])
 @login_required
 @check_access_rights('.dashboard')
+@read_replica()
 def dashboard_ajax(action):
     from run import app
     result = {
@@ -89,8 +134,8 @@ def dashboard_ajax(action):
                     'entries': data
                 }
             else:
-                service = get_class_instance(form.service_inst.name, None,
-                                             None)
+                service = ServiceLoader.registry.get_instance(
+                    form.service_inst.name, None, None)
                 report_type = form.report_type.data
                 template_string = service.get_template_for_type(report_type)
                 template_args = service.get_template_arguments(
@@ -107,6 +152,30 @@ def dashboard_ajax(action):
                 template_string, **template_args)
         else:
             result['errors'] = form.errors
+    if action == 'counts':
+        # Report counts per deployment, service, hour and level, from the
+        # rollup instead of the report tables
+        form = CountsForm(request.form)
+        if form.validate_on_submit():
+            query = ReportRollup.query.filter(
+                ReportRollup.hour >= get_since(form.hours.data or 24))
+            if form.deployment.data is not None:
+                query = query.filter(
+                    ReportRollup.deployment_id == form.deployment.data)
+            result['status'] = 'success'
+            result['payload'] = [
+                {
+                    'deployment': cell.deployment_id,
+                    'service': cell.service,
+                    'hour': cell.hour.strftime('%Y-%m-%d %H:00:00'),
+                    'level': cell.level,
+                    'count': cell.count
+                } for cell in query.order_by(
+                    ReportRollup.hour, ReportRollup.deployment_id,
+                    ReportRollup.service, ReportRollup.level).all()
+            ]
+        else:
+            result['errors'] = form.errors
     if action == 'data':
         # TODO: add implementation for more data request from the client
         # side (to allow dynamic reloading of data)
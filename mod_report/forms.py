@@ -1,7 +1,8 @@
 from flask_wtf import Form
 from flask_wtf.form import _Auto
 from wtforms import StringField, IntegerField
-from wtforms.validators import DataRequired, ValidationError
+from wtforms.validators import DataRequired, ValidationError, NumberRange, \
+    Optional
 
 from mod_honeypot.models import Deployment
 from pipot.services.ServiceLoader import get_class_instance
@@ -60,3 +61,18 @@ class DashboardForm(Form):
             form.service_inst.name, None, None).get_report_types()
         if field.data not in valid_types:
             raise ValidationError('invalid report type')
+
+
+class CountsForm(Form):
+    deployment = IntegerField('Deployment', validators=[Optional()])
+    hours = IntegerField('Hours', default=24, validators=[
+        Optional(), NumberRange(min=1, max=24 * 366)
+    ])
+
+    @staticmethod
+    def validate_deployment(form, field):
+        # When given, it needs to be a valid deployment
+        deployment = Deployment.query.filter(
+            Deployment.id == field.data).first()
+        if deployment is None:
+            raise ValidationError('invalid deployment id')
@@ -0,0 +1,40 @@
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, \
+    UniqueConstraint, Index
+
+from database import Base
+
+
+class ReportRollup(Base):
+    """
+    Amount of stored reports per deployment, service, hour and notification
+    level. The collector keeps it up to date while storing reports, so the
+    dashboard can count them without reading the report tables.
+    """
+    __tablename__ = 'report_rollup'
+    __table_args__ = (
+        UniqueConstraint('deployment_id', 'service', 'hour', 'level',
+                         name='uq_report_rollup_cell'),
+        Index('ix_report_rollup_hour', 'hour'),
+        {'mysql_engine': 'InnoDB'}
+    )
+    id = Column(Integer, primary_key=True)
+    deployment_id = Column(Integer, ForeignKey(
+        'deployment.id', onupdate="CASCADE", ondelete="CASCADE"),
+        nullable=False)
+    # The name of the service, or 'PiPot' for the reports of the honeypot
+    service = Column(String(50), nullable=False)
+    hour = Column(DateTime(), nullable=False)
+    level = Column(Integer, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, deployment_id, service, hour, level, count=0):
+        self.deployment_id = deployment_id
+        self.service = service
+        self.hour = hour
+        self.level = level
+        self.count = count
+
+    def __repr__(self):
+        return '<ReportRollup %r: %r %r %r %r>' % (
+            self.deployment_id, self.service, self.hour, self.level,
+            self.count)
@@ -1,6 +1,39 @@
 import base64
+import binascii
+import collections
+import os
+import threading
 
-from Crypto import Random, Util, Cipher
+from Crypto import Random
+from Crypto.Cipher import AES
+from Crypto.Util import Counter
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+# Size of the nonce of AES-GCM
+GCM_NONCE_SIZE = 12
+# AES-GCM contexts per key, so the key schedule is set up once per key;
+# the least recently used ones are dropped first
+_gcm_contexts = collections.OrderedDict()
+_gcm_contexts_max = 4096
+_gcm_lock = threading.Lock()
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def _get_gcm(key):
+    with _gcm_lock:
+        context = _gcm_contexts.pop(key, None)
+        if context is None:
+            context = AESGCM(_to_bytes(key))
+            if len(_gcm_contexts) >= _gcm_contexts_max:
+                _gcm_contexts.popitem(last=False)
+        _gcm_contexts[key] = context
+    return context
 
 
 class Encryption:
@@ -21,11 +54,24 @@ class Encryption:
         :return: A base64 encoded encrypted string.
         :rtype: str
         """
-        iv = Random.new().read(Cipher.AES.block_size)
-        ctr = Util.Counter.new(128,
-                               initial_value=long(iv.encode("hex"), 16))
-        cipher = Cipher.AES.new(key, Cipher.AES.MODE_CTR, counter=ctr)
-        return base64.b64encode(iv + cipher.encrypt(content))
+        return base64.b64encode(Encryption.encrypt_raw(key, content))
+
+    @staticmethod
+    def encrypt_raw(key, content):
+        """
+        Encrypts a given content string using the given key and a random IV.
+
+        :param key: The key.
+        :type key: str
+        :param content: The content to encrypt.
+        :type content: bytes
+        :return: The IV, followed by the encrypted content.
+        :rtype: bytes
+        """
+        iv = Random.new().read(AES.block_size)
+        ctr = Counter.new(128, initial_value=int(binascii.hexlify(iv), 16))
+        cipher = AES.new(_to_bytes(key), AES.MODE_CTR, counter=ctr)
+        return iv + cipher.encrypt(_to_bytes(content))
 
     @staticmethod
     def decrypt(key, encrypted):
@@ -42,10 +88,72 @@ class Encryption:
         """
         try:
             encrypted = base64.b64decode(encrypted)
+        except BaseException:
+            return ""
+        return Encryption.decrypt_raw(key, encrypted)
+
+    @staticmethod
+    def decrypt_raw(key, encrypted):
+        """
+        Decrypts the given bytes using the provided key.
+
+        :param key: The key.
+        :type key: str
+        :param encrypted: The content to decrypt, preceded by the 16 byte IV.
+        :type encrypted: bytes
+        :return: The decrypted content (empty on failure).
+        :rtype: bytes
+        """
+        try:
             iv = encrypted[:16]
-            ctr = Util.Counter.new(128,
-                                   initial_value=long(iv.encode("hex"), 16))
-            cipher = Cipher.AES.new(key, Cipher.AES.MODE_CTR, counter=ctr)
+            ctr = Counter.new(128,
+                              initial_value=int(binascii.hexlify(iv), 16))
+            cipher = AES.new(_to_bytes(key), AES.MODE_CTR, counter=ctr)
             return cipher.decrypt(encrypted[16:])
         except BaseException:
-            return ""
+            return b""
+
+    @staticmethod
+    def encrypt_gcm(key, content, associated_data=None):
+        """
+        Encrypts and authenticates the content with AES-GCM, using a random
+        nonce.
+
+        :param key: The key (16, 24 or 32 characters).
+        :type key: str
+        :param content: The content to encrypt.
+        :type content: bytes
+        :param associated_data: Data that isn't encrypted, but that is
+            authenticated along with the content.
+        :type associated_data: bytes
+        :return: The nonce, followed by the encrypted content and the tag.
+        :rtype: bytes
+        """
+        nonce = os.urandom(GCM_NONCE_SIZE)
+        return nonce + _get_gcm(key).encrypt(
+            nonce, _to_bytes(content), associated_data)
+
+    @staticmethod
+    def decrypt_gcm(key, encrypted, associated_data=None):
+        """
+        Authenticates and decrypts content encrypted with AES-GCM, in a
+        single pass.
+
+        :param key: The key.
+        :type key: str
+        :param encrypted: The nonce, followed by the encrypted content and
+            the tag.
+        :type encrypted: bytes
+        :param associated_data: The authenticated, unencrypted data.
+        :type associated_data: bytes
+        :return: The decrypted content, or None if it isn't authentic.
+        :rtype: bytes
+        """
+        if len(encrypted) < GCM_NONCE_SIZE:
+            return None
+        try:
+            return _get_gcm(key).decrypt(
+                encrypted[:GCM_NONCE_SIZE], encrypted[GCM_NONCE_SIZE:],
+                associated_data)
+        except (InvalidTag, ValueError):
+            return None
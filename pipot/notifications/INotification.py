@@ -32,6 +32,27 @@ class INotification:
         """
         pass
 
+    def open(self):
+        """
+        Called once before the first message is processed by a pooled
+        instance. Can be used to set up persistent resources (e.g. a
+        connection to a mail server).
+
+        :return: void
+        :rtype: void
+        """
+        pass
+
+    def close(self):
+        """
+        Called when a pooled instance is discarded (e.g. when the collector
+        stops). Should release anything acquired in open.
+
+        :return: void
+        :rtype: void
+        """
+        pass
+
     @abstractmethod
     def requires_extra_config(self):
         """
@@ -1,11 +1,16 @@
 import importlib
+import json
+import logging
 import os
-from traceback import print_exc
+import sys
+import threading
 
 import pipot.notifications as main
 import pipot.notifications.temp as temp
 from pipot.notifications.INotification import INotification
 
+logger = logging.getLogger(__name__)
+
 
 class NotificationLoaderException(Exception):
     def __init__(self, value):
@@ -43,14 +48,14 @@ def load_from_file(file_name, temp_folder=True):
         if INotification in cls.__bases__:
             return cls
     except TabError as e:
-        print_exc()
+        logger.exception('Could not load %s', file_name)
         raise NotificationLoaderException('Tab error: %s' % str(e))
     except TypeError as e:
-        print_exc()
+        logger.exception('Could not load %s', file_name)
         raise NotificationLoaderException('Validation of the imported file '
                                           'failed: %s' % str(e))
     except ImportError as e:
-        print_exc()
+        logger.exception('Could not load %s', file_name)
         raise NotificationLoaderException('Import of the file  failed: %s'
                                           % str(e))
 
@@ -91,3 +96,153 @@ def get_class_instance(name, config):
 
     raise NotificationLoaderException('File does not contain a valid '
                                       'INotification implementation')
+
+
+class NotifierPool(object):
+    """
+    Keeps opened notifier instances per notification name and
+    configuration, so they (and their connections) can be reused for every
+    message. Users hand instances back through release; an instance is only
+    closed once nobody uses it anymore. Instances are created and opened
+    outside of the pool lock, so a notifier that's slow to open only holds
+    up the users of that same notifier.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._instances = {}
+        # Amount of users per instance (by id)
+        self._users = {}
+        # Locks of the instances that are being opened, per key
+        self._opening = {}
+        # Changes on every invalidation
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, config):
+        """
+        Gets an opened instance of the given notification service for the
+        given configuration. Every call should be matched by a call to
+        release once the instance isn't needed anymore.
+
+        :param name: The name of the notification service.
+        :type name: str
+        :param config: The configuration for this service
+        :type config: dict
+        :return: An opened instance of the notification service.
+        :rtype: pipot.notifications.INotification.INotification
+        """
+        key = (name, json.dumps(config, sort_keys=True))
+        with self._lock:
+            instance = self._use(key)
+            if instance is not None:
+                return instance
+            opening = self._opening.setdefault(key, threading.Lock())
+        with opening:
+            with self._lock:
+                # Another user may have opened it meanwhile
+                instance = self._use(key)
+                if instance is not None:
+                    return instance
+                self.misses += 1
+                generation = self._generation
+            try:
+                instance = get_class_instance(name, config)
+                instance.open()
+            finally:
+                with self._lock:
+                    self._opening.pop(key, None)
+            with self._lock:
+                # What was opened before an invalidation is only used once
+                if generation == self._generation:
+                    self._instances[key] = instance
+                self._users[id(instance)] = 1
+        return instance
+
+    def _use(self, key):
+        """
+        Gets a pooled instance and counts the new user, if there's one.
+        Should be called with the lock held.
+
+        :param key: The name and the serialized configuration.
+        :type key: tuple
+        :return: The pooled instance, or None.
+        :rtype: pipot.notifications.INotification.INotification
+        """
+        instance = self._instances.get(key, None)
+        if instance is not None:
+            self.hits += 1
+            self._users[id(instance)] = self._users.get(id(instance), 0) + 1
+        return instance
+
+    def release(self, instance):
+        """
+        Hands back an instance that was obtained through get. The last user
+        closes it, and removes it from the pool.
+
+        :param instance: The instance.
+        :type instance: pipot.notifications.INotification.INotification
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            users = self._users.pop(id(instance), 0) - 1
+            if users > 0:
+                self._users[id(instance)] = users
+                return
+            for key, pooled in list(self._instances.items()):
+                if pooled is instance:
+                    del self._instances[key]
+        self._close([instance])
+
+    def invalidate(self, name=None, reload_modules=False):
+        """
+        Forgets the pooled instances of a notification service, or of all
+        of them. Instances that are in use are closed when they're
+        released; the others right away.
+
+        :param name: The name of the notification service, or None for all.
+        :type name: str
+        :param reload_modules: Also unload the modules, so the next lookup
+            imports the code from disk again.
+        :type reload_modules: bool
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            self._generation += 1
+            keys = [key for key in self._instances.keys()
+                    if name is None or key[0] == name]
+            instances = [self._instances.pop(key) for key in keys]
+            instances = [instance for instance in instances
+                         if id(instance) not in self._users]
+            if reload_modules:
+                for service_name in set(key[0] for key in keys):
+                    sys.modules.pop(main.__name__ + '.' + service_name, None)
+        self._close(instances)
+
+    def close_all(self):
+        """
+        Closes all pooled instances, including the ones in use. Meant for
+        shutting down, after the users stopped.
+
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            instances = list(self._instances.values())
+            self._instances = {}
+            self._users = {}
+        self._close(instances)
+
+    @staticmethod
+    def _close(instances):
+        for instance in instances:
+            try:
+                instance.close()
+            except Exception:
+                logger.exception('Could not close notifier %s', instance)
+
+
+pool = NotifierPool()
@@ -4,7 +4,7 @@ import datetime
 from abc import ABCMeta, abstractmethod
 
 import sys
-from sqlalchemy import Column, DateTime, Integer, String, ForeignKey
+from sqlalchemy import Column, DateTime, Integer, String, ForeignKey, Index
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.orm import relationship
 from twisted.application import internet
@@ -22,10 +22,27 @@ class IModel(Base):
     """
     Abstract base model for storing entries in the database containing three
     base fields: id, timestamp and deployment_id (foreign key to the
-    Deployment table).
+    Deployment table). Every table gets an index on (deployment_id,
+    timestamp), for the reports per deployment, and one on timestamp, for
+    pruning old rows.
     """
     __abstract__ = True
-    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    @declared_attr
+    def __table_args__(cls):
+        return cls.get_indexes() + ({'mysql_engine': 'InnoDB'},)
+
+    @classmethod
+    def get_indexes(cls):
+        """
+        Gets the indexes of the table. Subclasses can extend these.
+
+        :return: The indexes.
+        :rtype: tuple[sqlalchemy.Index]
+        """
+        return (Index('ix_%s_deployment_id_timestamp' % cls.__tablename__,
+                      'deployment_id', 'timestamp'),
+                Index('ix_%s_timestamp' % cls.__tablename__, 'timestamp'))
 
     id = Column(Integer, primary_key=True)
     timestamp = Column(DateTime())
@@ -73,12 +90,18 @@ class IModel(Base):
 class IModelIP(IModel):
     """
     Abstract base class implementation that adds an IP & port over the
-    already defined fields.
+    already defined fields, and an index on (ip, timestamp).
     """
     __abstract__ = True
     ip = Column(String(46))  # IPv6 proof
     port = Column(Integer)
 
+    @classmethod
+    def get_indexes(cls):
+        return super(IModelIP, cls).get_indexes() + (
+            Index('ix_%s_ip_timestamp' % cls.__tablename__, 'ip',
+                  'timestamp'),)
+
     def __init__(self, deployment_id, ip, port, timestamp=None):
         """
         Inits this instance.
@@ -157,6 +180,35 @@ class IService:
         """
         pass
 
+    def create_storage_rows(self, deployment_id, entries):
+        """
+        Creates the objects for a batch of entries of this service. The
+        default implementation calls create_storage_row for every entry;
+        services can override it to handle the batch at once.
+
+        :param deployment_id: The id of the deployment.
+        :type deployment_id: int
+        :param entries: The entries, as (data, timestamp) tuples.
+        :type entries: list[tuple]
+        :return: The instances of an IModel, in the order of the entries.
+        :rtype: list[IModel]
+        """
+        return [self.create_storage_row(deployment_id, data, timestamp)
+                for data, timestamp in entries]
+
+    def get_notification_levels_for(self, storage_rows):
+        """
+        Determines the notification levels for a batch of entries. The
+        default implementation calls get_notification_level for every
+        entry.
+
+        :param storage_rows: The entries to examine.
+        :type storage_rows: list[IModel]
+        :return: The notification levels, in the order of the entries.
+        :rtype: list[int]
+        """
+        return [self.get_notification_level(row) for row in storage_rows]
+
     @abstractmethod
     def get_ports_used(self):
         """
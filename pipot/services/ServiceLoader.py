@@ -1,6 +1,9 @@
+import hashlib
 import importlib
+import json
 import os
 import sys
+import threading
 
 from pipot.services.IService import IService
 import pipot.services as main
@@ -103,18 +106,39 @@ def get_class_instance(name, collector, config):
     :return: A class instance of the loaded class.
     :rtype: pipot.services.IService.IService
     """
+    cls = get_class(name)
+    try:
+        return cls(collector=collector, config=config)
+    except TypeError as e:
+        raise ServiceLoaderException('Validation of the imported file '
+                                     'failed: %s' % str(e))
+
+
+def get_class(name):
+    """
+    Gets the class of the given service (a service in this folder). Both
+    plain service files and service containers are supported.
+
+    :param name: The name of the service.
+    :type name: str
+    :return: The class of the service.
+    :rtype: class
+    """
     try:
         py_mod = importlib.import_module('.' + name, main.__name__)
+        if hasattr(py_mod, '__path__'):
+            # Service container; the class is in the module with the same name
+            py_mod = importlib.import_module(
+                '.' + name + '.' + name, main.__name__)
 
         if hasattr(py_mod, name):
-            class_inst = getattr(py_mod, name)(collector=collector,
-                                               config=config)
+            cls = getattr(py_mod, name)
         else:
             raise ServiceLoaderException('There is no class named %s '
                                          'present in the file' % name)
 
-        if isinstance(class_inst, IService):
-            return class_inst
+        if isinstance(cls, type) and issubclass(cls, IService):
+            return cls
     except TabError as e:
         raise ServiceLoaderException('Tab error: %s' % str(e))
     except TypeError as e:
@@ -126,3 +150,116 @@ def get_class_instance(name, collector, config):
 
     raise ServiceLoaderException('File does not contain a valid IService  '
                                  'implementation')
+
+
+def get_config_hash(config):
+    """
+    Calculates a stable hash for a service configuration.
+
+    :param config: The configuration for a service.
+    :type config: dict
+    :return: The hex digest of the configuration.
+    :rtype: str
+    """
+    return hashlib.sha1(
+        json.dumps(config, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class ServiceRegistry(object):
+    """
+    Resolves service classes once, and caches service instances per
+    service name and configuration, so they can be reused for every
+    processed entry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._classes = {}
+        self._instances = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_instance(self, name, collector, config):
+        """
+        Gets a (shared) instance of the given service for the given
+        configuration.
+
+        :param name: The name of the service.
+        :type name: str
+        :param collector: The collector the instance is bound to.
+        :type collector: serverCollector.ICollector
+        :param config: The configuration for this service
+        :type config: dict
+        :return: An instance of the service.
+        :rtype: pipot.services.IService.IService
+        """
+        key = (name, get_config_hash(config), id(collector))
+        instance = self._instances.get(key, None)
+        if instance is not None:
+            self.hits += 1
+            return instance
+        self.misses += 1
+        with self._lock:
+            cls = self._classes.get(name, None)
+            if cls is None:
+                cls = get_class(name)
+                self._classes[name] = cls
+            try:
+                instance = cls(collector=collector, config=config)
+            except TypeError as e:
+                raise ServiceLoaderException('Validation of the imported '
+                                             'file failed: %s' % str(e))
+            self._instances[key] = instance
+        return instance
+
+    def invalidate(self, name=None, reload_modules=False):
+        """
+        Forgets the class and instances of a service, or of all services.
+
+        :param name: The name of the service, or None for all services.
+        :type name: str
+        :param reload_modules: Also unload the modules of the services, so
+            the next lookup imports the code from disk again. Only needed
+            in processes that don't reload the modules themselves (i.e.
+            the collector).
+        :type reload_modules: bool
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            names = list(self._classes.keys()) if name is None else [name]
+            for key in list(self._instances.keys()):
+                if name is None or key[0] == name:
+                    del self._instances[key]
+            for service_name in names:
+                self._classes.pop(service_name, None)
+                if reload_modules:
+                    _unload_modules(service_name)
+
+
+def _unload_modules(name):
+    """
+    Removes the modules of a service from sys.modules, and the tables they
+    declared from the metadata, so the service can be imported again.
+
+    :param name: The name of the service.
+    :type name: str
+    :return: None
+    :rtype: None
+    """
+    from database import Base
+    prefix = main.__name__ + '.' + name
+    for mod_name in list(sys.modules.keys()):
+        if mod_name != prefix and not mod_name.startswith(prefix + '.'):
+            continue
+        py_mod = sys.modules.pop(mod_name)
+        if py_mod is None:
+            continue
+        for value in list(vars(py_mod).values()):
+            table = getattr(value, '__table__', None)
+            if getattr(value, '__module__', None) == mod_name and \
+                    table is not None and table in Base.metadata:
+                Base.metadata.remove(table)
+
+
+registry = ServiceRegistry()
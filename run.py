@@ -1,11 +1,14 @@
+import logging
 import os
 import traceback
 
 import sys
 
 from flask import Flask, g
+
+import log_sink
 from config_parser import parse_config
-from database import create_session
+from database import bootstrap, create_session, init_engine
 from decorators import template_renderer
 from mod_auth.controllers import mod_auth
 from mod_config.controllers import mod_config
@@ -16,6 +19,12 @@ from mod_support.controllers import mod_support
 app = Flask(__name__)
 config = parse_config('config')
 app.config.from_mapping(config)
+log_sink.configure(config, 'pipot-web')
+logger = logging.getLogger(__name__)
+# One engine (and connection pool) for all requests of this process; the
+# tables that don't exist yet are created once, at startup
+init_engine(app.config['DATABASE_URI'], config)
+bootstrap(app.config['DATABASE_URI'])
 try:
     app.config['DEBUG'] = os.environ['DEBUG']
 except KeyError:
@@ -81,8 +90,7 @@ def not_found(error):
 @app.errorhandler(500)
 @template_renderer('500.html', 500)
 def internal_error(error):
-    print(error)
-    traceback.print_exc()
+    logger.error('Internal error: %s', error, exc_info=True)
     return
 
 
@@ -1,18 +1,39 @@
+import collections
 import hashlib
 import hmac
 import json
+import logging
+import time
+import zlib
 
 import datetime
 from abc import ABCMeta, abstractmethod
 
-from twisted.internet import protocol
+from sqlalchemy.exc import SQLAlchemyError
+from twisted.application import service
+from twisted.internet import protocol, task, threads
 
-from mod_config.models import Rule, Actions
-from mod_honeypot.models import PiPotReport, Deployment
+from collector import wire
+from collector.buffer import WriteBehindBuffer
+from collector.cache import DeploymentCache, CacheVersionWatcher
+from collector.dedup import DuplicateFilter
+from collector.dispatch import NotificationDispatcher
+from collector.framing import FrameDecoder, FrameError
+from collector.ingest import IngestPipeline
+from collector.metrics import MetricsRegistry
+from collector.prefilter import KnownInstances, PreFilter
+from collector.ratelimit import LoadShedder
+from collector.rollup import PIPOT_LEVEL, get_cell, write_counts
+from collector.spool import Spool, SpoolDrainer
+from collector.udp import get_socket_drops, set_receive_buffer
+from collector.rules import RuleEngine
+from mod_honeypot.models import PiPotReport
 from pipot.encryption import Encryption
 from pipot.notifications import NotificationLoader
 from pipot.services import ServiceLoader
 
+logger = logging.getLogger(__name__)
+
 
 class ICollector:
     """
@@ -51,161 +72,918 @@ class ICollector:
 
 
 class ServerCollector(ICollector):
-    def __init__(self, db):
+    def __init__(self, db, config=None):
         super(ServerCollector, self).__init__()
+        if config is None:
+            config = {}
         self.db = db
+        self.metrics = MetricsRegistry()
+        self._create_metrics()
+        self.buffer = WriteBehindBuffer(
+            db,
+            config.get('COLLECTOR_FLUSH_ROWS', 500),
+            config.get('COLLECTOR_FLUSH_INTERVAL', 1.0),
+            lambda rows, duration: self.stage_latency.labels('db').observe(
+                duration),
+            write_counts,
+            config.get('COLLECTOR_BUFFER_MAX_ROWS', 100000)
+        )
+        self.deployments = DeploymentCache(
+            db, config.get('COLLECTOR_UNKNOWN_CACHE_TIME', 10.0))
+        self.dispatcher = NotificationDispatcher(
+            NotificationLoader.pool.get,
+            config.get('COLLECTOR_NOTIFY_QUEUE_SIZE', 1000),
+            config.get('COLLECTOR_NOTIFY_CONCURRENCY', 1),
+            config.get('COLLECTOR_NOTIFY_TIMEOUT', 10.0),
+            config.get('COLLECTOR_NOTIFY_FAILURES', 5),
+            config.get('COLLECTOR_NOTIFY_RETRY', 30.0),
+            NotificationLoader.pool.release,
+            lambda name, duration: self.notify_latency.labels(
+                name).observe(duration)
+        )
+        self.rules = RuleEngine(db)
+        # Per deployment rate limit; disabled when no rate is configured
+        self.shedder = None
+        if config.get('COLLECTOR_RATE_LIMIT', 0) > 0:
+            self.shedder = LoadShedder(
+                config['COLLECTOR_RATE_LIMIT'],
+                config.get('COLLECTOR_RATE_BURST',
+                           config['COLLECTOR_RATE_LIMIT'])
+            )
+        # Batches that carry a nonce are processed once, even when the
+        # client retransmits them; disabled when the window is 0
+        self.dedup = None
+        if config.get('COLLECTOR_DEDUP_WINDOW', 1024) > 0:
+            self.dedup = DuplicateFilter(
+                config.get('COLLECTOR_DEDUP_WINDOW', 1024))
+        # Optional on-disk spool between authentication and storage, so
+        # messages survive a slow or unavailable database
+        self.spool = None
+        self.drainer = None
+        if config.get('COLLECTOR_SPOOL_DIR', None) is not None:
+            self.spool = Spool(
+                config['COLLECTOR_SPOOL_DIR'],
+                config.get('COLLECTOR_SPOOL_SEGMENT_SIZE', 64 * 1024 * 1024),
+                config.get('COLLECTOR_SPOOL_SYNC_RECORDS', 1000),
+                config.get('COLLECTOR_SPOOL_SYNC_INTERVAL', 0.1)
+            )
+            self.drainer = SpoolDrainer(
+                self.spool, self._replay, self._flush_replayed,
+                config.get('COLLECTOR_FLUSH_ROWS', 500)
+            )
+        # UDP sockets whose kernel drops are reported
+        self._udp_sockets = set()
+        # Drops garbage before it's queued, without querying the database
+        self.known = KnownInstances(db)
+        self.prefilter = PreFilter(
+            self.known,
+            config.get('COLLECTOR_UNKNOWN_RATE', 1.0),
+            config.get('COLLECTOR_UNKNOWN_BURST', 5),
+            config.get('COLLECTOR_UNKNOWN_TOTAL_RATE', 10.0),
+            config.get('COLLECTOR_UNKNOWN_TOTAL_BURST', 20)
+        )
+        # Received messages are processed by a pool of worker threads
+        self.ingest = IngestPipeline(
+            self.process_data,
+            config.get('COLLECTOR_INGEST_WORKERS', 4),
+            config.get('COLLECTOR_INGEST_QUEUE_SIZE', 10000),
+            db
+        )
+        # Picks up configuration changes made through the web application
+        self.watcher = CacheVersionWatcher(db)
+        self.watcher.register('deployment', self.deployments.invalidate)
+        self.watcher.register('deployment', self.known.reload)
+        self.watcher.register('rule', self.rules.invalidate)
+        # Notifiers for configurations that are no longer used are closed
+        self.watcher.register('rule', self._retire_notifiers)
+        self.watcher.register('service', self._reload_services)
+        self.watcher.register('notification', self._reload_notifications)
+        self._register_statistics()
+
+    @staticmethod
+    def _reload_services():
+        # The code of a service changed, so the modules need to be imported
+        # again as well.
+        ServiceLoader.registry.invalidate(reload_modules=True)
+
+    def _reload_notifications(self):
+        # The code of a notifier changed: new messages go through new
+        # instances, and the old ones are closed once their lanes are done
+        self.dispatcher.retain(set())
+        NotificationLoader.pool.invalidate(reload_modules=True)
+
+    def _retire_notifiers(self):
+        try:
+            notifiers = self.rules.get_notifiers()
+        except SQLAlchemyError as e:
+            logger.error('Could not load the rules: %s', e)
+            return
+        self.dispatcher.retain(notifiers)
+
+    def _create_metrics(self):
+        self.received = self.metrics.counter(
+            'pipot_collector_messages_received_total',
+            'Messages received by the collector.')
+        self.rejected = self.metrics.counter(
+            'pipot_collector_messages_rejected_total',
+            'Messages that were discarded, by reason.', ['reason'])
+        self.prefiltered = self.metrics.counter(
+            'pipot_collector_messages_prefiltered_total',
+            'Messages that were discarded before processing, by reason.',
+            ['reason'])
+        self.duplicates = self.metrics.counter(
+            'pipot_collector_duplicates_suppressed_total',
+            'Retransmitted batches that were suppressed, by deployment.',
+            ['deployment'])
+        self.entries = self.metrics.counter(
+            'pipot_collector_entries_total',
+            'Entries of authentic messages, by service, deployment and '
+            'outcome (stored, dropped by the rules or shed).',
+            ['service', 'deployment', 'outcome'])
+        self.stage_latency = self.metrics.histogram(
+            'pipot_collector_stage_seconds',
+            'Time spent per processing stage (decode, decrypt, hmac; '
+            'rules per service batch; db per flush).', ['stage'])
+        self.notify_latency = self.metrics.histogram(
+            'pipot_collector_notify_seconds',
+            'Time a notifier took to send a notification, by notifier.',
+            ['notifier'], (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
+    def _register_statistics(self):
+        """
+        Exposes the statistics kept by the collector's components.
+
+        :return: None
+        :rtype: None
+        """
+        ingest = self.ingest
+        buffer = self.buffer
+        dispatcher = self.dispatcher
+        self.metrics.callback(
+            'pipot_collector_ingest_queue_depth',
+            'Messages waiting for an ingest worker.', 'gauge',
+            ingest.queue_depth)
+        self.metrics.callback(
+            'pipot_collector_ingest_messages_total',
+            'Messages handled by the ingest workers, by result.', 'counter',
+            lambda: {'processed': ingest.processed, 'errors': ingest.errors,
+                     'dropped': ingest.dropped}, ['result'])
+        self.metrics.callback(
+            'pipot_collector_buffer_rows',
+            'Rows waiting in the write-behind buffer.', 'gauge',
+            lambda: len(buffer))
+        self.metrics.callback(
+            'pipot_collector_rows_written_total',
+            'Rows written to the database.', 'counter',
+            lambda: buffer.rows_written)
+        self.metrics.callback(
+            'pipot_collector_rows_dropped_total',
+            'Rows that were not written to the database, by reason.',
+            'counter',
+            lambda: {'refused': buffer.rows_refused,
+                     'overflow': buffer.rows_overflowed}, ['reason'])
+        self.metrics.callback(
+            'pipot_collector_udp_kernel_drops_total',
+            'Datagrams the kernel dropped because the receive buffer of the '
+            'socket was full.', 'counter', self.get_kernel_drops)
+        if self.spool is not None:
+            self.metrics.callback(
+                'pipot_collector_spool_backlog_bytes',
+                'Spooled data that is not in the database yet.', 'gauge',
+                self.spool.backlog)
+        self.metrics.callback(
+            'pipot_collector_notify_queue_depth',
+            'Notifications waiting to be sent.', 'gauge',
+            dispatcher.queue_depth)
+        self.metrics.callback(
+            'pipot_collector_notifications_total',
+            'Notifications that were sent, by result.', 'counter',
+            lambda: {
+                'sent': dispatcher.dispatched - dispatcher.failed -
+                dispatcher.timed_out,
+                'failed': dispatcher.failed,
+                'timed_out': dispatcher.timed_out
+            }, ['result'])
+        self.metrics.callback(
+            'pipot_collector_notifications_dropped_total',
+            'Notifications that were dropped, by reason.', 'counter',
+            lambda: dict(dispatcher.dropped), ['reason'])
+        caches = {
+            'deployment': self.deployments,
+            'service': ServiceLoader.registry,
+            'notifier': NotificationLoader.pool
+        }
+        self.metrics.callback(
+            'pipot_collector_cache_hits_total',
+            'Cache hits, by cache.', 'counter',
+            lambda: dict((name, c.hits) for name, c in caches.items()),
+            ['cache'])
+        self.metrics.callback(
+            'pipot_collector_cache_misses_total',
+            'Cache misses, by cache.', 'counter',
+            lambda: dict((name, c.misses) for name, c in caches.items()),
+            ['cache'])
 
     def queue_data(self, service_name, data):
         pass
 
+    def _replay(self, payload):
+        """
+        Processes a record from the spool.
+
+        :param payload: The spooled record.
+        :type payload: bytes
+        :return: None
+        :rtype: None
+        """
+        record = json.loads(payload.decode('utf-8'))
+        honeypot = self.deployments.get(record['instance'])
+        if honeypot is None:
+            logger.warning('Spooled message of removed deployment (%s); '
+                           'discarding', record['instance'])
+            return
+        self.process_content(honeypot, record['content'])
+
+    def _flush_replayed(self):
+        self.buffer.flush()
+        return len(self.buffer) == 0
+
+    def receive(self, data, source=None):
+        """
+        Hands a received message over to the ingest workers, which will
+        process it, unless the pre-filter drops it. Called from the reactor
+        thread.
+
+        :param data: A JSONified version of the data.
+        :type data: str
+        :param source: The address the message came from.
+        :type source: str
+        :return: None
+        :rtype: None
+        """
+        reason = self.prefilter.check(data, source)
+        if reason is not None:
+            self.discard(reason)
+            return
+        if not self.ingest.submit(data):
+            logger.warning('Ingest queue is full; discarding message',
+                           extra={'category': 'rejected'})
+
+    def receive_batch(self, messages):
+        """
+        Hands a batch of received messages over to the ingest workers as a
+        single unit, after dropping the ones the pre-filter rejects. Called
+        from the reactor thread.
+
+        :param messages: The messages, as (data, source address) tuples.
+        :type messages: list[tuple]
+        :return: None
+        :rtype: None
+        """
+        batch = []
+        for data, source in messages:
+            reason = self.prefilter.check(data, source)
+            if reason is not None:
+                self.discard(reason)
+            else:
+                batch.append(data)
+        if len(batch) > 0 and not self.ingest.submit_batch(batch):
+            logger.warning('Ingest queue is full; discarding %s messages',
+                           len(batch), extra={'category': 'rejected'})
+
+    def watch_socket(self, fileno):
+        """
+        Adds a UDP socket to the ones whose kernel drops are reported.
+
+        :param fileno: The file descriptor of the socket.
+        :type fileno: int
+        :return: None
+        :rtype: None
+        """
+        self._udp_sockets.add(fileno)
+
+    def unwatch_socket(self, fileno):
+        self._udp_sockets.discard(fileno)
+
+    def get_kernel_drops(self):
+        """
+        Gets the amount of datagrams the kernel dropped on the watched UDP
+        sockets, because the reactor didn't read them fast enough.
+
+        :return: The amount of dropped datagrams.
+        :rtype: int
+        """
+        total = 0
+        for fileno in list(self._udp_sockets):
+            total += get_socket_drops(fileno) or 0
+        return total
+
+    def discard(self, reason):
+        """
+        Counts a message that was dropped before processing. Called from
+        the reactor thread.
+
+        :param reason: Why the message was dropped.
+        :type reason: str
+        :return: None
+        :rtype: None
+        """
+        self.prefiltered.labels(reason).inc()
+        logger.debug('Message dropped by the pre-filter (%s)', reason,
+                     extra={'category': 'rejected'})
+
     def process_data(self, data):
-        print("Received a message: %s" % data)
+        logger.debug('Received a message: %s', data,
+                     extra={'category': 'received'})
+        self.received.inc()
+        start = time.time()
+        if wire.is_envelope(data):
+            result = self._open_envelope(data, start)
+        else:
+            result = self._open_json(data, start)
+        if result is None:
+            return
+        honeypot, content = result
+        logger.debug('Data authenticated; processing')
+        if self.spool is not None:
+            # Stored on disk first; the drainer replays it into the database
+            self.spool.append(json.dumps({
+                'instance': honeypot.instance_key,
+                'content': content
+            }).encode('utf-8'))
+        else:
+            self.process_content(honeypot, content)
+
+    def _reject(self, reason, message, *args):
+        logger.warning(message, *args, extra={'category': 'rejected'})
+        self.rejected.labels(reason).inc()
+
+    def _open_json(self, data, start):
+        """
+        Decrypts and authenticates a message in the JSON format, which
+        carries the encrypted payload in base64.
+
+        :param data: The received message.
+        :type data: str
+        :param start: The time the processing started.
+        :type start: float
+        :return: The deployment and the authenticated content, or None if
+            the message was rejected.
+        :rtype: tuple
+        """
         # Attempt to deserialize the data
         try:
             data = json.loads(data)
         except ValueError:
-            print('Message not valid JSON; discarding')
-            return
+            self._reject('invalid_json', 'Message not valid JSON; discarding')
+            return None
         # Check if JSON contains the two required fields
         if 'data' not in data or 'instance' not in data:
-            print('Invalid JSON (information missing; discarding)')
-            return
-        """:type : mod_honeypot.models.Deployment"""
-        honeypot = Deployment.query.filter(
-            Deployment.instance_key == data['instance']).first()
-        if honeypot is not None:
-            # Attempt to decrypt content
-            decrypted = Encryption.decrypt(honeypot.encryption_key,
-                                           data['data'])
+            self._reject('missing_fields',
+                         'Invalid JSON (information missing; discarding)')
+            return None
+        """:type : collector.cache.DeploymentRecord"""
+        honeypot = self.deployments.get(data['instance'])
+        start = self.stage_latency.labels('decode').time(start)
+        if honeypot is None:
+            self._reject('unknown_instance',
+                         'Unknown honeypot instance (%s); discarding',
+                         data['instance'])
+            return None
+        # Attempt to decrypt content. A nonce next to the data isn't
+        # authenticated, so only the one in the payload counts.
+        decrypted = Encryption.decrypt(honeypot.encryption_key, data['data'])
+        return self._verify_payload(honeypot, decrypted, start)
+
+    def _open_envelope(self, data, start):
+        """
+        Decrypts and authenticates a message in the binary format.
+
+        :param data: The received message.
+        :type data: bytes
+        :param start: The time the processing started.
+        :type start: float
+        :return: The deployment and the authenticated content, or None if
+            the message was rejected.
+        :rtype: tuple
+        """
+        try:
+            envelope = wire.decode_envelope(data)
+        except wire.WireError as e:
+            self._reject('invalid_envelope', 'Invalid envelope (%s); '
+                         'discarding', e.value)
+            return None
+        honeypot = self.deployments.get(envelope.instance)
+        start = self.stage_latency.labels('decode').time(start)
+        if honeypot is None:
+            self._reject('unknown_instance',
+                         'Unknown honeypot instance (%s); discarding',
+                         envelope.instance)
+            return None
+        if envelope.nonce is None or envelope.version < 2:
+            # Version 1 doesn't authenticate the nonce of the envelope, so
+            # only the one in the payload counts
+            return self._authenticate(honeypot, envelope, data, start)
+        # Known duplicates are dropped before decryption; the nonce is
+        # only recorded once the batch (and with it the nonce) turned out
+        # to be authentic
+        if self._is_duplicate(honeypot, envelope.nonce, False):
+            return None
+        result = self._authenticate(honeypot, envelope, data, start)
+        if result is not None and \
+                self._is_duplicate(honeypot, envelope.nonce, True):
+            return None
+        return result
+
+    def _is_duplicate(self, honeypot, nonce, record):
+        """
+        Checks if a batch was processed before, and counts it if so.
+
+        :param honeypot: The deployment that sent the batch.
+        :type honeypot: collector.cache.DeploymentRecord
+        :param nonce: The nonce of the batch.
+        :type nonce: bytes
+        :param record: Record the nonce, which should only be done for
+            authentic batches.
+        :type record: bool
+        :return: True if the batch is a duplicate.
+        :rtype: bool
+        """
+        if self.dedup is None:
+            return False
+        if record:
+            duplicate = not self.dedup.add(honeypot.instance_key, nonce)
+        else:
+            duplicate = self.dedup.seen(honeypot.instance_key, nonce)
+        if duplicate:
+            self.duplicates.labels(honeypot.id).inc()
+            self._reject('duplicate', 'Duplicate batch of %s; discarding',
+                         honeypot.instance_key)
+        return duplicate
+
+    def _authenticate(self, honeypot, envelope, data, start):
+        """
+        Decrypts and authenticates the body of an envelope.
+
+        :param honeypot: The deployment that sent the message.
+        :type honeypot: collector.cache.DeploymentRecord
+        :param envelope: The envelope of the message.
+        :type envelope: collector.wire.Envelope
+        :param data: The received message.
+        :type data: bytes
+        :param start: The time the processing started.
+        :type start: float
+        :return: The deployment and the authenticated content, or None if
+            the message was rejected.
+        :rtype: tuple
+        """
+        if envelope.version >= 3:
+            # AES-GCM: authentication and decryption in a single pass
+            body = Encryption.decrypt_gcm(
+                honeypot.encryption_key, envelope.body,
+                wire.get_header(data, envelope))
+            self.stage_latency.labels('decrypt').time(start)
+            if body is None:
+                self._reject('auth_failed',
+                             'Message not authentic; discarding')
+                return None
+            return self._parse_content(honeypot, envelope, body)
+        decrypted = Encryption.decrypt_raw(honeypot.encryption_key,
+                                           envelope.body)
+        if envelope.version >= 2:
+            return self._verify_signed(honeypot, envelope, decrypted, start)
+        if envelope.flags & wire.FLAG_COMPRESSED:
             try:
-                decrypted_data = json.loads(decrypted)
-            except ValueError:
-                print('Decrypted data is not JSON; discarding')
-                return
-            if 'hmac' not in decrypted_data or \
-                    'content' not in decrypted_data:
-                print('Decrypted data misses info; discarding')
-                return
-            # Verify message authenticity
-            mac = hmac.new(
-                str(honeypot.mac_key),
-                str(json.dumps(decrypted_data['content'], sort_keys=True)),
-                hashlib.sha256
-            ).hexdigest()
+                decrypted = zlib.decompress(decrypted)
+            except zlib.error:
+                self._reject('undecryptable',
+                             'Could not decompress payload; discarding')
+                return None
+        return self._verify_payload(honeypot, decrypted, start)
+
+    def _verify_signed(self, honeypot, envelope, decrypted, start):
+        """
+        Verifies the MAC over the exact content bytes of a decrypted
+        payload (preceded by the nonce of the envelope, if any), and only
+        parses the content if it's authentic.
+
+        :param honeypot: The deployment that sent the message.
+        :type honeypot: collector.cache.DeploymentRecord
+        :param envelope: The envelope of the message.
+        :type envelope: collector.wire.Envelope
+        :param decrypted: The decrypted payload (MAC and content).
+        :type decrypted: bytes
+        :param start: The time the decryption started.
+        :type start: float
+        :return: The deployment and the authenticated content, or None if
+            the message was rejected.
+        :rtype: tuple
+        """
+        mac, body = decrypted[:wire.MAC_SIZE], decrypted[wire.MAC_SIZE:]
+        start = self.stage_latency.labels('decrypt').time(start)
+        expected = hmac.new(honeypot.mac_key.encode('utf8'),
+                            (envelope.nonce or b'') + body,
+                            hashlib.sha256).digest()
+        authentic = len(mac) == wire.MAC_SIZE and \
+            hmac.compare_digest(mac, expected)
+        self.stage_latency.labels('hmac').time(start)
+        if not authentic:
+            self._reject('hmac_failed', 'Message not authentic; discarding')
+            return None
+        return self._parse_content(honeypot, envelope, body)
+
+    def _parse_content(self, honeypot, envelope, body):
+        """
+        Parses the authenticated content bytes of an envelope.
+
+        :param honeypot: The deployment that sent the message.
+        :type honeypot: collector.cache.DeploymentRecord
+        :param envelope: The envelope of the message.
+        :type envelope: collector.wire.Envelope
+        :param body: The authenticated content bytes.
+        :type body: bytes
+        :return: The deployment and the content, or None if the content
+            is invalid.
+        :rtype: tuple
+        """
+        if envelope.flags & wire.FLAG_COMPRESSED:
+            try:
+                body = zlib.decompress(body)
+            except zlib.error:
+                self._reject('invalid_content',
+                             'Could not decompress content; discarding')
+                return None
+        try:
+            content = json.loads(body.decode('utf8'))
+        except ValueError:
+            content = None
+        if not isinstance(content, list):
+            self._reject('invalid_content',
+                         'Content is not a list of entries; discarding')
+            return None
+        return honeypot, content
+
+    def _verify_payload(self, honeypot, decrypted, start):
+        """
+        Parses a decrypted payload (content, hmac and optionally a nonce),
+        and verifies the authenticity of the content. If there's a nonce,
+        the hmac covers it as well, and a batch with a known nonce is
+        dropped as a duplicate.
+
+        :param honeypot: The deployment that sent the message.
+        :type honeypot: collector.cache.DeploymentRecord
+        :param decrypted: The decrypted payload.
+        :type decrypted: bytes
+        :param start: The time the decryption started.
+        :type start: float
+        :return: The deployment and the authenticated content, or None if
+            the message was rejected.
+        :rtype: tuple
+        """
+        try:
+            decrypted_data = json.loads(decrypted)
+        except ValueError:
+            self._reject('undecryptable',
+                         'Decrypted data is not JSON; discarding')
+            return None
+        if 'hmac' not in decrypted_data or 'content' not in decrypted_data:
+            self._reject('missing_fields',
+                         'Decrypted data misses info; discarding')
+            return None
+        start = self.stage_latency.labels('decrypt').time(start)
+        # Verify message authenticity
+        nonce = decrypted_data.get('nonce', None)
+        signed = decrypted_data['content']
+        if nonce is not None:
+            signed = {'content': signed, 'nonce': nonce}
+        mac = hmac.new(
+            honeypot.mac_key.encode('utf8'),
+            json.dumps(signed, sort_keys=True).encode('utf8'),
+            hashlib.sha256
+        ).hexdigest()
+        try:
+            authentic = hmac.compare_digest(
+                mac.encode('utf8'), decrypted_data['hmac'].encode('utf8'))
+        except AttributeError:
+            # Older python version? Fallback which is less safe
+            authentic = mac == decrypted_data['hmac']
+        self.stage_latency.labels('hmac').time(start)
+        if not authentic:
+            self._reject('hmac_failed', 'Message not authentic; discarding')
+            logger.debug('Payload: %s',
+                         json.dumps(decrypted_data['content']),
+                         extra={'category': 'received'})
+            return None
+        if nonce is not None and self._is_duplicate(
+                honeypot, json.dumps(nonce, sort_keys=True), True):
+            return None
+        return honeypot, decrypted_data['content']
+
+    def process_content(self, honeypot, content):
+        """
+        Processes the entries of an authenticated message.
+
+        :param honeypot: The deployment that sent the message.
+        :type honeypot: collector.cache.DeploymentRecord
+        :param content: The entries of the message.
+        :type content: list[dict]
+        :return: None
+        :rtype: None
+        """
+        rows = []
+        # The rollup cell of each row
+        cells = []
+        # Entries of the services of the profile, grouped per service
+        batches = collections.OrderedDict()
+        deployment = honeypot.id
+        for entry in content:
+            # Entry exists out of timestamp, service & data elements
+            timestamp = datetime.datetime.utcnow()
             try:
-                authentic = hmac.compare_digest(
-                    mac, decrypted_data['hmac'].encode('utf8'))
-            except AttributeError:
-                # Older python version? Fallback which is less safe
-                authentic = mac == decrypted_data['hmac']
-
-            if authentic:
-                print('Data authenticated; processing')
-                # Determine service
-                for entry in decrypted_data['content']:
-                    # Entry exists out of timestamp, service & data elements
-                    timestamp = datetime.datetime.utcnow()
-                    try:
-                        timestamp = datetime.datetime.strptime(
-                            entry['timestamp'], '%Y-%m-%d %H:%M:%S')
-                    except ValueError:
-                        pass
-                    if entry['service'] == 'PiPot':
-                        # Store
-                        row = PiPotReport(honeypot.id, entry['data'],
-                                          timestamp)
-                        self.db.add(row)
-                        self.db.commit()
-                        print('Stored PiPot entry in the database')
-                    else:
-                        # Get active services through the deployment profile
-                        for p_service in honeypot.profile.services:
-                            if p_service.service.name != entry['service']:
-                                continue
-                            print('Valid service for profile: %s' %
-                                  entry['service'])
-                            # Valid service
-                            service = ServiceLoader.get_class_instance(
-                                entry['service'], self,
-                                p_service.get_service_config()
-                            )
-                            # Convert JSON back to object
-                            service_data = service.create_storage_row(
-                                honeypot.id, entry['data'], timestamp)
-                            notification_level = \
-                                service.get_notification_level(service_data)
-                            # Get rules that apply here
-                            rules = Rule.query.filter(
-                                Rule.service_id ==
-                                p_service.service_id
-                            ).order_by(Rule.level.asc())
-                            rule_parsed = False
-                            for rule in rules:
-                                if not rule.matches(notification_level):
-                                    continue
-                                # Process message according to rule
-                                notifier = \
-                                    NotificationLoader.get_class_instance(
-                                        rule.notification.name,
-                                        rule.get_notification_config()
-                                    )
-                                notifier.process(
-                                    service_data.get_message_for_level(
-                                        notification_level
-                                    )
-                                )
-                                if rule.action == Actions.drop:
-                                    rule_parsed = True
-                                    break
-                            if not rule_parsed:
-                                # Store in DB
-                                self.db.add(service_data)
-                                self.db.commit()
-                                print('Processed message; stored in DB')
-                            else:
-                                print('Processed message; dropping due to '
-                                      'rules')
-                        if len(honeypot.profile.services) == 0:
-                            print('There are no services configured for '
-                                  'this honeypot; discarding')
+                timestamp = datetime.datetime.strptime(
+                    entry['timestamp'], '%Y-%m-%d %H:%M:%S')
+            except ValueError:
+                pass
+            if entry['service'] == 'PiPot':
+                if self.shedder is not None:
+                    # Counts against the limit, but is never shed
+                    self.shedder.admit(
+                        honeypot.instance_key, None, [])
+                # Store
+                rows.append(PiPotReport(honeypot.id, entry['data'],
+                                        timestamp))
+                cells.append(get_cell(honeypot.id, 'PiPot', timestamp,
+                                      PIPOT_LEVEL))
+                self.entries.labels(
+                    'PiPot', deployment, 'stored').inc()
+                logger.info('Queued PiPot entry for storage',
+                            extra={'category': 'stored'})
+            elif entry['service'] in honeypot.services:
+                batches.setdefault(entry['service'], []).append(
+                    (entry['data'], timestamp))
+            elif len(honeypot.services) == 0:
+                logger.warning('There are no services configured '
+                               'for this honeypot; discarding',
+                               extra={'category': 'rejected'})
+        for name, entries in batches.items():
+            rows.extend(self._process_batch(honeypot, name, entries, cells))
+        # Queue for storage in DB
+        self.buffer.extend(rows, cells)
+
+    def _process_batch(self, honeypot, name, entries, cells):
+        """
+        Processes the entries of a single service of an authenticated
+        message, and applies the rules to them.
+
+        :param honeypot: The deployment that sent the message.
+        :type honeypot: collector.cache.DeploymentRecord
+        :param name: The name of the service.
+        :type name: str
+        :param entries: The entries, as (data, timestamp) tuples.
+        :type entries: list[tuple]
+        :param cells: The list to add the rollup cells of the stored rows
+            to.
+        :type cells: list[tuple]
+        :return: The rows to store.
+        :rtype: list[pipot.services.IService.IModel]
+        """
+        deployment = honeypot.id
+        # Active service through the deployment profile
+        service_id, service_config = honeypot.services[name]
+        logger.debug('Valid service for profile: %s', name)
+        service = ServiceLoader.registry.get_instance(
+            name, self, service_config)
+        # Convert JSON back to objects
+        service_rows = service.create_storage_rows(honeypot.id, entries)
+        notification_levels = service.get_notification_levels_for(
+            service_rows)
+        rows = []
+        start = time.time()
+        for service_data, notification_level in zip(
+                service_rows, notification_levels):
+            if self.shedder is not None and \
+                    not self.shedder.admit(
+                        honeypot.instance_key,
+                        notification_level,
+                        service.get_notification_levels()):
+                logger.info('Deployment over its rate limit; '
+                            'shedding entry',
+                            extra={'category': 'shed'})
+                self.entries.labels(name, deployment, 'shed').inc()
+                continue
+            # Apply the rules for this level
+            decision = self.rules.evaluate(
+                service_id, service, notification_level)
+            if len(decision.notifications) > 0:
+                message = service_data.get_message_for_level(
+                    notification_level)
+                for notifier, config in decision.notifications:
+                    self.dispatcher.dispatch(notifier, config, message)
+            if not decision.drop:
+                rows.append(service_data)
+                cells.append(get_cell(deployment, name,
+                                      service_data.timestamp,
+                                      notification_level))
+                self.entries.labels(name, deployment, 'stored').inc()
+                logger.info('Processed message; queued for storage',
+                            extra={'category': 'stored'})
             else:
-                print('Message not authentic; discarding')
-                # print('Expected: %s, got %s' % (mac, decrypted_data[
-                # 'hmac']))
-                # print('Payload: %s' % json.dumps(decrypted_data['content']))
-        else:
-            print('Unknown honeypot instance (%s); discarding' %
-                  data['instance'])
+                self.entries.labels(name, deployment, 'dropped').inc()
+                logger.info('Processed message; dropping due to rules',
+                            extra={'category': 'dropped'})
+        self.stage_latency.labels('rules').time(start)
+        return rows
+
+
+class CollectorService(service.Service):
+    """
+    Twisted service that takes care of the periodic work of the collector,
+    and flushes any pending data when the reactor shuts down.
+    """
+
+    def __init__(self, collector, interval=0.5, poll_interval=5.0,
+                 pruner=None, prune_interval=3600.0):
+        """
+        Creates the service.
+
+        :param collector: The collector to maintain.
+        :type collector: ServerCollector
+        :param interval: How often (in seconds) the buffer gets checked.
+        :type interval: float
+        :param poll_interval: How often (in seconds) the cache versions are
+            checked for configuration changes.
+        :type poll_interval: float
+        :param pruner: Removes expired reports; None keeps them.
+        :type pruner: collector.retention.ReportPruner
+        :param prune_interval: How often (in seconds) expired reports are
+            removed.
+        :type prune_interval: float
+        """
+        self.collector = collector
+        self.pruner = pruner
+        self._loops = [
+            (task.LoopingCall(
+                threads.deferToThread, collector.watcher.poll),
+             poll_interval)
+        ]
+        if collector.drainer is None:
+            # Flushes are database work, which stays out of the reactor.
+            # With a spool, the drainer takes care of the flushes, as it
+            # has to know when its rows are written.
+            self._loops.append((task.LoopingCall(
+                threads.deferToThread, collector.buffer.tick), interval))
+        if pruner is not None:
+            self._loops.append((task.LoopingCall(
+                threads.deferToThread, pruner.run), prune_interval))
+
+    def startService(self):
+        service.Service.startService(self)
+        # Until this finished, the pre-filter lets all instance keys pass
+        threads.deferToThread(self.collector.known.reload)
+        if self.collector.drainer is not None:
+            self.collector.drainer.start()
+        self.collector.ingest.start()
+        for loop, interval in self._loops:
+            loop.start(interval)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for loop, interval in self._loops:
+            if loop.running:
+                loop.stop()
+        if self.pruner is not None:
+            self.pruner.stop()
+        self.collector.ingest.stop()
+        if self.collector.drainer is not None:
+            self.collector.drainer.stop()
+            self.collector.spool.close()
+        self.collector.buffer.flush()
+        self.collector.dispatcher.stop()
+        NotificationLoader.pool.close_all()
 
 
 class SSLCollector(protocol.Protocol):
     def __init__(self, factory):
         self.factory = factory
+        self._decoder = FrameDecoder(factory.max_frame_size)
+        self._peer = None
 
     def connectionMade(self):
-        pass
+        self._peer = getattr(self.transport.getPeer(), 'host', None)
 
     def connectionLost(self, reason=protocol.connectionDone):
-        pass
+        # Clients that send one message per connection don't terminate it
+        frame = self._decoder.flush()
+        if frame is not None:
+            self.process_frame(frame)
 
     def dataReceived(self, data):
+        try:
+            frames = self._decoder.feed(data)
+        except FrameError as e:
+            logger.warning('Invalid frame (%s); closing connection', e.value)
+            if 'collector' in self.factory.__dict__:
+                self.factory.collector.discard('invalid_frame')
+            self.transport.loseConnection()
+            return
+        for frame in frames:
+            self.process_frame(frame)
+
+    def process_frame(self, frame):
         if 'collector' in self.factory.__dict__:
-            self.factory.collector.process_data(data)
+            self.factory.collector.receive(frame, self._peer)
         else:
-            print('No collector present!')
+            logger.error('No collector present!')
 
 
 class SSLFactory(protocol.Factory):
-    def __init__(self, collector):
+    def __init__(self, collector, max_frame_size=65536):
         self.collector = collector
+        self.max_frame_size = max_frame_size
 
     def buildProtocol(self, addr):
         return SSLCollector(self)
 
 
 class UDPCollector(protocol.DatagramProtocol):
-    def __init__(self, collector):
+    """
+    Receives messages over UDP. Datagrams can be collected into batches of
+    up to batch_size datagrams (or batch_delay seconds), which are handed
+    to the ingest workers as a single unit, so the reactor gets back to
+    reading the socket sooner during a burst.
+    """
+
+    def __init__(self, collector, max_datagram_size=65536, batch_size=1,
+                 batch_delay=0.005, receive_buffer=0, clock=None):
+        """
+        Creates the protocol.
+
+        :param collector: The collector to hand the messages to.
+        :type collector: ServerCollector
+        :param max_datagram_size: The maximum size of a datagram, in bytes.
+        :type max_datagram_size: int
+        :param batch_size: The maximum amount of datagrams per batch; 1
+            hands every datagram over right away.
+        :type batch_size: int
+        :param batch_delay: The maximum time (in seconds) a datagram waits
+            for its batch to fill up.
+        :type batch_delay: float
+        :param receive_buffer: The size (in bytes) of the kernel receive
+            buffer of the socket; 0 keeps the system default.
+        :type receive_buffer: int
+        :param clock: The clock to schedule the batches with; the reactor
+            by default.
+        :type clock: twisted.internet.interfaces.IReactorTime
+        """
         self.collector = collector
+        self.max_datagram_size = max_datagram_size
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.receive_buffer = receive_buffer
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.clock = clock
+        self._batch = []
+        self._call = None
+        self._fileno = None
+
+    def startProtocol(self):
+        handle = self.transport.getHandle()
+        if self.receive_buffer > 0:
+            set_receive_buffer(handle, self.receive_buffer)
+        self._fileno = handle.fileno()
+        self.collector.watch_socket(self._fileno)
+
+    def stopProtocol(self):
+        self.flush()
+        if self._fileno is not None:
+            self.collector.unwatch_socket(self._fileno)
+            self._fileno = None
 
     def datagramReceived(self, data, addr):
-        self.collector.process_data(data)
+        if len(data) > self.max_datagram_size:
+            self.collector.discard('too_large')
+            return
+        if self.batch_size <= 1:
+            self.collector.receive(data, addr[0])
+            return
+        self._batch.append((data, addr[0]))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+        elif self._call is None:
+            self._call = self.clock.callLater(self.batch_delay, self.flush)
+
+    def flush(self):
+        """
+        Hands the current batch over to the collector.
+
+        :return: None
+        :rtype: None
+        """
+        if self._call is not None:
+            if self._call.active():
+                self._call.cancel()
+            self._call = None
+        if len(self._batch) > 0:
+            batch, self._batch = self._batch, []
+            self.collector.receive_batch(batch)
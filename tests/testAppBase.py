@@ -16,7 +16,7 @@ import tests.config
 import flask
 from flask import g, current_app, session
 from collections import namedtuple
-from database import create_session
+from database import bootstrap, create_session
 from mod_auth.models import User, Role, Page, PageAccess
 from mod_config.models import Service, Notification, Actions, Conditions, Rule
 from mod_honeypot.models import Profile, PiModels, PiPotReport, ProfileService, \
@@ -87,6 +87,7 @@ class TestAppBase(unittest.TestCase):
         if not os.path.exists(self.keydir):
             os.mkdir(self.keydir)
         self.app = self.create_app()
+        bootstrap(self.app.config['DATABASE_URI'])
         self.client = self.app.test_client(self)
 
     def tearDown(self):
@@ -0,0 +1,57 @@
+import os
+import socket
+import sys
+import unittest
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collector import workers
+
+
+class TestCollectorWorkers(unittest.TestCase):
+
+    def test_supervisor_runs_every_worker(self):
+        supervisor = workers.create_supervisor(3, '/tmp/pipot.tac', '/tmp')
+        self.assertEqual(sorted(supervisor.processes.keys()),
+                         ['collector-0', 'collector-1', 'collector-2'])
+        args, uid, gid, env = supervisor.processes['collector-2']
+        self.assertEqual(args[0], sys.executable)
+        self.assertEqual(args[-2:], ['--python', '/tmp/pipot.tac'])
+        self.assertEqual(env[workers.WORKER_ENV], '2')
+
+    def test_worker_index(self):
+        os.environ.pop(workers.WORKER_ENV, None)
+        self.assertIsNone(workers.get_worker_index())
+        os.environ[workers.WORKER_ENV] = '1'
+        try:
+            self.assertEqual(workers.get_worker_index(), 1)
+        finally:
+            del os.environ[workers.WORKER_ENV]
+
+    def test_worker_config_splits_the_limits(self):
+        config = {'COLLECTOR_RATE_LIMIT': 100, 'COLLECTOR_RATE_BURST': 1000,
+                  'COLLECTOR_SPOOL_DIR': '/tmp/spool'}
+        worker = workers.get_worker_config(config, 1, 4)
+        self.assertEqual(worker['COLLECTOR_RATE_LIMIT'], 25)
+        self.assertEqual(worker['COLLECTOR_RATE_BURST'], 250)
+        self.assertNotIn('COLLECTOR_UNKNOWN_TOTAL_RATE', worker)
+        self.assertEqual(worker['COLLECTOR_SPOOL_DIR'],
+                         os.path.join('/tmp/spool', 'worker-1'))
+        self.assertEqual(config['COLLECTOR_RATE_LIMIT'], 100)
+
+    @unittest.skipUnless(hasattr(socket, 'SO_REUSEPORT'),
+                         'SO_REUSEPORT not supported')
+    def test_workers_share_ports(self):
+        for socket_type in [socket.SOCK_DGRAM, socket.SOCK_STREAM]:
+            first = workers.reuse_port_socket(socket_type, '127.0.0.1', 0)
+            port = first.getsockname()[1]
+            second = workers.reuse_port_socket(
+                socket_type, '127.0.0.1', port)
+            self.assertEqual(second.getsockname()[1], port)
+            first.close()
+            second.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mock
+from sqlalchemy import Column, Integer, Table, Index
+
+import database
+import tests.config
+from mod_honeypot.models import Deployment, PiPotReport, Profile
+from pipot.services import ServiceModelsManager
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+service_dir = os.path.join(test_dir, '..', 'pipot', 'services',
+                           'TelnetService')
+
+
+class TestDatabase(unittest.TestCase):
+
+    def setUp(self):
+        database.init_engine(tests.config.DATABASE_URI)
+
+    def tearDown(self):
+        database.db_session.remove()
+
+    def test_sessions_share_the_engine(self):
+        engine = database.db_engine
+        first = database.create_session(tests.config.DATABASE_URI)
+        second = database.create_session(tests.config.DATABASE_URI)
+        self.assertIs(first, second)
+        self.assertIs(database.db_engine, engine)
+        self.assertIs(first.get_bind(), engine)
+
+    def test_session_does_not_create_tables(self):
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *ignored):
+            statements.append(statement)
+        from sqlalchemy import event
+        event.listen(database.db_engine, 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            database.create_session(tests.config.DATABASE_URI)
+        finally:
+            event.remove(database.db_engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(statements, [])
+
+    def test_pool_settings(self):
+        engine = database.init_engine(
+            'mysql+pymysql://user@localhost/pipot',
+            {'DATABASE_POOL_SIZE': 3, 'DATABASE_MAX_OVERFLOW': 2,
+             'DATABASE_POOL_RECYCLE': 60})
+        self.assertEqual(engine.pool.size(), 3)
+        self.assertEqual(engine.pool._max_overflow, 2)
+        self.assertEqual(engine.pool._recycle, 60)
+        self.assertTrue(engine.pool._pre_ping)
+
+    def test_read_replica_routing(self):
+        replica_dir = tempfile.mkdtemp()
+        database.init_engine(tests.config.DATABASE_URI, {
+            'DATABASE_READ_URI': 'sqlite:///%s' % os.path.join(
+                replica_dir, 'replica.db')})
+        tables = [Profile.__table__]
+        try:
+            for engine in [database.db_engine, database.read_engine]:
+                database.Base.metadata.create_all(bind=engine, tables=tables)
+            database.read_session.add(Profile('replica', 'test'))
+            database.read_session.commit()
+            database.read_session.remove()
+            self.assertEqual(Profile.query.count(), 0)
+            with database.read_replica() as session:
+                self.assertIs(session, database.read_session)
+                self.assertEqual(Profile.query.one().name, 'replica')
+                # Writes stay on the primary database
+                database.db_session.add(Profile('primary', 'test'))
+                database.db_session.commit()
+                self.assertEqual(Profile.query.count(), 1)
+
+            @database.read_replica()
+            def names():
+                return [p.name for p in Profile.query.order_by(Profile.id)]
+            self.assertEqual(names(), ['replica'])
+            self.assertEqual(Profile.query.one().name, 'primary')
+            database.db_session.rollback()
+        finally:
+            for engine in [database.db_engine, database.read_engine]:
+                database.Base.metadata.drop_all(bind=engine, tables=tables)
+            database.read_session.remove()
+            shutil.rmtree(replica_dir)
+
+    def test_read_replica_without_replica(self):
+        self.assertIsNone(database.read_session)
+        with database.read_replica() as session:
+            self.assertIs(session, database.db_session)
+
+    def test_report_tables_declare_indexes(self):
+        self.assertEqual(
+            sorted([c.name for c in index.columns]
+                   for index in PiPotReport.__table__.indexes),
+            [['deployment_id', 'timestamp'], ['timestamp']])
+        self.assertEqual(
+            [[c.name for c in index.columns]
+             for index in Deployment.__table__.indexes],
+            [['instance_key']])
+
+    def test_missing_indexes_are_reported_and_created(self):
+        engine = database.db_engine
+        table = Table('index_check', database.Base.metadata,
+                      Column('id', Integer, primary_key=True),
+                      Column('a', Integer), Column('b', Integer))
+        try:
+            table.create(bind=engine)
+            Index('ix_index_check_a_b', table.c.a, table.c.b)
+            Index('ix_index_check_id', table.c.id)
+            missing = database.check_indexes(engine, [table])
+            self.assertEqual([index.name for index in missing],
+                             ['ix_index_check_a_b'])
+            database.check_indexes(engine, [table], create=True)
+            self.assertEqual(
+                database.find_missing_indexes(engine, [table]), [])
+        finally:
+            table.drop(bind=engine)
+            database.Base.metadata.remove(table)
+
+    def test_bootstrap_checks_service_tables(self):
+        temp_dir = tempfile.mkdtemp()
+        models = os.path.join(temp_dir, 'models.txt')
+        with open(models, 'w') as f:
+            f.write('TelnetService.ReportTelnet\n')
+        shutil.copytree(os.path.join(test_dir, 'testFiles', 'TelnetService'),
+                        service_dir)
+        open(os.path.join(service_dir, '__init__.py'), 'w').close()
+        engine = database.db_engine
+        # A report table created by an older version, without indexes
+        engine.execute('CREATE TABLE report_telnet (id INTEGER PRIMARY KEY, '
+                       'timestamp DATETIME, deployment_id INTEGER, '
+                       'ip VARCHAR(46), port INTEGER, password VARCHAR(100))')
+        try:
+            with mock.patch.object(ServiceModelsManager, 'models_storage',
+                                   models):
+                database.bootstrap(tests.config.DATABASE_URI)
+                table = database.Base.metadata.tables['report_telnet']
+                self.assertEqual(
+                    sorted(index.name for index in
+                           database.find_missing_indexes(engine, [table])),
+                    ['ix_report_telnet_deployment_id_timestamp',
+                     'ix_report_telnet_ip_timestamp',
+                     'ix_report_telnet_timestamp'])
+                database.bootstrap(tests.config.DATABASE_URI,
+                                   create_indexes=True)
+                self.assertEqual(
+                    database.find_missing_indexes(engine, [table]), [])
+        finally:
+            database.Base.metadata.drop_all(bind=engine)
+            engine.execute('DROP TABLE IF EXISTS report_telnet')
+            table = database.Base.metadata.tables.get('report_telnet', None)
+            if table is not None:
+                database.Base.metadata.remove(table)
+            for name in list(sys.modules):
+                if name.startswith('pipot.services.TelnetService'):
+                    del sys.modules[name]
+            shutil.rmtree(service_dir)
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
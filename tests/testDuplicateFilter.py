@@ -0,0 +1,36 @@
+import os
+import sys
+import unittest
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collector.dedup import DuplicateFilter
+
+
+class TestDuplicateFilter(unittest.TestCase):
+
+    def test_detects_duplicates_per_deployment(self):
+        dedup = DuplicateFilter()
+        self.assertFalse(dedup.seen('a', b'1'))
+        self.assertTrue(dedup.add('a', b'1'))
+        self.assertTrue(dedup.seen('a', b'1'))
+        self.assertFalse(dedup.add('a', b'1'))
+        self.assertTrue(dedup.add('b', b'1'))
+
+    def test_window_is_bounded(self):
+        dedup = DuplicateFilter(window=2, max_deployments=2)
+        for nonce in [b'1', b'2', b'3']:
+            dedup.add('a', nonce)
+        self.assertFalse(dedup.seen('a', b'1'))
+        self.assertTrue(dedup.seen('a', b'3'))
+        dedup.add('b', b'1')
+        dedup.add('a', b'4')
+        dedup.add('c', b'1')
+        # The least recently seen deployment is forgotten
+        self.assertFalse(dedup.seen('b', b'1'))
+        self.assertTrue(dedup.seen('a', b'4'))
+
+
+if __name__ == '__main__':
+    unittest.main()
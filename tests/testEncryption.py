@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipot import encryption
+from pipot.encryption import Encryption
+
+
+class TestEncryption(unittest.TestCase):
+
+    key = 'k' * 32
+
+    def test_ctr_round_trip(self):
+        encrypted = Encryption.encrypt(self.key, b'content')
+        self.assertEqual(Encryption.decrypt(self.key, encrypted), b'content')
+        self.assertEqual(Encryption.decrypt(self.key, '!invalid'), '')
+
+    def test_gcm_round_trip(self):
+        encrypted = Encryption.encrypt_gcm(self.key, b'content', b'header')
+        self.assertEqual(
+            Encryption.decrypt_gcm(self.key, encrypted, b'header'),
+            b'content')
+
+    def test_gcm_rejects_tampering(self):
+        encrypted = Encryption.encrypt_gcm(self.key, b'content', b'header')
+        tampered = bytearray(encrypted)
+        tampered[-1] ^= 1
+        self.assertIsNone(
+            Encryption.decrypt_gcm(self.key, bytes(tampered), b'header'))
+        self.assertIsNone(
+            Encryption.decrypt_gcm(self.key, encrypted, b'other header'))
+        self.assertIsNone(
+            Encryption.decrypt_gcm('x' * 32, encrypted, b'header'))
+        self.assertIsNone(Encryption.decrypt_gcm(self.key, b'short'))
+        self.assertIsNone(Encryption.decrypt_gcm('bad key', encrypted))
+
+    def test_gcm_contexts_are_cached(self):
+        Encryption.encrypt_gcm(self.key, b'content')
+        context = encryption._gcm_contexts[self.key]
+        Encryption.encrypt_gcm(self.key, b'content')
+        self.assertIs(encryption._gcm_contexts[self.key], context)
+
+    def test_gcm_contexts_drop_least_recently_used(self):
+        maximum = encryption._gcm_contexts_max
+        encryption._gcm_contexts.clear()
+        encryption._gcm_contexts_max = 2
+        try:
+            for key in ['a' * 32, 'b' * 32, 'a' * 32, 'c' * 32]:
+                Encryption.encrypt_gcm(key, b'content')
+            self.assertEqual(list(encryption._gcm_contexts),
+                             ['a' * 32, 'c' * 32])
+        finally:
+            encryption._gcm_contexts_max = maximum
+
+
+if __name__ == '__main__':
+    unittest.main()
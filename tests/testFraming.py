@@ -0,0 +1,82 @@
+import os
+import struct
+import sys
+import unittest
+
+import mock
+from twisted.test import proto_helpers
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collector.framing import FrameDecoder, FrameError
+from serverCollector import SSLFactory
+
+
+class TestFraming(unittest.TestCase):
+
+    def test_newline_delimited_messages(self):
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(b'{"a": 1}\n{"b"'), [b'{"a": 1}'])
+        self.assertEqual(decoder.feed(b': 2}\r\n{"c": 3}\n'),
+                         [b'{"b": 2}', b'{"c": 3}'])
+        self.assertEqual(len(decoder), 0)
+
+    def test_length_prefixed_messages(self):
+        decoder = FrameDecoder()
+        data = struct.pack('!I', 5) + b'ab\ncd' + struct.pack('!I', 2) + b'ef'
+        self.assertEqual(decoder.feed(data[:3]), [])
+        self.assertEqual(decoder.feed(data[3:7]), [])
+        self.assertEqual(decoder.feed(data[7:]), [b'ab\ncd', b'ef'])
+
+    def test_mixed_messages(self):
+        decoder = FrameDecoder()
+        data = b'{"a": 1}\n' + struct.pack('!I', 3) + b'abc' + b'{"b": 2}\n'
+        self.assertEqual(decoder.feed(data),
+                         [b'{"a": 1}', b'abc', b'{"b": 2}'])
+
+    def test_maximum_frame_size(self):
+        decoder = FrameDecoder(max_frame_size=8)
+        self.assertRaises(FrameError, decoder.feed,
+                          struct.pack('!I', 9) + b'a')
+        decoder = FrameDecoder(max_frame_size=8)
+        self.assertRaises(FrameError, decoder.feed, b'{"a": 12345}')
+        # Terminated messages are limited as well, in one chunk or more
+        decoder = FrameDecoder(max_frame_size=100)
+        self.assertRaises(FrameError, decoder.feed,
+                          b'{' + b'a' * 5000 + b'}\n')
+        decoder = FrameDecoder(max_frame_size=100)
+        self.assertEqual(decoder.feed(b'{' + b'a' * 60), [])
+        self.assertRaises(FrameError, decoder.feed, b'a' * 60 + b'}\n')
+        decoder = FrameDecoder(max_frame_size=8)
+        self.assertEqual(decoder.feed(b'{"a": 1}\r\n'), [b'{"a": 1}'])
+
+    def test_flush_unterminated_message(self):
+        decoder = FrameDecoder()
+        decoder.feed(b'{"a": 1}')
+        self.assertEqual(decoder.flush(), b'{"a": 1}')
+        decoder.feed(struct.pack('!I', 3) + b'a')
+        self.assertIsNone(decoder.flush())
+
+    def test_protocol_processes_every_message(self):
+        collector = mock.Mock()
+        protocol = SSLFactory(collector).buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(b'{"a": 1}\n{"b": 2}\n{"c"')
+        protocol.dataReceived(b': 3}')
+        protocol.connectionLost(None)
+        self.assertEqual(
+            [c[0][0] for c in collector.receive.call_args_list],
+            [b'{"a": 1}', b'{"b": 2}', b'{"c": 3}'])
+
+    def test_protocol_drops_connection_on_oversized_message(self):
+        protocol = SSLFactory(mock.Mock(), 4).buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        protocol.dataReceived(struct.pack('!I', 5))
+        self.assertTrue(transport.disconnecting)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import sys
+import threading
+import unittest
+
+import mock
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collector.ingest import IngestPipeline
+
+
+class TestIngestPipeline(unittest.TestCase):
+
+    def test_workers_process_all_messages(self):
+        processed = []
+        pipeline = IngestPipeline(processed.append, workers=3)
+        pipeline.start()
+        for i in range(100):
+            self.assertTrue(pipeline.submit(i))
+        pipeline.stop()
+        self.assertEqual(sorted(processed), list(range(100)))
+        self.assertEqual(pipeline.processed, 100)
+        self.assertEqual(pipeline.queue_depth(), 0)
+
+    def test_queue_is_bounded_by_messages(self):
+        gate = threading.Event()
+        processed = []
+
+        def process(data):
+            gate.wait()
+            processed.append(data)
+        pipeline = IngestPipeline(process, workers=1, queue_size=4)
+        pipeline.start()
+        self.assertTrue(pipeline.submit_batch([1, 2, 3]))
+        self.assertEqual(pipeline.queue_depth(), 3)
+        self.assertFalse(pipeline.submit_batch([4, 5, 6]))
+        self.assertFalse(pipeline.submit(7))
+        gate.set()
+        pipeline.stop()
+        self.assertEqual(processed, [1, 2, 3, 4])
+        self.assertEqual(pipeline.received, 7)
+        self.assertEqual(pipeline.dropped, 3)
+        self.assertEqual(pipeline.queue_depth(), 0)
+
+    def test_stop_processes_what_stuck_workers_left_queued(self):
+        gate = threading.Event()
+        processed = []
+
+        def process(data):
+            if threading.current_thread().name.startswith('ingest'):
+                gate.wait()
+            processed.append(data)
+        pipeline = IngestPipeline(process, workers=1)
+        pipeline.start()
+        workers = list(pipeline._threads)
+        for i in range(5):
+            pipeline.submit(i)
+        pipeline.stop(0.1)
+        self.assertEqual(processed, [1, 2, 3, 4])
+        # Except for the message the stuck worker is busy with
+        self.assertEqual(pipeline.queue_depth(), 1)
+        gate.set()
+        for worker in workers:
+            worker.join(5)
+        self.assertEqual(pipeline.queue_depth(), 0)
+
+    def test_stop_drops_what_it_cannot_process_in_time(self):
+        gate = threading.Event()
+        processed = []
+
+        def process(data):
+            if threading.current_thread().name.startswith('ingest'):
+                gate.wait()
+            processed.append(data)
+        pipeline = IngestPipeline(process, workers=1)
+        pipeline.start()
+        workers = list(pipeline._threads)
+        for i in range(5):
+            pipeline.submit(i)
+        with mock.patch('collector.ingest.time') as clock:
+            clock.time.side_effect = [0.0, 0.0, 5.0]
+            pipeline.stop(0.1)
+        self.assertEqual(processed, [1])
+        self.assertEqual(pipeline.dropped, 3)
+        # Except for the message the stuck worker is busy with
+        self.assertEqual(pipeline.queue_depth(), 1)
+        gate.set()
+        for worker in workers:
+            worker.join(5)
+        self.assertEqual(pipeline.queue_depth(), 0)
+
+    def test_full_queue_drops_messages(self):
+        gate = threading.Event()
+        pipeline = IngestPipeline(lambda data: gate.wait(), workers=1,
+                                  queue_size=2)
+        pipeline.start()
+        results = [pipeline.submit(i) for i in range(10)]
+        gate.set()
+        pipeline.stop()
+        self.assertTrue(results.count(False) >= 7)
+        self.assertEqual(pipeline.dropped, results.count(False))
+
+    def test_errors_are_counted(self):
+        def process(data):
+            raise ValueError(data)
+        pipeline = IngestPipeline(process, workers=1)
+        pipeline.start()
+        pipeline.submit('message')
+        pipeline.stop()
+        self.assertEqual(pipeline.errors, 1)
+
+    def test_errors_roll_back_the_session(self):
+        db = mock.Mock()
+
+        def process(data):
+            raise ValueError(data)
+        pipeline = IngestPipeline(process, workers=1, db=db)
+        pipeline.start()
+        pipeline.submit('message')
+        pipeline.stop()
+        self.assertEqual(db.rollback.call_count, 1)
+        self.assertEqual(db.remove.call_count, 1)
+
+    def test_without_workers_processes_inline(self):
+        processed = []
+        pipeline = IngestPipeline(processed.append, workers=0)
+        pipeline.start()
+        pipeline.submit('message')
+        self.assertEqual(processed, ['message'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+import logging
+import os
+import sys
+import threading
+import unittest
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import log_sink
+
+
+class RecordingHandler(logging.Handler):
+
+    def __init__(self, gate=None):
+        logging.Handler.__init__(self)
+        self.gate = gate
+        self.records = []
+
+    def emit(self, record):
+        if self.gate is not None:
+            self.gate.wait()
+        self.records.append(record)
+
+
+def make_record(message, level=logging.INFO, category=None, args=None):
+    record = logging.LogRecord('test', level, __file__, 1, message, args,
+                               None)
+    if category is not None:
+        record.category = category
+    return record
+
+
+class TestLogSink(unittest.TestCase):
+
+    def test_sampling(self):
+        sampler = log_sink.SamplingFilter({'stored': 10})
+        passed = [sampler.filter(make_record('x', category='stored'))
+                  for i in range(100)]
+        self.assertEqual(passed.count(True), 10)
+        self.assertTrue(all(
+            sampler.filter(make_record('x', category='other'))
+            for i in range(10)))
+        self.assertTrue(all(
+            sampler.filter(make_record('x', logging.ERROR, 'stored'))
+            for i in range(10)))
+
+    def test_async_handler_writes_in_background(self):
+        target = RecordingHandler()
+        handler = log_sink.AsyncHandler(target)
+        arguments = ['a']
+        handler.handle(make_record('message %s', args=(arguments,)))
+        # Changes after the call don't show up in the record
+        arguments.append('b')
+        handler.close()
+        self.assertEqual([r.getMessage() for r in target.records],
+                         ["message ['a']"])
+
+    def test_async_handler_drops_when_full(self):
+        gate = threading.Event()
+        target = RecordingHandler(gate)
+        handler = log_sink.AsyncHandler(target, queue_size=2)
+        for i in range(10):
+            handler.handle(make_record('message'))
+        gate.set()
+        handler.close()
+        self.assertTrue(handler.dropped >= 7)
+        self.assertEqual(len(target.records) + handler.dropped, 10)
+
+    def test_configure_replaces_handler(self):
+        root = logging.getLogger()
+        level = root.level
+        try:
+            log_sink.configure({'LOG_LEVEL': 'WARNING'})
+            second = log_sink.configure({})
+            handlers = [h for h in root.handlers
+                        if isinstance(h, log_sink.AsyncHandler)]
+            self.assertEqual(handlers, [second])
+            self.assertEqual(root.level, logging.INFO)
+        finally:
+            root.removeHandler(second)
+            second.close()
+            root.setLevel(level)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+import os
+import sys
+import unittest
+
+import mock
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collector.metrics import MetricsRegistry, MetricsResource
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_counter(self):
+        registry = MetricsRegistry()
+        plain = registry.counter('test_total', 'Test counter.')
+        labeled = registry.counter('test_labeled_total', 'Labeled.',
+                                   ['kind'])
+        plain.inc()
+        plain.inc(2)
+        labeled.labels('a').inc()
+        labeled.labels('b "quoted"').inc(5)
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP test_total Test counter.',
+            '# TYPE test_total counter',
+            'test_total 3',
+            '# HELP test_labeled_total Labeled.',
+            '# TYPE test_labeled_total counter',
+            'test_labeled_total{kind="a"} 1',
+            'test_labeled_total{kind="b \\"quoted\\""} 5'
+        ])
+
+    def test_histogram(self):
+        registry = MetricsRegistry()
+        histogram = registry.histogram('test_seconds', 'Durations.',
+                                       ['stage'], buckets=[0.1, 1])
+        histogram.labels('x').observe(0.05)
+        histogram.labels('x').observe(0.5)
+        histogram.labels('x').observe(5)
+        self.assertEqual(registry.render().splitlines()[2:], [
+            'test_seconds_bucket{stage="x",le="0.1"} 1',
+            'test_seconds_bucket{stage="x",le="1.0"} 2',
+            'test_seconds_bucket{stage="x",le="+Inf"} 3',
+            'test_seconds_sum{stage="x"} 5.55',
+            'test_seconds_count{stage="x"} 3'
+        ])
+
+    def test_callback(self):
+        registry = MetricsRegistry()
+        registry.callback('test_depth', 'Depth.', 'gauge', lambda: 7)
+        registry.callback('test_results_total', 'Results.', 'counter',
+                          lambda: {'ok': 2, 'failed': 1}, ['result'])
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP test_depth Depth.',
+            '# TYPE test_depth gauge',
+            'test_depth 7',
+            '# HELP test_results_total Results.',
+            '# TYPE test_results_total counter',
+            'test_results_total{result="failed"} 1',
+            'test_results_total{result="ok"} 2'
+        ])
+
+    def test_duplicate_and_label_checks(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('test_total', 'Test.', ['kind'])
+        self.assertRaises(ValueError, registry.counter, 'test_total', 'Test.')
+        self.assertRaises(ValueError, counter.labels)
+
+    def test_resource(self):
+        registry = MetricsRegistry()
+        registry.counter('test_total', 'Test.').inc()
+        request = mock.MagicMock()
+        body = MetricsResource(registry).render_GET(request)
+        self.assertIn(b'test_total 1', body)
+        request.setHeader.assert_called_with(
+            b'Content-Type', b'text/plain; version=0.0.4; charset=utf-8')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,148 @@
+import os
+import sys
+import threading
+import unittest
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collector.dispatch import NotificationDispatcher, CircuitBreaker
+
+
+class Notifier(object):
+    def __init__(self, fail=False, gate=None):
+        self.fail = fail
+        self.gate = gate
+        self.messages = []
+
+    def process(self, message):
+        if self.gate is not None:
+            self.gate.wait()
+        if self.fail:
+            raise IOError('Mail server unavailable')
+        self.messages.append(message)
+
+
+class TestNotificationDispatch(unittest.TestCase):
+
+    def test_messages_are_delivered(self):
+        notifier = Notifier()
+        dispatcher = NotificationDispatcher(lambda name, config: notifier)
+        for i in range(10):
+            self.assertTrue(dispatcher.dispatch('Mail', {}, 'message %s' % i))
+        dispatcher.stop()
+        self.assertEqual(notifier.messages,
+                         ['message %s' % i for i in range(10)])
+        self.assertEqual(dispatcher.dispatched, 10)
+        self.assertEqual(dispatcher.queue_depth(), 0)
+
+    def test_latency_is_observed_per_notifier(self):
+        observed = []
+        dispatcher = NotificationDispatcher(
+            lambda name, config: Notifier(),
+            observer=lambda name, duration: observed.append(name))
+        dispatcher.dispatch('Mail', {}, 'first')
+        dispatcher.dispatch('Slack', {}, 'second')
+        dispatcher.stop()
+        self.assertEqual(sorted(observed), ['Mail', 'Slack'])
+
+    def test_full_queue_drops_messages(self):
+        gate = threading.Event()
+        notifier = Notifier(gate=gate)
+        dispatcher = NotificationDispatcher(lambda name, config: notifier,
+                                            queue_size=2)
+        results = [dispatcher.dispatch('Mail', {}, 'message %s' % i)
+                   for i in range(10)]
+        gate.set()
+        dispatcher.stop()
+        self.assertTrue(results.count(False) >= 7)
+        self.assertEqual(dispatcher.dropped['queue_full'],
+                         results.count(False))
+
+    def test_failures_open_the_circuit(self):
+        dispatcher = NotificationDispatcher(
+            lambda name, config: Notifier(fail=True), failure_threshold=2,
+            reset_timeout=3600)
+        dispatcher.dispatch('Mail', {}, 'first')
+        dispatcher.dispatch('Mail', {}, 'second')
+        dispatcher.stop()
+        self.assertEqual(dispatcher.failed, 2)
+        self.assertFalse(dispatcher.dispatch('Mail', {}, 'third'))
+        self.assertEqual(dispatcher.dropped['circuit_open'], 1)
+
+    def test_retired_lanes_release_their_notifier(self):
+        gate = threading.Event()
+        notifier = Notifier(gate=gate)
+        released = []
+        dispatcher = NotificationDispatcher(
+            lambda name, config: notifier,
+            release_notifier=released.append)
+        dispatcher.dispatch('Mail', {'to': 'a'}, 'first')
+        dispatcher.dispatch('Mail', {'to': 'a'}, 'second')
+        dispatcher.dispatch('Mail', {'to': 'b'}, 'third')
+        workers = dispatcher._lanes[('Mail', '{"to": "a"}')].workers
+        self.assertEqual(dispatcher.retain({('Mail', '{"to": "b"}')}), 1)
+        self.assertEqual(released, [])
+        gate.set()
+        for worker in workers:
+            worker.join(5)
+        self.assertEqual(released, [notifier])
+        self.assertIn('first', notifier.messages)
+        self.assertIn('second', notifier.messages)
+        self.assertEqual(len(dispatcher._lanes), 1)
+        dispatcher.stop()
+        self.assertEqual(released, [notifier, notifier])
+
+    def test_retired_lanes_with_a_full_queue_stop_all_workers(self):
+        gate = threading.Event()
+        notifier = Notifier(gate=gate)
+        released = []
+        dispatcher = NotificationDispatcher(
+            lambda name, config: notifier, queue_size=2, concurrency=2,
+            release_notifier=released.append)
+        dispatcher.idle_interval = 0.05
+        lane = dispatcher._get_lane('Mail', {})
+        for i in range(4):
+            dispatcher.dispatch('Mail', {}, 'message %s' % i)
+        self.assertEqual(lane.queue.qsize(), 2)
+        self.assertEqual(dispatcher.retain(set()), 1)
+        gate.set()
+        for worker in lane.workers:
+            worker.join(5)
+            self.assertFalse(worker.is_alive())
+        self.assertEqual(lane.active, 0)
+        self.assertEqual(released, [notifier])
+        self.assertEqual(len(notifier.messages),
+                         4 - dispatcher.dropped['queue_full'])
+        dispatcher.stop()
+
+    def test_messages_for_a_retiring_lane_are_not_lost(self):
+        notifier = Notifier()
+        dispatcher = NotificationDispatcher(lambda name, config: notifier)
+        lane = dispatcher._get_lane('Mail', {})
+        get_lane = dispatcher._get_lane
+        # The lane retires between looking it up and queueing the message
+        calls = []
+
+        def racing_get_lane(name, config):
+            calls.append(name)
+            if len(calls) == 1:
+                dispatcher.retain(set())
+                return lane
+            return get_lane(name, config)
+        dispatcher._get_lane = racing_get_lane
+        self.assertTrue(dispatcher.dispatch('Mail', {}, 'message'))
+        self.assertEqual(len(calls), 2)
+        dispatcher.stop()
+        self.assertEqual(notifier.messages, ['message'])
+
+    def test_circuit_breaker_trial_call(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertFalse(breaker.is_open)
+
+
+if __name__ == '__main__':
+    unittest.main()
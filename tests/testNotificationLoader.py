@@ -0,0 +1,135 @@
+import os
+import sys
+import threading
+import types
+import unittest
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipot.notifications import NotificationLoader
+from pipot.notifications.INotification import INotification
+
+
+class MailNotification(INotification):
+    def __init__(self, config):
+        super(MailNotification, self).__init__(config)
+        self.opened = 0
+        self.closed = 0
+
+    def open(self):
+        self.opened += 1
+
+    def close(self):
+        self.closed += 1
+
+    def process(self, message):
+        pass
+
+    def requires_extra_config(self):
+        return True
+
+    @staticmethod
+    def get_extra_config_sample():
+        return {'to': 'admin@example.com'}
+
+    def is_valid_extra_config(self, config):
+        return 'to' in config
+
+    @staticmethod
+    def get_apt_dependencies():
+        return []
+
+    @staticmethod
+    def get_pip_dependencies():
+        return []
+
+    @staticmethod
+    def after_install_hook():
+        return True
+
+
+class SlowNotification(MailNotification):
+    gate = threading.Event()
+
+    def open(self):
+        self.gate.wait(5)
+        super(SlowNotification, self).open()
+
+
+class TestNotificationLoader(unittest.TestCase):
+
+    def setUp(self):
+        for cls in [MailNotification, SlowNotification]:
+            module = types.ModuleType(
+                'pipot.notifications.%s' % cls.__name__)
+            setattr(module, cls.__name__, cls)
+            sys.modules[module.__name__] = module
+        self.pool = NotificationLoader.NotifierPool()
+
+    def tearDown(self):
+        for name in ['MailNotification', 'SlowNotification']:
+            sys.modules.pop('pipot.notifications.%s' % name, None)
+
+    def test_pool_reuses_opened_instances(self):
+        first = self.pool.get('MailNotification', {'to': 'a'})
+        second = self.pool.get('MailNotification', {'to': 'a'})
+        other = self.pool.get('MailNotification', {'to': 'b'})
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        self.assertEqual(first.opened, 1)
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 2))
+
+    def test_pool_opens_instances_outside_of_the_lock(self):
+        SlowNotification.gate.clear()
+        instances = []
+        threads = [threading.Thread(target=lambda: instances.append(
+            self.pool.get('SlowNotification', {'to': 'a'})))
+            for i in range(2)]
+        for thread in threads:
+            thread.start()
+        # Other notifiers don't wait for the slow one
+        self.pool.get('MailNotification', {'to': 'a'})
+        self.assertEqual(instances, [])
+        SlowNotification.gate.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(len(instances), 2)
+        self.assertIs(instances[0], instances[1])
+        self.assertEqual(instances[0].opened, 1)
+        self.assertEqual((self.pool.hits, self.pool.misses), (1, 2))
+        self.pool.release(instances[0])
+        self.pool.release(instances[0])
+        self.assertEqual(instances[0].closed, 1)
+
+    def test_pool_close_all(self):
+        first = self.pool.get('MailNotification', {'to': 'a'})
+        self.pool.close_all()
+        self.assertEqual(first.closed, 1)
+        self.assertIsNot(self.pool.get('MailNotification', {'to': 'a'}),
+                         first)
+
+    def test_pool_closes_instances_once_released(self):
+        first = self.pool.get('MailNotification', {'to': 'a'})
+        self.pool.get('MailNotification', {'to': 'a'})
+        self.pool.invalidate()
+        self.assertEqual(first.closed, 0)
+        self.pool.release(first)
+        self.assertEqual(first.closed, 0)
+        self.pool.release(first)
+        self.assertEqual(first.closed, 1)
+        # Unused instances are closed right away
+        other = self.pool.get('MailNotification', {'to': 'b'})
+        self.pool.release(other)
+        self.assertEqual(other.closed, 1)
+        self.assertIsNot(self.pool.get('MailNotification', {'to': 'b'}),
+                         other)
+
+    def test_pool_invalidate_reloads_module(self):
+        self.pool.get('MailNotification', {'to': 'a'})
+        self.pool.invalidate('MailNotification', reload_modules=True)
+        self.assertNotIn('pipot.notifications.MailNotification', sys.modules)
+
+
+if __name__ == '__main__':
+    unittest.main()
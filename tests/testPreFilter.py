@@ -0,0 +1,87 @@
+import os
+import sys
+import unittest
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collector import wire
+from collector.prefilter import PreFilter
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeKnown(object):
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.loaded = keys is not None
+
+    def __contains__(self, instance_key):
+        return self.keys is not None and instance_key in self.keys
+
+
+class TestPreFilter(unittest.TestCase):
+
+    def test_get_instance(self):
+        self.assertEqual(PreFilter.get_instance(
+            b'{"data": "x", "instance" : "abc"}'), 'abc')
+        self.assertEqual(PreFilter.get_instance(
+            wire.encode_envelope('abc', b'body')), 'abc')
+        self.assertIsNone(PreFilter.get_instance(b'GET / HTTP/1.0'))
+        self.assertIsNone(PreFilter.get_instance(b'{"instance": 1}'))
+        self.assertIsNone(PreFilter.get_instance(wire.MAGIC + b'\x09'))
+
+    def test_known_instances_pass(self):
+        prefilter = PreFilter(FakeKnown({'abc'}), 1, 1)
+        for i in range(10):
+            self.assertIsNone(prefilter.check(
+                b'{"instance": "abc", "data": ""}', '10.0.0.1'))
+        self.assertEqual(prefilter.check(b'\x00\x01', '10.0.0.1'),
+                         'malformed')
+        self.assertEqual(prefilter.check(u'{"instance": "abc"}'), None)
+
+    def test_unknown_instances_are_rate_limited_per_source(self):
+        clock = FakeClock()
+        prefilter = PreFilter(FakeKnown({'abc'}), 1, 2, clock=clock)
+        data = b'{"instance": "xyz", "data": ""}'
+        results = [prefilter.check(data, '10.0.0.1') for i in range(5)]
+        self.assertEqual(results, [None, None, None, 'unknown_instance',
+                                   'unknown_instance'])
+        self.assertIsNone(prefilter.check(data, '10.0.0.2'))
+        # Recovers once the source slows down
+        clock.now += 5
+        self.assertIsNone(prefilter.check(data, '10.0.0.1'))
+
+    def test_unknown_instances_are_rate_limited_overall(self):
+        clock = FakeClock()
+        prefilter = PreFilter(FakeKnown({'abc'}), 1, 5, 1, 2, clock=clock)
+        data = b'{"instance": "xyz", "data": ""}'
+        results = [prefilter.check(data, '10.0.0.%s' % i) for i in range(5)]
+        self.assertEqual(results, [None, None, None, 'unknown_instance',
+                                   'unknown_instance'])
+        clock.now += 5
+        self.assertIsNone(prefilter.check(data, '10.0.0.100'))
+
+    def test_forgets_least_recent_sources(self):
+        prefilter = PreFilter(FakeKnown(set()), 1, 1, max_sources=2)
+        data = b'{"instance": "xyz"}'
+        for source in ['a', 'b', 'a', 'c']:
+            prefilter.check(data, source)
+        self.assertEqual(list(prefilter._sources), ['a', 'c'])
+
+    def test_everything_passes_until_loaded(self):
+        prefilter = PreFilter(FakeKnown(None), 1, 1)
+        for i in range(10):
+            self.assertIsNone(prefilter.check(b'{"instance": "xyz"}', 'a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
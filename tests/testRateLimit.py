@@ -0,0 +1,84 @@
+import os
+import sys
+import unittest
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collector.ratelimit import TokenBucket, LoadShedder
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_pressure_rises_with_debt(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, 10, clock)
+        for i in range(10):
+            bucket.take()
+        self.assertEqual(bucket.pressure(), 0)
+        for i in range(5):
+            bucket.take()
+        self.assertEqual(bucket.pressure(), 0.5)
+        for i in range(50):
+            bucket.take()
+        self.assertEqual(bucket.pressure(), 1)
+
+    def test_refills_over_time(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, 10, clock)
+        for i in range(20):
+            bucket.take()
+        clock.now += 1.5
+        self.assertEqual(bucket.pressure(), 0)
+        self.assertEqual(bucket.take(), 4)
+
+
+class TestLoadShedder(unittest.TestCase):
+
+    levels = [1, 2, 3, 4, 5]
+
+    def test_floor(self):
+        self.assertEqual(LoadShedder.get_floor(0, self.levels), 1)
+        self.assertEqual(LoadShedder.get_floor(0.1, self.levels), 2)
+        self.assertEqual(LoadShedder.get_floor(0.5, self.levels), 3)
+        self.assertEqual(LoadShedder.get_floor(1, self.levels), 5)
+
+    def test_sheds_lowest_levels_first(self):
+        clock = FakeClock()
+        shedder = LoadShedder(10, 10, clock)
+        for i in range(10):
+            self.assertTrue(shedder.admit('flood', 1, self.levels))
+        # Slightly over the limit: only the lowest level goes
+        self.assertTrue(shedder.admit('flood', 1, self.levels))
+        self.assertFalse(shedder.admit('flood', 1, self.levels))
+        self.assertTrue(shedder.admit('flood', 2, self.levels))
+        # Sustained overload: everything but the highest level goes
+        for i in range(20):
+            shedder.admit('flood', 3, self.levels)
+        self.assertFalse(shedder.admit('flood', 4, self.levels))
+        self.assertTrue(shedder.admit('flood', 5, self.levels))
+        self.assertTrue(shedder.admit('flood', None, []))
+
+    def test_counts_per_deployment(self):
+        clock = FakeClock()
+        shedder = LoadShedder(1, 1, clock)
+        for i in range(5):
+            shedder.admit('flood', 1, self.levels)
+        self.assertTrue(shedder.admit('quiet', 1, self.levels))
+        self.assertEqual(shedder.get_shed_counts(), {'flood': 3})
+        # Recovers once the deployment is back under its rate
+        clock.now += 10
+        self.assertTrue(shedder.admit('flood', 1, self.levels))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import datetime
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from collector.retention import ReportPruner, get_report_models
+from database import create_session
+from mod_config.models import Service
+from mod_honeypot.models import Profile, PiModels, PiPotReport, \
+    CollectorTypes, Deployment
+from tests.testAppBase import TestAppBase
+
+
+class TestReportPruner(TestAppBase):
+
+    def setUp(self):
+        super(TestReportPruner, self).setUp()
+        self.db = create_session(self.app.config['DATABASE_URI'],
+                                 drop_tables=False)
+        profile = Profile(name='test-profile', description='test')
+        self.db.add(profile)
+        self.db.commit()
+        deployment = Deployment(
+            name='test-deployment', profile_id=profile.id,
+            instance_key='test', mac_key='test',
+            encryption_key='test', rpi_model=PiModels['one'],
+            server_ip='test', interface='test',
+            wlan_config='test', hostname='test',
+            rootpw='test', debug=True,
+            collector_type=CollectorTypes['udp'])
+        self.db.add(deployment)
+        self.db.commit()
+        now = datetime.datetime.utcnow()
+        for days in [40, 35, 31, 20, 1]:
+            self.db.add(PiPotReport(
+                deployment.id, 'message %s' % days,
+                now - datetime.timedelta(days=days)))
+        self.db.commit()
+        self.archive_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+        self.db.remove()
+        super(TestReportPruner, self).tearDown()
+
+    def remaining(self):
+        messages = [report.message for report in PiPotReport.query.order_by(
+            PiPotReport.id)]
+        self.db.rollback()
+        return messages
+
+    def test_prunes_in_chunks(self):
+        pruner = ReportPruner(self.db, 30, chunk_size=2)
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *ignored):
+            if statement.startswith('DELETE'):
+                statements.append(statement)
+        from sqlalchemy import event
+        event.listen(self.db.get_bind(), 'before_cursor_execute',
+                     before_cursor_execute)
+        try:
+            self.assertEqual(pruner.run(), 3)
+        finally:
+            event.remove(self.db.get_bind(), 'before_cursor_execute',
+                         before_cursor_execute)
+        self.assertEqual(len(statements), 2)
+        self.assertEqual(self.remaining(), ['message 20', 'message 1'])
+        self.assertEqual(pruner.pruned, 3)
+
+    def test_archives_removed_rows(self):
+        pruner = ReportPruner(self.db, 30, chunk_size=2,
+                              archive_dir=self.archive_dir)
+        pruner.run()
+        archived = []
+        for name in sorted(os.listdir(self.archive_dir)):
+            self.assertTrue(name.startswith('report_pipot-'))
+            with gzip.open(os.path.join(self.archive_dir, name), 'rb') as f:
+                archived.extend(json.loads(line.decode('utf-8'))['message']
+                                for line in f)
+        self.assertEqual(sorted(archived),
+                         ['message 31', 'message 35', 'message 40'])
+
+    def test_service_retention_overrides_default(self):
+        pruner = ReportPruner(self.db, 30, {'PiPot': 10})
+        self.assertEqual(pruner.run(), 4)
+        self.assertEqual(self.remaining(), ['message 1'])
+        pruner = ReportPruner(self.db, 0, {'PiPot': 0})
+        self.assertEqual(pruner.run(), 0)
+        self.assertEqual(self.remaining(), ['message 1'])
+
+    def test_skips_services_that_cannot_be_loaded(self):
+        self.db.add(Service(name='MissingService', description='test'))
+        self.db.commit()
+        pruner = ReportPruner(self.db, 30)
+        self.assertEqual(get_report_models(self.db),
+                         [('PiPot', PiPotReport)])
+        self.assertEqual(pruner.run(), 3)
+
+    def test_report_models_come_from_the_service(self):
+        self.db.add(Service(name='FakeService', description='test'))
+        self.db.commit()
+        service = mock.Mock()
+        service.get_used_table_names.return_value = {
+            'report_b': Deployment, 'report_a': PiPotReport}
+        with mock.patch('pipot.services.ServiceLoader.registry.get_instance',
+                        return_value=service) as get_instance:
+            self.assertEqual(get_report_models(self.db), [
+                ('PiPot', PiPotReport), ('FakeService', PiPotReport),
+                ('FakeService', Deployment)])
+        get_instance.assert_called_once_with('FakeService', None, None)
+
+    def test_stop_interrupts_pruning(self):
+        pruner = ReportPruner(self.db, 30, chunk_size=1)
+        pruner.stop()
+        self.assertEqual(pruner.prune(
+            PiPotReport.__table__, datetime.datetime.utcnow()), 0)
+        self.assertEqual(len(self.remaining()), 5)
+
+    def test_from_config(self):
+        self.assertIsNone(ReportPruner.from_config(self.db, {}))
+        pruner = ReportPruner.from_config(self.db, {
+            'REPORT_RETENTION': {'PiPot': 7},
+            'REPORT_PRUNE_CHUNK_SIZE': 10
+        })
+        self.assertEqual(pruner.get_retention('PiPot'), 7)
+        self.assertEqual(pruner.get_retention('TelnetService'), 0)
+        self.assertEqual(pruner.chunk_size, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,216 @@
+import datetime
+import unittest
+
+import mock
+from sqlalchemy.exc import OperationalError
+
+import tests.authMock
+from collector import rollup
+from collector.buffer import WriteBehindBuffer
+from database import create_session
+from mod_honeypot.models import Profile, PiModels, PiPotReport, \
+    CollectorTypes, Deployment
+from mod_report.models import ReportRollup
+from serverCollector import ServerCollector
+from tests.testAppBase import TestAppBase
+
+
+class TestReportRollup(TestAppBase):
+
+    def setUp(self):
+        super(TestReportRollup, self).setUp()
+        self.db = create_session(self.app.config['DATABASE_URI'],
+                                 drop_tables=False)
+        profile = Profile(name='test-profile', description='test')
+        self.db.add(profile)
+        self.db.commit()
+        deployment = Deployment(
+            name='test-deployment', profile_id=profile.id,
+            instance_key='test', mac_key='test',
+            encryption_key='test', rpi_model=PiModels['one'],
+            server_ip='test', interface='test',
+            wlan_config='test', hostname='test',
+            rootpw='test', debug=True,
+            collector_type=CollectorTypes['udp'])
+        self.db.add(deployment)
+        self.db.commit()
+        self.deployment_id = deployment.id
+        self.hour = datetime.datetime.utcnow().replace(
+            minute=0, second=0, microsecond=0)
+
+    def tearDown(self):
+        self.db.remove()
+        super(TestReportRollup, self).tearDown()
+
+    def cells(self):
+        cells = [(c.service, c.hour, c.level, c.count)
+                 for c in ReportRollup.query.order_by(
+                     ReportRollup.hour, ReportRollup.service,
+                     ReportRollup.level)]
+        self.db.rollback()
+        return cells
+
+    def test_count_per_hour(self):
+        counts = {}
+        rollup.count(counts, 1, 'PiPot', self.hour.replace(minute=5), 0)
+        rollup.count(counts, 1, 'PiPot', self.hour.replace(minute=59), 0)
+        rollup.count(counts, 1, 'PiPot', self.hour, 1, 3)
+        other = {}
+        rollup.count(other, 1, 'PiPot', self.hour, 0)
+        rollup.merge(counts, other)
+        self.assertEqual(counts, {(1, 'PiPot', self.hour, 0): 3,
+                                  (1, 'PiPot', self.hour, 1): 3})
+
+    def test_write_counts_adds_to_existing_cells(self):
+        counts = {}
+        rollup.count(counts, self.deployment_id, 'PiPot', self.hour, 0, 2)
+        rollup.write_counts(self.db, counts)
+        self.db.commit()
+        rollup.count(counts, self.deployment_id, 'PiPot', self.hour, 1)
+        rollup.write_counts(self.db, counts)
+        self.db.commit()
+        self.assertEqual(self.cells(), [('PiPot', self.hour, 0, 4),
+                                        ('PiPot', self.hour, 1, 1)])
+
+    def test_write_counts_retries_cells_inserted_meanwhile(self):
+        self.db.add(ReportRollup(self.deployment_id, 'PiPot', self.hour, 0,
+                                 3))
+        self.db.commit()
+        update_cell = rollup._update_cell
+        calls = []
+
+        def racing_update_cell(db, table, cell):
+            # The first update misses the cell another flush inserted
+            calls.append(cell)
+            return len(calls) > 1 and update_cell(db, table, cell)
+        counts = {}
+        rollup.count(counts, self.deployment_id, 'PiPot', self.hour, 0, 2)
+        with mock.patch.object(rollup, '_update_cell',
+                               side_effect=racing_update_cell):
+            rollup.write_counts(self.db, counts)
+        self.db.commit()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(self.cells(), [('PiPot', self.hour, 0, 5)])
+
+    def test_buffer_writes_counts_with_rows(self):
+        buffer = WriteBehindBuffer(self.db, max_rows=10, max_delay=3600,
+                                   rollup=rollup.write_counts)
+        cell = rollup.get_cell(self.deployment_id, 'PiPot', self.hour, 0)
+        buffer.extend([PiPotReport(self.deployment_id, 'a', self.hour)],
+                      [cell])
+        with mock.patch.object(self.db, 'commit', side_effect=OperationalError(
+                'COMMIT', {}, Exception('down'))):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(self.cells(), [])
+        buffer.extend([PiPotReport(self.deployment_id, 'b', self.hour)],
+                      [cell])
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(self.cells(), [('PiPot', self.hour, 0, 2)])
+
+    def test_buffer_drops_rows_the_database_refuses(self):
+        existing = PiPotReport(self.deployment_id, 'existing', self.hour)
+        self.db.add(existing)
+        self.db.commit()
+        buffer = WriteBehindBuffer(self.db, max_rows=10, max_delay=3600,
+                                   rollup=rollup.write_counts)
+        rows = [PiPotReport(self.deployment_id, 'a', self.hour),
+                PiPotReport(self.deployment_id, 'duplicate', self.hour),
+                PiPotReport(self.deployment_id, 'b', self.hour)]
+        rows[1].id = existing.id
+        buffer.extend(rows, [
+            rollup.get_cell(self.deployment_id, 'PiPot', self.hour, level)
+            for level in [0, 1, 0]])
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(buffer.rows_refused, 1)
+        self.assertEqual(buffer.rows_written, 2)
+        self.assertEqual(sorted(r.message for r in PiPotReport.query),
+                         ['a', 'b', 'existing'])
+        # The refused row isn't counted either
+        self.assertEqual(self.cells(), [('PiPot', self.hour, 0, 2)])
+
+    def test_collector_counts_stored_entries(self):
+        collector = ServerCollector(self.db)
+        content = [
+            {'service': 'PiPot', 'data': 'booted',
+             'timestamp': '2016-01-01 12:30:00'},
+            {'service': 'PiPot', 'data': 'running',
+             'timestamp': '2016-01-01 12:45:00'},
+            {'service': 'PiPot', 'data': 'running',
+             'timestamp': '2016-01-01 13:00:00'}
+        ]
+        collector.process_content(collector.deployments.get('test'), content)
+        collector.buffer.flush()
+        self.assertEqual(self.cells(), [
+            ('PiPot', datetime.datetime(2016, 1, 1, 12), 0, 2),
+            ('PiPot', datetime.datetime(2016, 1, 1, 13), 0, 1)])
+
+    def test_backfill_replaces_counts(self):
+        for minute in [1, 2, 3]:
+            self.db.add(PiPotReport(self.deployment_id, 'a',
+                                    self.hour.replace(minute=minute)))
+        self.db.add(ReportRollup(self.deployment_id, 'PiPot', self.hour, 0,
+                                 10))
+        self.db.commit()
+        totals = rollup.backfill(self.db, [('PiPot', PiPotReport)],
+                                 chunk_size=2)
+        self.assertEqual(totals, {'PiPot': 3})
+        self.assertEqual(self.cells(), [('PiPot', self.hour, 0, 3)])
+
+    def test_backfill_counts_all_tables_of_a_service(self):
+        for minute in [1, 2, 3]:
+            self.db.add(PiPotReport(self.deployment_id, 'a',
+                                    self.hour.replace(minute=minute)))
+        self.db.commit()
+        service = mock.Mock()
+        service.get_notification_levels_for.side_effect = \
+            lambda rows: [1] * len(rows)
+        # The same table twice stands in for a service with two tables
+        with mock.patch('pipot.services.ServiceLoader.registry.get_instance',
+                        return_value=service):
+            totals = rollup.backfill(self.db, [('Fake', PiPotReport),
+                                               ('Fake', PiPotReport)],
+                                     chunk_size=2)
+        self.assertEqual(totals, {'Fake': 6})
+        self.assertEqual(self.cells(), [('Fake', self.hour, 1, 6)])
+
+    def test_dashboard_counts(self):
+        self.db.add(ReportRollup(self.deployment_id, 'PiPot', self.hour, 0,
+                                 5))
+        self.db.add(ReportRollup(
+            self.deployment_id, 'PiPot',
+            self.hour - datetime.timedelta(days=2), 0, 7))
+        self.db.commit()
+        with self.app.test_client() as client:
+            response = client.post('/dashboard/counts', data=dict(
+                deployment=self.deployment_id, hours=24))
+            self.assertEqual(response.get_json()['status'], 'success')
+            self.assertEqual(response.get_json()['payload'], [{
+                'deployment': self.deployment_id, 'service': 'PiPot',
+                'hour': self.hour.strftime('%Y-%m-%d %H:00:00'),
+                'level': 0, 'count': 5}])
+            response = client.post('/dashboard/counts', data=dict(
+                hours=72))
+            self.assertEqual(len(response.get_json()['payload']), 2)
+            response = client.post('/dashboard/counts', data=dict(
+                deployment=self.deployment_id + 1))
+            self.assertEqual(response.get_json()['status'], 'error')
+
+    def test_dashboard_shows_recent_counts(self):
+        self.db.add(ReportRollup(self.deployment_id, 'PiPot', self.hour, 0,
+                                 5))
+        self.db.add(ReportRollup(self.deployment_id, 'PiPot', self.hour, 1,
+                                 2))
+        self.db.add(ReportRollup(
+            self.deployment_id, 'PiPot',
+            self.hour - datetime.timedelta(days=2), 0, 7))
+        self.db.commit()
+        with self.app.test_client() as client:
+            response = client.get('/')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'test-deployment (7 reports in the last 24 hours)',
+                          response.data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,533 @@
+import base64
+import hashlib
+import hmac
+import json
+import unittest
+import zlib
+
+import mock
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+from collector import wire
+from collector.buffer import WriteBehindBuffer
+from collector.cache import DeploymentCache, CacheVersionWatcher
+from collector.rules import RuleEngine
+from database import create_session
+from mod_config.models import Service, Notification, Rule, Actions, \
+    Conditions, CacheVersion
+from mod_honeypot.models import Profile, PiModels, PiPotReport, \
+    ProfileService, CollectorTypes, Deployment
+from pipot.encryption import Encryption
+from serverCollector import ServerCollector
+from tests.testAppBase import TestAppBase
+
+
+class TestServerCollector(TestAppBase):
+
+    def setUp(self):
+        super(TestServerCollector, self).setUp()
+        self.db = create_session(self.app.config['DATABASE_URI'],
+                                 drop_tables=False)
+        profile = Profile(name='test-profile', description='test')
+        service = Service(name='TelnetService', description='test')
+        self.db.add(profile)
+        self.db.add(service)
+        self.db.commit()
+        self.db.add(ProfileService(profile.id, service.id, '{"port": 23}'))
+        self.service_id = service.id
+        deployment = Deployment(
+            name='test-deployment', profile_id=profile.id,
+            instance_key='test', mac_key='test',
+            encryption_key='test', rpi_model=PiModels['one'],
+            server_ip='test', interface='test',
+            wlan_config='test', hostname='test',
+            rootpw='test', debug=True,
+            collector_type=CollectorTypes['udp'])
+        self.db.add(deployment)
+        self.db.commit()
+        self.deployment_id = deployment.id
+
+    def tearDown(self):
+        self.db.remove()
+        super(TestServerCollector, self).tearDown()
+
+    def test_buffer_flushes_on_row_threshold(self):
+        buffer = WriteBehindBuffer(self.db, max_rows=5, max_delay=3600)
+        for i in range(4):
+            buffer.add(PiPotReport(self.deployment_id, 'test %s' % i))
+        self.assertEqual(len(buffer), 4)
+        self.assertEqual(PiPotReport.query.count(), 0)
+        buffer.add(PiPotReport(self.deployment_id, 'test 4'))
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(PiPotReport.query.count(), 5)
+        self.assertEqual(buffer.flushes, 1)
+        self.assertEqual(buffer.last_flush_rows, 5)
+
+    def test_buffer_flushes_on_time_threshold(self):
+        buffer = WriteBehindBuffer(self.db, max_rows=100, max_delay=3600)
+        buffer.add(PiPotReport(self.deployment_id, 'test'))
+        buffer.tick()
+        self.assertEqual(PiPotReport.query.count(), 0)
+        buffer.max_delay = 0
+        buffer.tick()
+        self.assertEqual(PiPotReport.query.count(), 1)
+        self.assertEqual(buffer.rows_written, 1)
+
+    def test_buffer_keeps_rows_while_the_database_is_unavailable(self):
+        buffer = WriteBehindBuffer(self.db, max_rows=100, max_delay=3600)
+        buffer.add(PiPotReport(self.deployment_id, 'test'))
+        with mock.patch.object(self.db, 'commit', side_effect=OperationalError(
+                'COMMIT', {}, Exception('down'))) as commit:
+            self.assertEqual(buffer.flush(), 0)
+        # Not retried row by row
+        self.assertEqual(commit.call_count, 1)
+        self.assertEqual(len(buffer), 1)
+        self.assertEqual(buffer.rows_refused, 0)
+        self.assertEqual(buffer.flush(), 1)
+        self.assertEqual(PiPotReport.query.count(), 1)
+
+    def test_refused_rows_do_not_hold_back_the_spool(self):
+        collector = ServerCollector(self.db)
+        existing = PiPotReport(self.deployment_id, 'existing')
+        self.db.add(existing)
+        self.db.commit()
+        row = PiPotReport(self.deployment_id, 'duplicate')
+        row.id = existing.id
+        collector.buffer.add(row)
+        self.assertTrue(collector._flush_replayed())
+        self.assertEqual(collector.buffer.rows_refused, 1)
+
+    def test_buffer_drops_rows_when_full(self):
+        buffer = WriteBehindBuffer(self.db, max_rows=100, max_delay=3600,
+                                   max_buffered=3)
+        buffer.extend([PiPotReport(self.deployment_id, 'test %s' % i)
+                       for i in range(2)])
+        buffer.extend([PiPotReport(self.deployment_id, 'test %s' % i)
+                       for i in range(2, 4)])
+        buffer.add(PiPotReport(self.deployment_id, 'test 4'))
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.rows_overflowed, 2)
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(sorted(r.message for r in PiPotReport.query),
+                         ['test 0', 'test 1', 'test 2'])
+
+    def test_buffer_stays_bounded_while_the_database_is_unavailable(self):
+        buffer = WriteBehindBuffer(self.db, max_rows=100, max_delay=3600,
+                                   max_buffered=3)
+        buffer.extend([PiPotReport(self.deployment_id, 'old %s' % i)
+                       for i in range(2)])
+
+        def commit():
+            # Rows keep coming in while the flush waits for the database
+            buffer.extend([PiPotReport(self.deployment_id, 'new %s' % i)
+                           for i in range(3)])
+            raise OperationalError('COMMIT', {}, Exception('down'))
+        with mock.patch.object(self.db, 'commit', side_effect=commit):
+            self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.rows_overflowed, 2)
+        buffer.add(PiPotReport(self.deployment_id, 'rejected'))
+        self.assertEqual(buffer.rows_overflowed, 3)
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(sorted(r.message for r in PiPotReport.query),
+                         ['new 0', 'old 0', 'old 1'])
+
+    def test_buffer_flush_without_rows(self):
+        buffer = WriteBehindBuffer(self.db)
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(buffer.flushes, 0)
+
+    def count_queries(self, f, *args):
+        from database import db_engine
+        queries = []
+
+        def before_cursor_execute(*ignored):
+            queries.append(ignored)
+        event.listen(db_engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            result = f(*args)
+        finally:
+            event.remove(db_engine, 'before_cursor_execute',
+                         before_cursor_execute)
+        return result, len(queries)
+
+    def test_deployment_cache_resolves_known_instance(self):
+        cache = DeploymentCache(self.db)
+        record, queries = self.count_queries(cache.get, 'test')
+        self.assertEqual(record.id, self.deployment_id)
+        self.assertEqual(record.mac_key, 'test')
+        self.assertEqual(record.services, {
+            'TelnetService': (self.service_id, {'port': 23})
+        })
+        self.assertTrue(queries > 0)
+        cached, queries = self.count_queries(cache.get, 'test')
+        self.assertIs(cached, record)
+        self.assertEqual(queries, 0)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_deployment_cache_unknown_instance(self):
+        cache = DeploymentCache(self.db)
+        self.assertIsNone(cache.get('unknown'))
+
+    def test_deployment_cache_remembers_unknown_instances(self):
+        now = [1000.0]
+        cache = DeploymentCache(self.db, 10, clock=lambda: now[0])
+        ignored, queries = self.count_queries(cache.get, 'unknown')
+        self.assertTrue(queries > 0)
+        ignored, queries = self.count_queries(cache.get, 'unknown')
+        self.assertEqual(queries, 0)
+        now[0] += 11
+        ignored, queries = self.count_queries(cache.get, 'unknown')
+        self.assertTrue(queries > 0)
+        # A change to the deployments makes it look again
+        cache.invalidate()
+        ignored, queries = self.count_queries(cache.get, 'unknown')
+        self.assertTrue(queries > 0)
+
+    def test_deployment_cache_rolls_back_after_errors(self):
+        db = mock.Mock()
+        db.query.side_effect = OperationalError('SELECT', {}, None)
+        cache = DeploymentCache(db)
+        self.assertRaises(OperationalError, cache.get, 'test')
+        self.assertEqual(db.rollback.call_count, 1)
+
+    def test_deployment_cache_invalidated_through_version(self):
+        cache = DeploymentCache(self.db)
+        watcher = CacheVersionWatcher(self.db)
+        watcher.register('deployment', cache.invalidate)
+        watcher.poll()
+        record = cache.get('test')
+        watcher.poll()
+        self.assertIs(cache.get('test'), record)
+        CacheVersion.bump(self.db, 'deployment')
+        self.db.commit()
+        watcher.poll()
+        self.assertIsNot(cache.get('test'), record)
+
+    def add_rule(self, notification_id, condition, level, action):
+        self.db.add(Rule(self.service_id, notification_id, '{"to": "x"}',
+                         Conditions[condition], level, Actions[action]))
+        self.db.commit()
+
+    def test_rule_matches(self):
+        rule = Rule(self.service_id, None, None, Conditions.ge, 2,
+                    Actions.store)
+        self.assertTrue(rule.matches(2))
+        self.assertTrue(rule.matches(3))
+        self.assertFalse(rule.matches(1))
+
+    def test_rule_engine_decisions(self):
+        notification = Notification(name='Mail', description='test')
+        self.db.add(notification)
+        self.db.commit()
+        self.add_rule(notification.id, 'ge', 2, 'store')
+        self.add_rule(None, 'st', 2, 'drop')
+        self.add_rule(notification.id, 'eq', 3, 'drop')
+        service = mock.Mock()
+        service.get_notification_levels.return_value = [1, 2, 3]
+        engine = RuleEngine(self.db)
+        decision, queries = self.count_queries(
+            engine.evaluate, self.service_id, service, 1)
+        self.assertEqual(decision.notifications, ())
+        self.assertTrue(decision.drop)
+        decision, queries = self.count_queries(
+            engine.evaluate, self.service_id, service, 2)
+        self.assertEqual(queries, 0)
+        self.assertEqual(decision.notifications, (('Mail', {'to': 'x'}),))
+        self.assertFalse(decision.drop)
+        decision = engine.evaluate(self.service_id, service, 3)
+        self.assertEqual(len(decision.notifications), 2)
+        self.assertTrue(decision.drop)
+        # Undeclared levels are decided on the fly
+        self.assertFalse(engine.evaluate(self.service_id, service, 5).drop)
+        self.assertEqual(service.get_notification_levels.call_count, 1)
+
+    def test_rule_engine_invalidate(self):
+        service = mock.Mock()
+        service.get_notification_levels.return_value = [1, 2]
+        engine = RuleEngine(self.db)
+        self.assertFalse(engine.evaluate(self.service_id, service, 1).drop)
+        self.add_rule(None, 'eq', 1, 'drop')
+        self.assertFalse(engine.evaluate(self.service_id, service, 1).drop)
+        engine.invalidate()
+        self.assertTrue(engine.evaluate(self.service_id, service, 1).drop)
+
+    def test_rule_changes_retire_unused_notifiers(self):
+        notification = Notification(name='Mail', description='test')
+        self.db.add(notification)
+        self.db.commit()
+        self.add_rule(notification.id, 'eq', 1, 'store')
+        engine = RuleEngine(self.db)
+        self.assertEqual(engine.get_notifiers(), {('Mail', '{"to": "x"}')})
+        collector = ServerCollector(self.db)
+        collector.dispatcher = mock.Mock()
+        collector._retire_notifiers()
+        collector.dispatcher.retain.assert_called_once_with(
+            {('Mail', '{"to": "x"}')})
+        Rule.query.delete()
+        self.db.commit()
+        collector.rules.invalidate()
+        collector._retire_notifiers()
+        collector.dispatcher.retain.assert_called_with(set())
+
+    def test_entries_are_processed_per_service_batch(self):
+        self.add_rule(None, 'eq', 1, 'drop')
+        collector = ServerCollector(self.db)
+        service = mock.Mock()
+        service.get_notification_levels.return_value = [1, 2]
+        service.create_storage_rows.side_effect = \
+            lambda deployment_id, entries: [
+                PiPotReport(deployment_id, data, timestamp)
+                for data, timestamp in entries]
+        service.get_notification_levels_for.side_effect = \
+            lambda rows: [int(row.message) for row in rows]
+        content = [
+            {'service': 'TelnetService', 'data': '1',
+             'timestamp': '2016-01-01 12:00:00'},
+            {'service': 'PiPot', 'data': 'booted', 'timestamp': ''},
+            {'service': 'TelnetService', 'data': '2', 'timestamp': ''}
+        ]
+        with mock.patch('serverCollector.ServiceLoader.registry') as registry:
+            registry.get_instance.return_value = service
+            collector.process_content(
+                collector.deployments.get('test'), content)
+        self.assertEqual(service.create_storage_rows.call_count, 1)
+        self.assertEqual(service.get_notification_levels_for.call_count, 1)
+        collector.buffer.flush()
+        self.assertEqual(
+            sorted(r.message for r in PiPotReport.query.all()),
+            ['2', 'booted'])
+
+    def test_metrics_count_rejected_messages(self):
+        collector = ServerCollector(self.db)
+        collector.process_data('not json')
+        collector.process_data('{"instance": "test"}')
+        collector.process_data('{"instance": "unknown", "data": ""}')
+        collector.process_data('{"instance": "test", "data": "garbage"}')
+        output = collector.metrics.render()
+        self.assertIn('pipot_collector_messages_received_total 4', output)
+        for reason in ['invalid_json', 'missing_fields', 'unknown_instance',
+                       'undecryptable']:
+            self.assertIn('pipot_collector_messages_rejected_total{'
+                          'reason="%s"} 1' % reason, output)
+        self.assertIn('pipot_collector_stage_seconds_count{stage="decode"} 2',
+                      output)
+        self.assertIn('pipot_collector_cache_misses_total{'
+                      'cache="deployment"} 2', output)
+
+    def test_metrics_notify_latency_per_notifier(self):
+        collector = ServerCollector(self.db)
+        collector.dispatcher.observer('Mail', 0.2)
+        output = collector.metrics.render()
+        self.assertIn('pipot_collector_notify_seconds_bucket{'
+                      'notifier="Mail",le="0.5"} 1', output)
+        self.assertIn('pipot_collector_notify_seconds_count{'
+                      'notifier="Mail"} 1', output)
+        collector.dispatcher.stop()
+
+    def test_prefilter_drops_garbage_before_processing(self):
+        collector = ServerCollector(self.db, {'COLLECTOR_INGEST_WORKERS': 0,
+                                              'COLLECTOR_UNKNOWN_BURST': 1})
+        collector.known.reload()
+        self.assertIn('test', collector.known)
+        collector.receive(b'garbage', '10.0.0.1')
+        for i in range(3):
+            collector.receive(b'{"instance": "unknown", "data": ""}',
+                              '10.0.0.1')
+        collector.receive(b'{"instance": "test", "data": ""}', '10.0.0.1')
+        output = collector.metrics.render()
+        self.assertIn('pipot_collector_messages_received_total 3', output)
+        self.assertIn('pipot_collector_messages_prefiltered_total{'
+                      'reason="malformed"} 1', output)
+        self.assertIn('pipot_collector_messages_prefiltered_total{'
+                      'reason="unknown_instance"} 1', output)
+        # The second unknown message is answered by the cache
+        self.assertIn('pipot_collector_cache_misses_total{'
+                      'cache="deployment"} 2', output)
+
+    def test_unknown_instances_from_many_sources_are_bounded(self):
+        collector = ServerCollector(self.db, {'COLLECTOR_INGEST_WORKERS': 0})
+        collector.known.reload()
+        self.db.rollback()
+
+        def receive_all():
+            for i in range(500):
+                data = '{"instance": "unknown-%s", "data": ""}' % (i % 50)
+                collector.receive(data.encode('utf-8'),
+                                  '10.0.%s.%s' % (i // 250, i % 250))
+        ignored, queries = self.count_queries(receive_all)
+        # Only the overall burst gets through to the database
+        self.assertTrue(0 < queries <= 40)
+        self.assertIn('pipot_collector_messages_prefiltered_total{'
+                      'reason="unknown_instance"}',
+                      collector.metrics.render())
+
+    def add_keyed_deployment(self):
+        deployment = Deployment(
+            name='keyed-deployment', profile_id=1,
+            instance_key='keyed', mac_key='m' * 32,
+            encryption_key='e' * 32, rpi_model=PiModels['one'],
+            server_ip='test', interface='test',
+            wlan_config='test', hostname='test',
+            rootpw='test', debug=True,
+            collector_type=CollectorTypes['udp'])
+        self.db.add(deployment)
+        self.db.commit()
+
+    @staticmethod
+    def make_payload(content):
+        mac = hmac.new(b'm' * 32, json.dumps(
+            content, sort_keys=True).encode('utf8'), hashlib.sha256)
+        return json.dumps({'content': content, 'hmac': mac.hexdigest()})
+
+    def test_accepts_json_and_binary_messages(self):
+        self.add_keyed_deployment()
+        collector = ServerCollector(self.db)
+        content = [{'service': 'PiPot', 'data': 'booted',
+                    'timestamp': '2016-01-01 12:00:00'}]
+        payload = self.make_payload(content).encode('utf8')
+        collector.process_data(json.dumps({
+            'instance': 'keyed',
+            'data': base64.b64encode(Encryption.encrypt_raw(
+                'e' * 32, payload)).decode('ascii')
+        }))
+        collector.process_data(wire.encode_envelope(
+            'keyed', Encryption.encrypt_raw('e' * 32, payload)))
+        collector.process_data(wire.encode_envelope(
+            'keyed', Encryption.encrypt_raw('e' * 32, zlib.compress(payload)),
+            flags=wire.FLAG_COMPRESSED))
+        # Forged and malformed envelopes
+        collector.process_data(wire.encode_envelope(
+            'keyed', Encryption.encrypt_raw('e' * 32, payload.replace(
+                b'booted', b'forged'))))
+        collector.process_data(wire.MAGIC + b'\x09')
+        collector.buffer.flush()
+        self.assertEqual(PiPotReport.query.count(), 3)
+        output = collector.metrics.render()
+        self.assertIn('pipot_collector_messages_rejected_total{'
+                      'reason="hmac_failed"} 1', output)
+        self.assertIn('pipot_collector_messages_rejected_total{'
+                      'reason="invalid_envelope"} 1', output)
+
+    def test_signed_content_is_verified_before_parsing(self):
+        self.add_keyed_deployment()
+        collector = ServerCollector(self.db)
+
+        def send(body, flags=0, key=b'm' * 32):
+            mac = hmac.new(key, body, hashlib.sha256).digest()
+            collector.process_data(wire.encode_envelope(
+                'keyed', Encryption.encrypt_raw('e' * 32, mac + body),
+                version=2, flags=flags))
+        content = json.dumps([{'service': 'PiPot', 'data': 'booted',
+                               'timestamp': '2016-01-01 12:00:00'}])
+        send(content.encode('utf8'))
+        send(zlib.compress(content.encode('utf8')), wire.FLAG_COMPRESSED)
+        send(content.encode('utf8'), key=b'wrong')
+        send(b'{"not": "a list"}')
+        collector.buffer.flush()
+        self.assertEqual(PiPotReport.query.count(), 2)
+        output = collector.metrics.render()
+        self.assertIn('pipot_collector_messages_rejected_total{'
+                      'reason="hmac_failed"} 1', output)
+        self.assertIn('pipot_collector_messages_rejected_total{'
+                      'reason="invalid_content"} 1', output)
+
+    def test_gcm_messages(self):
+        self.add_keyed_deployment()
+        collector = ServerCollector(self.db)
+        content = json.dumps([{'service': 'PiPot', 'data': 'booted',
+                               'timestamp': '2016-01-01 12:00:00'}])
+
+        def envelope(key, flags=0, instance='keyed'):
+            header = wire.encode_envelope(instance, b'', 3, flags)
+            body = content.encode('utf8')
+            if flags & wire.FLAG_COMPRESSED:
+                body = zlib.compress(body)
+            return header + Encryption.encrypt_gcm(key, body, header)
+        collector.process_data(envelope('e' * 32))
+        collector.process_data(envelope('e' * 32, wire.FLAG_COMPRESSED))
+        collector.process_data(envelope('x' * 32))
+        # The header is authenticated: flipping a flag is detected
+        data = bytearray(envelope('e' * 32))
+        data[3] ^= wire.FLAG_COMPRESSED
+        collector.process_data(bytes(data))
+        collector.buffer.flush()
+        self.assertEqual(PiPotReport.query.count(), 2)
+        self.assertIn('pipot_collector_messages_rejected_total{'
+                      'reason="auth_failed"} 2', collector.metrics.render())
+
+    def test_retransmitted_batches_are_suppressed(self):
+        self.add_keyed_deployment()
+        collector = ServerCollector(self.db)
+        content = json.dumps([{'service': 'PiPot', 'data': 'booted',
+                               'timestamp': '2016-01-01 12:00:00'}])
+
+        def envelope(nonce, key='e' * 32):
+            header = wire.encode_envelope('keyed', b'', 3, nonce=nonce)
+            return header + Encryption.encrypt_gcm(
+                key, content.encode('utf8'), header)
+        # A forged batch doesn't block the real one with the same nonce
+        collector.process_data(envelope(b'batch--1', 'x' * 32))
+        collector.process_data(envelope(b'batch--1'))
+        collector.process_data(envelope(b'batch--1'))
+        collector.process_data(envelope(b'batch--2'))
+
+        def json_message(payload, nonce=None):
+            message = {'instance': 'keyed', 'data': base64.b64encode(
+                Encryption.encrypt_raw('e' * 32, payload.encode(
+                    'utf8'))).decode('ascii')}
+            if nonce is not None:
+                message['nonce'] = nonce
+            return json.dumps(message)
+        # The nonce in the payload is covered by the hmac
+        signed = {'content': json.loads(content), 'nonce': 7}
+        mac = hmac.new(b'm' * 32, json.dumps(
+            signed, sort_keys=True).encode('utf8'), hashlib.sha256)
+        signed['hmac'] = mac.hexdigest()
+        for i in range(2):
+            collector.process_data(json_message(json.dumps(signed)))
+        # Nonces outside the payload aren't authenticated, so ignored
+        payload = self.make_payload(json.loads(content))
+        collector.process_data(json_message(payload, 7))
+        collector.process_data(json_message(payload, 7))
+        collector.buffer.flush()
+        self.assertEqual(PiPotReport.query.count(), 5)
+        output = collector.metrics.render()
+        self.assertIn('pipot_collector_messages_rejected_total{'
+                      'reason="duplicate"} 2', output)
+        self.assertIn('pipot_collector_duplicates_suppressed_total{'
+                      'deployment="2"} 2', output)
+
+    def test_unauthenticated_nonces_cannot_block_batches(self):
+        self.add_keyed_deployment()
+        collector = ServerCollector(self.db)
+        content = json.dumps([{'service': 'PiPot', 'data': 'booted',
+                               'timestamp': '2016-01-01 12:00:00'}])
+
+        def signed(nonce, mac_nonce):
+            body = content.encode('utf8')
+            mac = hmac.new(b'm' * 32, mac_nonce + body,
+                           hashlib.sha256).digest()
+            return wire.encode_envelope(
+                'keyed', Encryption.encrypt_raw('e' * 32, mac + body),
+                version=2, nonce=nonce)
+        # An old authentic body with the nonce of a new batch attached
+        collector.process_data(signed(b'batch--2', b'batch--1'))
+        collector.process_data(signed(b'batch--2', b'batch--2'))
+        # Version 1 envelopes don't authenticate their nonce
+        payload = self.make_payload(json.loads(content)).encode('utf8')
+        for i in range(2):
+            collector.process_data(wire.encode_envelope(
+                'keyed', Encryption.encrypt_raw('e' * 32, payload),
+                nonce=b'batch--3'))
+        collector.buffer.flush()
+        self.assertEqual(PiPotReport.query.count(), 3)
+        output = collector.metrics.render()
+        self.assertIn('pipot_collector_messages_rejected_total{'
+                      'reason="hmac_failed"} 1', output)
+        self.assertNotIn('reason="duplicate"', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import sys
+import types
+import unittest
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pipot.services import ServiceLoader
+from pipot.services.IService import IService
+
+
+class TelnetService(IService):
+    def get_used_table_names(self):
+        return {}
+
+    def create_storage_row(self, deployment_id, data, timestamp):
+        pass
+
+    def get_notification_level(self, storage_row):
+        return 1
+
+    def get_ports_used(self):
+        return []
+
+    def get_notification_levels(self):
+        return [1]
+
+    def get_report_types(self):
+        return []
+
+    def get_data_for_type(self, report_type, **kwargs):
+        return {}
+
+    def get_template_for_type(self, report_type):
+        return ''
+
+    def get_template_arguments(self, report_type, initial_data):
+        return {}
+
+    def get_data_for_type_default_args(self, report_type):
+        return {}
+
+
+class TestServiceLoader(unittest.TestCase):
+
+    def setUp(self):
+        module = types.ModuleType('pipot.services.TelnetService')
+        module.TelnetService = TelnetService
+        sys.modules['pipot.services.TelnetService'] = module
+        self.registry = ServiceLoader.ServiceRegistry()
+
+    def tearDown(self):
+        del sys.modules['pipot.services.TelnetService']
+
+    def test_get_class_instance(self):
+        instance = ServiceLoader.get_class_instance('TelnetService', None, {})
+        self.assertIsInstance(instance, TelnetService)
+
+    def test_get_class_instance_unknown_service(self):
+        self.assertRaises(ServiceLoader.ServiceLoaderException,
+                          ServiceLoader.get_class_instance,
+                          'UnknownService', None, {})
+
+    def test_registry_reuses_instances(self):
+        first = self.registry.get_instance('TelnetService', None, {'a': 1})
+        second = self.registry.get_instance('TelnetService', None, {'a': 1})
+        other = self.registry.get_instance('TelnetService', None, {'a': 2})
+        self.assertIs(first, second)
+        self.assertIsNot(first, other)
+        self.assertEqual((self.registry.hits, self.registry.misses), (1, 2))
+
+    def test_registry_invalidate(self):
+        first = self.registry.get_instance('TelnetService', None, {})
+        self.registry.invalidate('OtherService')
+        self.assertIs(self.registry.get_instance('TelnetService', None, {}),
+                      first)
+        self.registry.invalidate('TelnetService')
+        self.assertIsNot(
+            self.registry.get_instance('TelnetService', None, {}), first)
+
+    def test_config_hash_is_order_independent(self):
+        self.assertEqual(
+            ServiceLoader.get_config_hash({'a': 1, 'b': 2}),
+            ServiceLoader.get_config_hash({'b': 2, 'a': 1}))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from sqlalchemy.exc import OperationalError
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collector.spool import Spool, SpoolDrainer
+
+
+class TestSpool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if name.startswith('spool-'))
+
+    def test_append_and_read(self):
+        spool = Spool(self.directory, segment_size=100)
+        for i in range(10):
+            spool.append(b'record %d' % i)
+        self.assertTrue(len(self.segments()) > 1)
+        records = spool.read(spool.checkpoint, 4)
+        self.assertEqual([r[0] for r in records],
+                         [b'record %d' % i for i in range(4)])
+        records = spool.read(records[-1][1], 100)
+        self.assertEqual([r[0] for r in records],
+                         [b'record %d' % i for i in range(4, 10)])
+        spool.close()
+
+    def test_commit_removes_consumed_segments(self):
+        spool = Spool(self.directory, segment_size=100)
+        for i in range(10):
+            spool.append(b'record %d' % i)
+        self.assertTrue(spool.backlog() > 0)
+        records = spool.read(spool.checkpoint, 100)
+        spool.commit(records[-1][1])
+        self.assertEqual(spool.backlog(), 0)
+        self.assertEqual(len(self.segments()), 1)
+        spool.close()
+        # Reopening continues after the checkpoint
+        spool = Spool(self.directory, segment_size=100)
+        spool.append(b'new')
+        self.assertEqual([r[0] for r in spool.read(spool.checkpoint)],
+                         [b'new'])
+        spool.close()
+
+    def test_recovery_cuts_incomplete_record(self):
+        spool = Spool(self.directory)
+        spool.append(b'complete')
+        spool.close()
+        path = os.path.join(self.directory, self.segments()[-1])
+        size = os.path.getsize(path)
+        with open(path, 'ab') as f:
+            f.write(b'\x00\x00\x00\x10\x00')
+        spool = Spool(self.directory)
+        self.assertEqual(os.path.getsize(path), size)
+        spool.append(b'next')
+        self.assertEqual([r[0] for r in spool.read(spool.checkpoint)],
+                         [b'complete', b'next'])
+        spool.close()
+
+
+class TestSpoolDrainer(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = Spool(self.directory)
+        for i in range(5):
+            self.spool.append(b'%d' % i)
+        self.handled = []
+        self.flush_ok = True
+
+    def tearDown(self):
+        self.spool.close()
+        shutil.rmtree(self.directory)
+
+    def flush(self):
+        return self.flush_ok
+
+    def test_drain(self):
+        drainer = SpoolDrainer(self.spool, self.handled.append, self.flush,
+                               batch_size=3)
+        self.assertTrue(drainer.drain())
+        self.assertTrue(drainer.drain())
+        self.assertFalse(drainer.drain())
+        self.assertEqual(self.handled, [b'0', b'1', b'2', b'3', b'4'])
+        self.assertEqual(self.spool.backlog(), 0)
+
+    def test_failed_flush_is_retried_without_replay(self):
+        drainer = SpoolDrainer(self.spool, self.handled.append, self.flush)
+        self.flush_ok = False
+        self.assertFalse(drainer.drain())
+        self.assertFalse(drainer.drain())
+        self.assertEqual(len(self.handled), 5)
+        self.assertTrue(self.spool.backlog() > 0)
+        self.flush_ok = True
+        self.assertTrue(drainer.drain())
+        self.assertEqual(len(self.handled), 5)
+        self.assertEqual(self.spool.backlog(), 0)
+
+    def test_database_error_stops_batch(self):
+        def handle(payload):
+            if payload == b'2' and len(self.handled) == 2:
+                self.handled.append(None)
+                raise OperationalError('insert', {}, Exception('down'))
+            self.handled.append(payload)
+        drainer = SpoolDrainer(self.spool, handle, self.flush)
+        self.assertTrue(drainer.drain())
+        self.assertEqual(self.spool.read(self.spool.checkpoint)[0][0], b'2')
+        self.assertTrue(drainer.drain())
+        self.assertEqual(self.handled, [b'0', b'1', None, b'2', b'3', b'4'])
+
+    def test_invalid_record_is_skipped(self):
+        def handle(payload):
+            if payload == b'1':
+                raise ValueError(payload)
+            self.handled.append(payload)
+        drainer = SpoolDrainer(self.spool, handle, self.flush)
+        self.assertTrue(drainer.drain())
+        self.assertEqual(self.handled, [b'0', b'2', b'3', b'4'])
+        self.assertEqual(drainer.skipped, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
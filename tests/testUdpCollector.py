@@ -0,0 +1,69 @@
+import os
+import socket
+import sys
+import tempfile
+import unittest
+
+import mock
+from twisted.internet import task
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collector.udp import get_socket_drops, set_receive_buffer
+from serverCollector import UDPCollector
+
+
+class TestUdpCollector(unittest.TestCase):
+
+    def test_without_batching(self):
+        collector = mock.Mock()
+        protocol = UDPCollector(collector, 4)
+        protocol.datagramReceived(b'abc', ('10.0.0.1', 1234))
+        protocol.datagramReceived(b'abcde', ('10.0.0.1', 1234))
+        collector.receive.assert_called_once_with(b'abc', '10.0.0.1')
+        collector.discard.assert_called_once_with('too_large')
+
+    def test_batches_on_size_and_delay(self):
+        collector = mock.Mock()
+        clock = task.Clock()
+        protocol = UDPCollector(collector, batch_size=3, batch_delay=0.01,
+                                clock=clock)
+        for i in range(4):
+            protocol.datagramReceived(b'%d' % i, ('10.0.0.1', 1234))
+        collector.receive_batch.assert_called_once_with(
+            [(b'0', '10.0.0.1'), (b'1', '10.0.0.1'), (b'2', '10.0.0.1')])
+        clock.advance(0.01)
+        collector.receive_batch.assert_called_with([(b'3', '10.0.0.1')])
+        self.assertEqual(collector.receive_batch.call_count, 2)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_receive_buffer(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.assertTrue(set_receive_buffer(sock, 65536) >= 65536)
+        finally:
+            sock.close()
+
+    def test_socket_drops(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        table = tempfile.NamedTemporaryFile('w', delete=False)
+        try:
+            inode = os.fstat(sock.fileno()).st_ino
+            table.write(
+                '  sl  local_address rem_address   st tx_queue rx_queue tr '
+                'tm->when retrnsmt   uid  timeout inode ref pointer drops\n'
+                '  1: 00000000:303A 00000000:0000 07 00000000:00000000 '
+                '00:00000000 00000000  1000        0 %s 2 '
+                '0000000000000000 42\n' % inode)
+            table.close()
+            self.assertEqual(get_socket_drops(sock.fileno(), (table.name,)),
+                             42)
+            self.assertIsNone(get_socket_drops(sock.fileno(), ()))
+        finally:
+            sock.close()
+            os.remove(table.name)
+
+
+if __name__ == '__main__':
+    unittest.main()
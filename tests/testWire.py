@@ -0,0 +1,51 @@
+import os
+import sys
+import unittest
+
+# Need to append server root path to ensure we can import the necessary files.
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collector import wire
+
+
+class TestWire(unittest.TestCase):
+
+    def test_round_trip(self):
+        data = wire.encode_envelope('instance', b'\x00body',
+                                    flags=wire.FLAG_COMPRESSED)
+        self.assertTrue(wire.is_envelope(data))
+        envelope = wire.decode_envelope(data)
+        self.assertEqual(envelope, wire.Envelope(
+            1, wire.FLAG_COMPRESSED, 'instance', None, b'\x00body'))
+
+    def test_round_trip_with_nonce(self):
+        data = wire.encode_envelope('instance', b'body', 3,
+                                    nonce=b'12345678')
+        envelope = wire.decode_envelope(data)
+        self.assertEqual(envelope, wire.Envelope(
+            3, wire.FLAG_NONCE, 'instance', b'12345678', b'body'))
+        self.assertEqual(wire.get_header(data, envelope),
+                         data[:-len(b'body')])
+        self.assertRaises(wire.WireError, wire.decode_envelope, data[:15])
+        self.assertRaises(wire.WireError, wire.encode_envelope,
+                          'instance', b'', nonce=b'short')
+        self.assertRaises(wire.WireError, wire.encode_envelope,
+                          'instance', b'', flags=wire.FLAG_NONCE)
+
+    def test_json_is_not_an_envelope(self):
+        self.assertFalse(wire.is_envelope(b'{"instance": "x"}'))
+
+    def test_invalid_envelopes(self):
+        self.assertRaises(wire.WireError, wire.decode_envelope, b'PP\x01')
+        self.assertRaises(wire.WireError, wire.decode_envelope,
+                          b'PP\x01\x00\x10short')
+        self.assertRaises(wire.WireError, wire.decode_envelope,
+                          wire.encode_envelope('instance', b'', version=9))
+        self.assertRaises(wire.WireError, wire.decode_envelope,
+                          b'PP\x01\x00\x02\xff\xfe')
+        self.assertRaises(wire.WireError, wire.encode_envelope,
+                          'x' * 256, b'')
+
+
+if __name__ == '__main__':
+    unittest.main()